@@ -2,19 +2,38 @@
 
 from django.contrib import admin
 from django import forms
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 
-from runner.models import Command, Run
+from runner.models import Command, Run, trigger_many
+
+# how much of the end of a run's output the admin shows
+ADMIN_OUTPUT_SIZE = 8 * 1024
 
 class CommandAdmin(admin.ModelAdmin):
     "The command admin is used to populate the available commands"
     search_fields = ['title', 'description', 'command_to_run']
-    list_display = ('title', 'description', 'run_link')
+    list_display = ('title', 'description', 'target', 'run_link')
+    list_filter = ['target']
     prepopulated_fields = {'slug': ("title",)}
     ordering = ['title']
     date_hierarchy = 'created_date'
+    actions = ['run_selected']
     fieldsets = (
         (None,
-            {'fields':('title', 'description', 'command_to_run')}
+            {'fields':('title', 'description', 'command_to_run', 'target')}
+        ),
+        ('Concurrency',
+            {
+                'fields':(('concurrency', 'max_concurrent'),),
+                'classes':('collapse',),
+            }
+        ),
+        ('Retention',
+            {
+                'fields':(('keep_runs', 'keep_days'), 'keep_failures'),
+                'classes':('collapse',),
+            }
         ),
         ('Meta',
             {
@@ -24,12 +43,53 @@ class CommandAdmin(admin.ModelAdmin):
         ),
     )
 
+    def run_selected(self, request, queryset):
+        "run all of the selected commands in one go"
+        runs = trigger_many(list(queryset))
+        rejected = runs.count(None)
+        message = "Started %s runs" % (len(runs) - rejected)
+        if rejected:
+            message += ", %s already running" % rejected
+        self.message_user(request, message)
+    run_selected.short_description = "Run selected commands"
+
+class OutputWidget(forms.Widget):
+    """
+    Shows the end of the output of a run, read only, with a link to the
+    run's page for the rest. Only the chunks at the end are loaded.
+    """
+    run = None
+
+    def render(self, name, value, attrs=None):
+        if self.run is None or self.run.id is None:
+            return u""
+        start, output = self.run.tail_output(ADMIN_OUTPUT_SIZE)
+        if start:
+            link = u'The last %s characters, <a href="%s">see it all</a>' % (
+                len(output), self.run.get_absolute_url())
+        else:
+            link = u'<a href="%s">View the run</a>' % (
+                self.run.get_absolute_url())
+        return mark_safe(u'<pre>%s</pre><p>%s</p>' % (escape(output), link))
+
+class RunForm(forms.ModelForm):
+    "Adds the output of the run, which is stored in chunks, for reading"
+    output = forms.CharField(required=False, widget=OutputWidget)
+
+    def __init__(self, *args, **kwargs):
+        super(RunForm, self).__init__(*args, **kwargs)
+        self.fields['output'].widget.run = self.instance
+
+    class Meta:
+        model = Run
+
 class RunAdmin(admin.ModelAdmin):
     "The run admin is really only available for completeness"
     list_display = ('command', 'created_date', 'updated_date', 'status')
     ordering = ['-updated_date']
     date_hierarchy = 'updated_date'
     list_filter = ['command', 'status']
+    form = RunForm
     fieldsets = (
         (None,
             {'fields':('command', 'status', 'output')}
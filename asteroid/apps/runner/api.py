@@ -0,0 +1,340 @@
+"""
+A read only JSON API for commands and runs, so scripts don't need to
+scrape the HTML pages. The urls mirror those of the pages, under /api/.
+
+Callers can ask for just the fields they want with a comma separated
+fields parameter, and only the columns needed for those fields are
+loaded. Runs are listed newest first using the same page tokens as the
+pages, passed as after and before.
+"""
+
+from datetime import datetime
+
+from django.http import HttpResponse
+from django.utils import simplejson
+from django.utils.encoding import force_unicode
+from django.utils.functional import wraps
+
+from runner.models import Command, Run, CommandStat, STATUSES, combine
+from runner.pagination import paginate, InvalidToken, PER_PAGE
+from runner import search
+
+# the most output we return in one go, in characters
+MAX_OUTPUT_RANGE = 1024 * 1024
+# how much output to include with a run
+RUN_OUTPUT_SIZE = 64 * 1024
+# the most runs we return in one go
+MAX_PER_PAGE = 100
+# the most days of statistics we return
+MAX_STATS_DAYS = 366
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d")
+
+class BadRequest(Exception):
+    "Raised when the parameters of a request don't make sense"
+    pass
+
+class NotFound(Exception):
+    "Raised when the command or run asked for doesn't exist"
+    pass
+
+def api_view(view):
+    "turn what a view returns into JSON, and our exceptions into errors"
+    def wrapper(request, *args, **kwargs):
+        try:
+            obj = view(request, *args, **kwargs)
+            status = 200
+        except BadRequest, e:
+            obj = {'error': force_unicode(e)}
+            status = 400
+        except NotFound, e:
+            obj = {'error': force_unicode(e)}
+            status = 404
+        response = HttpResponse(simplejson.dumps(obj),
+            content_type = 'application/javascript; charset=utf8')
+        response.status_code = status
+        return response
+    return wraps(view)(wrapper)
+
+def format_date(date):
+    return date and date.isoformat() or None
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise BadRequest("Can't understand the date %s" % value)
+
+def parse_int(request, name, default=None):
+    value = request.GET.get(name)
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise BadRequest("%s should be a number" % name)
+
+# The fields of each resource. Each has the columns it needs loading, or
+# the related columns for runs, and a function to get its value.
+
+COMMAND_FIELDS = {
+    'id': (('id',), lambda command: command.id),
+    'slug': (('slug',), lambda command: command.slug),
+    'title': (('title',), lambda command: command.title),
+    'description': (('description',), lambda command: command.description),
+    'command_to_run': (('command_to_run',),
+        lambda command: command.command_to_run),
+    'status': (('last_run_status',), lambda command: command.status()),
+    'last_run_id': (('last_run_id',), lambda command: command.last_run_id),
+    'last_run_date': (('last_run_date',),
+        lambda command: format_date(command.last_run_date)),
+    'created_date': (('created_date',),
+        lambda command: format_date(command.created_date)),
+    'updated_date': (('updated_date',),
+        lambda command: format_date(command.updated_date)),
+    'url': (('slug',), lambda command: command.get_absolute_url()),
+}
+
+def run_output(run):
+    "the end of the output of a run"
+    return run.tail_output(RUN_OUTPUT_SIZE)[1]
+
+def run_output_start(run):
+    "where the output we include with a run starts"
+    return max(0, run.output_length - RUN_OUTPUT_SIZE)
+
+RUN_FIELDS = {
+    'id': (('id',), lambda run: run.id),
+    'command': (('command__slug',), lambda run: run.command.slug),
+    'command_run': (('command_run',), lambda run: run.command_run),
+    'status': (('status',), lambda run: run.status),
+    'created_date': (('created_date',),
+        lambda run: format_date(run.created_date)),
+    'updated_date': (('updated_date',),
+        lambda run: format_date(run.updated_date)),
+    'started_at': (('started_at',), lambda run: format_date(run.started_at)),
+    'finished_at': (('finished_at',),
+        lambda run: format_date(run.finished_at)),
+    'exit_code': (('exit_code',), lambda run: run.exit_code),
+    'duration': (('duration',), lambda run: run.duration),
+    'output_length': (('output_length',), lambda run: run.output_length),
+    'output_start': (('output_length',), run_output_start),
+    'output': (('output_length',), run_output),
+    'url': (('command__slug',), lambda run: run.get_absolute_url()),
+}
+
+# output is expensive so isn't included in lists unless asked for
+RUN_LIST_FIELDS = [name for name in RUN_FIELDS
+    if name not in ('output', 'output_start')]
+
+def selected_fields(request, available, default=None):
+    "the fields asked for, or all of them"
+    if not request.GET.get('fields'):
+        return default or available.keys()
+    fields = [field.strip() for field in request.GET['fields'].split(",")
+        if field.strip()]
+    for field in fields:
+        if field not in available:
+            raise BadRequest("Unknown field %s" % field)
+    return fields
+
+def load(queryset, available, fields, required=('id',)):
+    "limit a queryset to the columns needed for the fields"
+    columns = set(required)
+    related = False
+    for field in fields:
+        for column in available[field][0]:
+            columns.add(column)
+            if "__" in column:
+                related = True
+    if related:
+        queryset = queryset.select_related('command')
+    return queryset.only(*columns)
+
+def serialise(obj, available, fields):
+    return dict([(field, available[field][1](obj)) for field in fields])
+
+@api_view
+def api_commands(request):
+    "all the commands"
+    fields = selected_fields(request, COMMAND_FIELDS)
+    commands = load(Command.objects.order_by('title'), COMMAND_FIELDS, fields)
+    return {
+        'commands': [serialise(command, COMMAND_FIELDS, fields)
+            for command in commands],
+    }
+
+def get_command(slug, fields=('id',)):
+    try:
+        return load(Command.objects, COMMAND_FIELDS, fields).get(slug=slug)
+    except Command.DoesNotExist:
+        raise NotFound("No command %s" % slug)
+
+@api_view
+def api_command(request, command):
+    "a single command"
+    fields = selected_fields(request, COMMAND_FIELDS)
+    return serialise(get_command(command, fields), COMMAND_FIELDS, fields)
+
+@api_view
+def api_runs(request, command=None):
+    """
+    A page of runs, newest first, optionally filtered by command, status
+    and the date they were last updated.
+    """
+    fields = selected_fields(request, RUN_FIELDS, RUN_LIST_FIELDS)
+    runs = Run.objects.all()
+
+    # a command in the url or the query string
+    command = command or request.GET.get('command')
+    if command:
+        # filtering on the id lets the database use the command index
+        runs = runs.filter(command=get_command(command).id)
+    status = request.GET.get('status')
+    if status:
+        if status not in dict(STATUSES):
+            raise BadRequest("Unknown status %s" % status)
+        runs = runs.filter(status=status)
+    if request.GET.get('since'):
+        runs = runs.filter(updated_date__gte=parse_date(request.GET['since']))
+    if request.GET.get('until'):
+        runs = runs.filter(updated_date__lt=parse_date(request.GET['until']))
+
+    per_page = parse_int(request, 'per_page', PER_PAGE)
+    if not 0 < per_page <= MAX_PER_PAGE:
+        raise BadRequest("per_page should be between 1 and %s" % MAX_PER_PAGE)
+
+    # the pagination needs the updated date and id
+    runs = load(runs, RUN_FIELDS, fields, ('id', 'updated_date'))
+    try:
+        page = paginate(runs, request.GET.get('after'),
+            request.GET.get('before'), per_page)
+    except InvalidToken:
+        raise BadRequest("Invalid page token")
+    return {
+        'runs': [serialise(run, RUN_FIELDS, fields)
+            for run in page.object_list],
+        'next': page.next_token,
+        'previous': page.previous_token,
+    }
+
+def get_run(command, run, fields):
+    runs = load(Run.objects.order_by(), RUN_FIELDS, fields)
+    try:
+        return runs.get(id=run, command__slug=command)
+    except Run.DoesNotExist:
+        raise NotFound("No run %s of %s" % (run, command))
+
+@api_view
+def api_run(request, command, run):
+    "a single run, with the end of its output"
+    fields = selected_fields(request, RUN_FIELDS)
+    return serialise(get_run(command, run, fields), RUN_FIELDS, fields)
+
+@api_view
+def api_run_status(request, command, run):
+    "just enough to tell how a run is getting on"
+    existing_run = get_run(command, run, ('status', 'output_length',
+        'updated_date'))
+    return {
+        'id': existing_run.id,
+        'status': existing_run.status,
+        'output_length': existing_run.output_length,
+        'updated_date': format_date(existing_run.updated_date),
+        'complete': existing_run.is_finished(),
+    }
+
+@api_view
+def api_run_output(request, command, run):
+    """
+    Part of the output of a run, from start up to but not including end.
+    Offsets count characters. Without an end we return as much as we can.
+    """
+    existing_run = get_run(command, run, ('status', 'output_length'))
+    start = parse_int(request, 'start', 0)
+    end = parse_int(request, 'end', start + MAX_OUTPUT_RANGE)
+    if start < 0 or end < start:
+        raise BadRequest("start and end should be in order and positive")
+    end = min(end, start + MAX_OUTPUT_RANGE)
+    output = existing_run.read_output(start, end)
+    return {
+        'start': start,
+        'end': start + len(output),
+        'output': output,
+        'output_length': existing_run.output_length,
+        'status': existing_run.status,
+    }
+
+def stat_record(stat):
+    "the statistics for a day, or a summary of several"
+    return {
+        'runs': stat.runs,
+        'failures': stat.failures,
+        'failure_rate': stat.failure_rate(),
+        'mean_duration': stat.mean_duration(),
+        'p50_duration': stat.p50(),
+        'p95_duration': stat.p95(),
+    }
+
+@api_view
+def api_command_stats(request, command):
+    """
+    How the runs of a command have gone each day for the last few days,
+    newest first, and over all of those days together. Durations are in
+    seconds, and the percentiles are estimates.
+    """
+    days = parse_int(request, 'days', 14)
+    if not 0 < days <= MAX_STATS_DAYS:
+        raise BadRequest("days should be between 1 and %s" % MAX_STATS_DAYS)
+    stats = list(CommandStat.objects.recent(days).filter(
+        command=get_command(command).id))
+    daily = []
+    for stat in stats:
+        record = stat_record(stat)
+        record['day'] = stat.day.isoformat()
+        daily.append(record)
+    return {
+        'days': daily,
+        'summary': stat_record(combine(stats)),
+    }
+
+@api_view
+def api_search(request):
+    """
+    Runs whose output contains the text in q, newest first, each with a
+    snippet of its output and where the matches are in the snippet. Pass
+    next as before to get more.
+    """
+    query = request.GET.get('q', '').strip()
+    if not query:
+        raise BadRequest("q should be the text to search for")
+    fields = selected_fields(request, RUN_FIELDS, RUN_LIST_FIELDS)
+    command_id = None
+    if request.GET.get('command'):
+        command_id = get_command(request.GET['command']).id
+    before = parse_int(request, 'before')
+    per_page = parse_int(request, 'per_page', search.RESULTS)
+    if not 0 < per_page <= MAX_PER_PAGE:
+        raise BadRequest("per_page should be between 1 and %s" % MAX_PER_PAGE)
+
+    try:
+        found = search.search(query, command_id, before, per_page)
+    except search.SearchError, e:
+        raise BadRequest("Can't search for %s" % query)
+    runs = load(Run.objects.all(), RUN_FIELDS, fields).in_bulk(
+        [run_id for run_id, snippet in found])
+    results = []
+    for run_id, snippet in found:
+        # the run may have been deleted since it was indexed
+        if run_id not in runs:
+            continue
+        result = serialise(runs[run_id], RUN_FIELDS, fields)
+        result['snippet'], result['highlights'] = search.split_snippet(
+            snippet)
+        results.append(result)
+    return {
+        'results': results,
+        'next': len(found) == per_page and found[-1][0] or None,
+    }
@@ -0,0 +1,128 @@
+"""
+Run commands on a pool of threads inside the web process, so without a
+message queue a request to run a command can return straight away rather
+than waiting for the command to finish. Commands spend their time waiting
+on other processes so threads are fine here.
+"""
+
+import sys
+import threading
+import time
+import traceback
+import Queue
+
+from django.conf import settings
+from django.db import connection
+
+from runner import metrics
+
+JOBS_RUNNING = metrics.gauge("asteroid_background_jobs_running",
+    "Jobs being run on background threads")
+JOBS_BUSY = metrics.counter("asteroid_background_busy_total",
+    "Jobs turned away because too many were already waiting")
+WAIT_SECONDS = metrics.histogram("asteroid_background_wait_seconds",
+    "How long jobs waited for a background thread",
+    buckets=metrics.RUN_BUCKETS)
+JOB_SECONDS = metrics.histogram("asteroid_background_job_seconds",
+    "How long background jobs took to run", buckets=metrics.RUN_BUCKETS)
+
+class Busy(Exception):
+    "Raised when too many jobs are already waiting to run"
+    pass
+
+class BackgroundExecutor(object):
+    """
+    Runs jobs on a fixed number of threads, holding no more than
+    max_queued jobs waiting for a free thread. Threads are started when the
+    first job is submitted.
+    """
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self.jobs = Queue.Queue(max_queued)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def submit(self, func, *args):
+        "queue a job, raising Busy if the queue is full"
+        self.start()
+        try:
+            self.jobs.put_nowait((func, args, time.time()))
+        except Queue.Full:
+            JOBS_BUSY.inc()
+            raise Busy()
+
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    # we've been told to stop
+                    break
+                func, args, submitted = job
+                WAIT_SECONDS.observe(time.time() - submitted)
+                JOBS_RUNNING.inc()
+                timer = JOB_SECONDS.time()
+                try:
+                    func(*args)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+                timer.stop()
+                JOBS_RUNNING.dec()
+            finally:
+                self.jobs.task_done()
+                # each thread has its own connection, don't leave it open
+                # between jobs
+                connection.close()
+
+    def wait(self):
+        "wait for all the jobs submitted so far to finish"
+        self.jobs.join()
+
+    def shutdown(self):
+        "let the queued jobs finish then stop the threads"
+        self.lock.acquire()
+        try:
+            for thread in self.threads:
+                self.jobs.put(None)
+            for thread in self.threads:
+                thread.join()
+            self.threads = []
+        finally:
+            self.lock.release()
+
+# there's one executor per process, created when it's first needed
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    "return the background executor for this process"
+    global _executor
+    _executor_lock.acquire()
+    try:
+        if _executor is None:
+            _executor = BackgroundExecutor(settings.BACKGROUND_WORKERS,
+                settings.BACKGROUND_QUEUE_SIZE)
+        return _executor
+    finally:
+        _executor_lock.release()
+
+def jobs_waiting():
+    "how many jobs are waiting for a thread in this process"
+    if _executor is None:
+        return 0
+    return _executor.jobs.qsize()
+
+JOBS_WAITING = metrics.gauge("asteroid_background_jobs_waiting",
+    "Jobs waiting for a background thread", function=jobs_waiting)
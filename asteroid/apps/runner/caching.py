@@ -0,0 +1,154 @@
+"""
+Caching of rendered pages and parts of pages. Rather than finding and
+deleting everything which mentions a command or run when one changes, each
+group of cached things has a version number which is part of every key.
+Changing a command or run bumps the version of the groups it appears in,
+so the old entries are never looked at again and just expire. This only
+needs get, set and incr so works with the local memory and file caches as
+well as memcached.
+
+Versions are only seen by processes sharing the cache. With the local
+memory cache, changes made by management commands such as prune_runs
+don't reach the web server, which shows what it has cached until
+CACHE_TIMEOUT passes. Those commands warn about this.
+
+Hits and misses are counted in the cache too, per cached thing, so they
+can be seen across processes sharing a cache.
+"""
+
+import sys
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.functional import wraps
+from django.utils.hashcompat import md5_constructor
+
+# the groups, commands for anything showing commands or their status and
+# runs for anything listing runs
+COMMANDS = "commands"
+RUNS = "runs"
+
+# versions and counters need to outlive what's cached, memcached won't
+# take anything longer than 30 days
+LONG_TIMEOUT = 60 * 60 * 24 * 30
+
+# backends which keep what's cached to the process doing the caching
+LOCAL_BACKENDS = ("locmem",)
+
+def is_shared():
+    "whether other processes see our cache, and so the versions we bump"
+    return settings.CACHE_BACKEND.split(":", 1)[0] not in LOCAL_BACKENDS
+
+def warn_if_not_shared():
+    "for management commands which change what the pages show"
+    if not is_shared():
+        print >> sys.stderr, ("The cache isn't shared with the web server, "
+            "so its pages may not show these changes for up to %s seconds. "
+            "Set CACHE_BACKEND to a file or memcached cache to avoid this." %
+            settings.CACHE_TIMEOUT)
+
+def _key(*parts):
+    return ":".join(["asteroid"] + [str(part) for part in parts])
+
+def _new_version():
+    """
+    a version which won't have been used before, so if the version itself
+    is evicted we can't go back to entries cached under an old one
+    """
+    return int(time.time() * 1000)
+
+def get_versions(groups):
+    "the current version of each of the groups, in the same order"
+    keys = [_key("version", group) for group in groups]
+    found = cache.get_many(keys)
+    versions = []
+    for key in keys:
+        version = found.get(key)
+        if version is None:
+            version = _new_version()
+            # someone else may have got there first
+            if not cache.add(key, version, LONG_TIMEOUT):
+                version = cache.get(key, version)
+        versions.append(version)
+    return versions
+
+def bump(*groups):
+    "change the version of the groups, which invalidates what's cached"
+    for group in groups:
+        key = _key("version", group)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _new_version(), LONG_TIMEOUT)
+
+def versioned_key(name, groups, vary_on=()):
+    "the key for a cached thing which depends on the groups"
+    key = _key("cached", name, *get_versions(groups))
+    if vary_on:
+        digest = md5_constructor(u":".join([unicode(value)
+            for value in vary_on]).encode('utf-8'))
+        key = "%s:%s" % (key, digest.hexdigest())
+    return key
+
+def count(name, outcome):
+    "count a hit or miss"
+    key = _key("stats", outcome, name)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, LONG_TIMEOUT)
+        # remember the names we've counted so we can report on them
+        names = cache.get(_key("stats", "names"), [])
+        if name not in names:
+            cache.set(_key("stats", "names"), names + [name], LONG_TIMEOUT)
+
+def lookup(name, groups, vary_on=()):
+    "return a cached thing and its key, or None and the key to set it with"
+    key = versioned_key(name, groups, vary_on)
+    value = cache.get(key)
+    if value is None:
+        count(name, "misses")
+    else:
+        count(name, "hits")
+    return value, key
+
+def store(key, value):
+    "cache something under a key from lookup"
+    cache.set(key, value, settings.CACHE_TIMEOUT)
+
+def stats(names=None):
+    "the hits and misses of each of the named cached things, or all of them"
+    if names is None:
+        names = cache.get(_key("stats", "names"), [])
+    results = {}
+    for name in names:
+        found = cache.get_many([_key("stats", "hits", name),
+            _key("stats", "misses", name)])
+        results[name] = {
+            'hits': found.get(_key("stats", "hits", name), 0),
+            'misses': found.get(_key("stats", "misses", name), 0),
+        }
+    return results
+
+def cache_view(name, groups):
+    """
+    Decorator which caches the pages rendered by a view, which depend on the
+    groups, for each url and query string. Only successful GET requests are
+    cached.
+    """
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            if request.method != "GET":
+                return view(request, *args, **kwargs)
+            cached, key = lookup(name, groups, [request.get_full_path()])
+            if cached is not None:
+                content, content_type = cached
+                return HttpResponse(content, content_type=content_type)
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                store(key, (response.content, response['Content-Type']))
+            return response
+        return wraps(view)(wrapper)
+    return decorator
@@ -0,0 +1,81 @@
+"""
+Compression of stored output. Command output tends to be very repetitive
+so it compresses well. Chunks are compressed when they're written if
+they're big enough to be worth it, using lzma for the largest if it's
+available and zlib otherwise. The compressed bytes are base64 encoded as
+they're stored in a text column.
+"""
+
+import base64
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# no compression
+PLAIN = ""
+ZLIB = "zlib"
+LZMA = "lzma"
+
+ENCODINGS = (
+    (PLAIN, "plain"),
+    (ZLIB, "zlib"),
+    (LZMA, "lzma"),
+)
+
+# output smaller than this, in bytes, isn't worth compressing
+COMPRESS_MIN_SIZE = 1024
+# and output at least this big gets the slower but smaller lzma
+LZMA_MIN_SIZE = 32 * 1024
+
+# how much output, in characters, to put in each chunk when rewriting
+# the output of finished runs
+COMPACT_SIZE = 64 * 1024
+
+def choose_encoding(size):
+    "pick the encoding for a piece of output of the given size in bytes"
+    if size < COMPRESS_MIN_SIZE:
+        return PLAIN
+    if size >= LZMA_MIN_SIZE and lzma is not None:
+        return LZMA
+    return ZLIB
+
+def compress(text):
+    """
+    Compress some output, returning the encoding used, the data to store
+    and the size of the output in bytes. If compressing doesn't make it any
+    smaller the output is stored as it is.
+    """
+    raw = text.encode('utf-8')
+    encoding = choose_encoding(len(raw))
+    if encoding == PLAIN:
+        return PLAIN, text, len(raw)
+    if encoding == LZMA:
+        packed = lzma.compress(raw)
+    else:
+        packed = zlib.compress(raw, 6)
+    data = base64.b64encode(packed)
+    if len(data) >= len(raw):
+        return PLAIN, text, len(raw)
+    return encoding, data, len(raw)
+
+def decompress(encoding, data):
+    "turn stored data back into the output"
+    if not encoding:
+        return data
+    packed = base64.b64decode(data)
+    if encoding == ZLIB:
+        raw = zlib.decompress(packed)
+    elif encoding == LZMA:
+        if lzma is None:
+            raise ValueError("Output is compressed with lzma, which isn't "
+                "available")
+        raw = lzma.decompress(packed)
+    else:
+        raise ValueError("Unknown output encoding %s" % encoding)
+    return raw.decode('utf-8')
@@ -0,0 +1,44 @@
+"""
+Conditional GET support, so browsers and scripts which already have a page
+can check it hasn't changed without downloading it again.
+"""
+
+from django.utils.cache import patch_cache_control
+from django.utils.functional import wraps
+from django.views.decorators.http import condition
+
+# how long pages which can never change again can be cached for, in seconds
+IMMUTABLE_MAX_AGE = 60 * 60 * 24 * 30
+
+def conditional(state):
+    """
+    Decorator which answers conditional requests for a view with a 304 when
+    nothing has changed, without calling the view. The state function is
+    passed the same arguments as the view and returns the ETag, the last
+    modified date and how long the page can be cached for without checking,
+    or None if there's no such page.
+    """
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return view(request, *args, **kwargs)
+            found = state(request, *args, **kwargs)
+            if found is None:
+                # let the view deal with it
+                return view(request, *args, **kwargs)
+            etag, last_modified, max_age = found
+            response = condition(
+                etag_func = lambda *args, **kwargs: etag,
+                last_modified_func = lambda *args, **kwargs: last_modified,
+            )(view)(request, *args, **kwargs)
+            if response.status_code in (200, 304):
+                if max_age:
+                    patch_cache_control(response, public=True,
+                        max_age=max_age)
+                else:
+                    # check with us every time
+                    patch_cache_control(response, max_age=0,
+                        must_revalidate=True)
+            return response
+        return wraps(view)(wrapper)
+    return decorator
@@ -0,0 +1,58 @@
+"""
+Run shell commands, passing their output on in chunks as it's produced
+rather than holding it all in memory until the command exits.
+"""
+
+import codecs
+import os
+import select
+import subprocess
+import time
+
+# how much to read from the command at once
+READ_SIZE = 4096
+# how much output to collect before passing it on
+FLUSH_SIZE = 64 * 1024
+# and the longest we hold on to output before passing it on, in seconds
+FLUSH_INTERVAL = 2
+
+def execute(command, write, flush_size=FLUSH_SIZE,
+        flush_interval=FLUSH_INTERVAL):
+    """
+    Run a shell command, calling write with each chunk of its combined
+    stdout and stderr as unicode, and return the exit code. Output is passed
+    on once flush_size bytes have been collected or flush_interval seconds
+    have passed, so no more than that is ever held in memory.
+    """
+    process = subprocess.Popen(command, shell=True, close_fds=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # a chunk can end part way through a character
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    pipe = process.stdout.fileno()
+
+    buffered = []
+    size = 0
+    last_flush = time.time()
+    while True:
+        # wait for output, but not so long we miss the next flush
+        timeout = max(0, last_flush + flush_interval - time.time())
+        ready = select.select([pipe], [], [], timeout)[0]
+        if ready:
+            data = os.read(pipe, READ_SIZE)
+            if not data:
+                break
+            buffered.append(data)
+            size += len(data)
+        if size >= flush_size or time.time() - last_flush >= flush_interval:
+            output = decoder.decode("".join(buffered))
+            if output:
+                write(output)
+            buffered = []
+            size = 0
+            last_flush = time.time()
+
+    remaining = decoder.decode("".join(buffered), True)
+    if remaining:
+        write(remaining)
+    process.stdout.close()
+    return process.wait()
@@ -0,0 +1,12 @@
+"Bring the database schema up to date whenever syncdb is run"
+
+from django.db.models.signals import post_syncdb
+
+import runner.models
+
+def apply_migrations(sender, verbosity=1, **kwargs):
+    "syncdb only creates new tables, so apply any changes to existing ones"
+    from runner.migrations import migrate
+    migrate(verbosity=int(verbosity))
+
+post_syncdb.connect(apply_migrations, sender=runner.models)
@@ -0,0 +1,18 @@
+"Populate the denormalised latest run details stored on each command"
+
+from django.core.management.base import NoArgsCommand
+
+from runner.models import Command as AsteroidCommand
+from runner.caching import warn_if_not_shared
+
+class Command(NoArgsCommand):
+    help = "Recalculates the latest run status, id and date stored on each command."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        for command in AsteroidCommand.objects.all():
+            command.refresh_last_run()
+            if verbosity > 1:
+                print "%s: %s" % (command, command.status())
+        if verbosity:
+            warn_if_not_shared()
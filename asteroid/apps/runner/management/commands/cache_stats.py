@@ -0,0 +1,18 @@
+"Report how well the page caches are doing"
+
+from django.core.management.base import NoArgsCommand
+
+from runner.caching import stats
+
+class Command(NoArgsCommand):
+    help = "Shows the hits and misses of each cached page and part of a page. These are kept in the cache, so with the local memory cache this only sees its own process."
+
+    def handle_noargs(self, **options):
+        results = stats()
+        for name in sorted(results.keys()):
+            hits = results[name]['hits']
+            misses = results[name]['misses']
+            total = hits + misses
+            rate = total and 100.0 * hits / total or 0
+            print "%s: %s hits, %s misses (%.1f%%)" % (name, hits, misses,
+                rate)
@@ -0,0 +1,60 @@
+"Compress the stored output of finished runs"
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from runner.models import Run, OutputChunk, UNFINISHED
+
+def storage_report():
+    """
+    return the number of chunks, how many are compressed, the size of the
+    output they hold and the space they take up, in bytes
+    """
+    cursor = connection.cursor()
+    # plain chunks from before compression don't know their size, but as
+    # output is mostly ascii the length of the text is close enough
+    cursor.execute("SELECT COUNT(*), "
+        "SUM(CASE WHEN encoding = '' THEN 0 ELSE 1 END), "
+        "SUM(CASE WHEN original_size = 0 THEN LENGTH(data) "
+        "ELSE original_size END), "
+        "SUM(LENGTH(data)) FROM %s" % connection.ops.quote_name(
+            OutputChunk._meta.db_table))
+    return [value or 0 for value in cursor.fetchone()]
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+            help='How many runs to load at a time.'),
+        make_option('--report', action='store_true', dest='report',
+            default=False, help='Only report on the space used by output.'),
+    )
+    help = "Rewrites the output of finished runs into large compressed chunks, then reports the space saved. Each run is rewritten in its own transaction so this can be run against a live database."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options.get('batch_size') or 100
+
+        if not options.get('report'):
+            runs = Run.objects.exclude(status__in=UNFINISHED).order_by('id')
+            last_id = 0
+            while True:
+                batch = list(runs.filter(id__gt=last_id).only(
+                    'id', 'output_length')[:batch_size])
+                for run in batch:
+                    written = run.compact_output()
+                    if verbosity > 1 and written:
+                        print "run %s: %s chunks" % (run.id, written)
+                if len(batch) < batch_size:
+                    break
+                last_id = batch[-1].id
+
+        chunks, compressed, original, stored = storage_report()
+        if verbosity:
+            saved = original - stored
+            print "%s of %s chunks compressed" % (compressed, chunks)
+            print "%s bytes of output stored in %s bytes" % (original, stored)
+            if original:
+                print "saved %s bytes (%.1f%%)" % (saved,
+                    100.0 * saved / original)
@@ -0,0 +1,25 @@
+"Apply schema migrations to an existing database"
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from runner.migrations import MIGRATIONS, applied_migrations, migrate
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--list', action='store_true', dest='list', default=False,
+            help='List the migrations and whether they have been applied.'),
+    )
+    help = "Applies any pending schema migrations for the runner app. Run syncdb first so any new tables exist."
+
+    def handle_noargs(self, **options):
+        if options.get('list'):
+            applied = applied_migrations()
+            for name, func in MIGRATIONS:
+                if name in applied:
+                    print " * %s" % name
+                else:
+                    print "   %s" % name
+        else:
+            migrate(verbosity=int(options.get('verbosity', 1)))
@@ -0,0 +1,52 @@
+"Archive and delete runs which have passed their command's retention policy"
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+
+from runner.models import Command as AsteroidCommand
+from runner.retention import prune_command, BATCH_SIZE
+from runner.caching import warn_if_not_shared
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--command', dest='command', default=None,
+            help='Only prune the runs of the command with this slug.'),
+        make_option('--archive-dir', dest='archive_dir', default=None,
+            help='Where to archive runs to, defaults to the ARCHIVE_DIR setting.'),
+        make_option('--no-archive', action='store_true', dest='no_archive',
+            default=False, help='Delete runs without archiving them.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=BATCH_SIZE, help='How many runs to delete at a time.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only report how many runs would be pruned.'),
+    )
+    help = "Archives runs which have passed the retention policy of their command to compressed JSON files, then deletes them. Runs are deleted in small batches, so this can be stopped at any point and run against a live database."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        commands = AsteroidCommand.objects.filter(
+            keep_runs__isnull=False) | AsteroidCommand.objects.filter(
+            keep_days__isnull=False)
+        if options.get('command'):
+            commands = commands.filter(slug=options['command'])
+            if not commands:
+                raise CommandError("No command %s with a retention policy" %
+                    options['command'])
+
+        archive_dir = None
+        if not options.get('no_archive'):
+            archive_dir = options.get('archive_dir') or settings.ARCHIVE_DIR
+
+        for command in commands:
+            if options.get('dry_run'):
+                print "%s: %s runs to prune" % (command.slug,
+                    command.expired_runs().count())
+                continue
+            pruned = prune_command(command, archive_dir,
+                options.get('batch_size') or BATCH_SIZE)
+            if verbosity:
+                print "%s: pruned %s runs" % (command.slug, pruned)
+        if verbosity and not options.get('dry_run'):
+            warn_if_not_shared()
@@ -0,0 +1,40 @@
+"Fail runs which haven't been heard from for so long they must have been lost"
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import NoArgsCommand
+
+from runner.models import Run
+from runner.caching import warn_if_not_shared
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--hours', type='int', dest='hours', default=None,
+            help='Fail runs not heard from for longer than this many hours, defaults to the STALE_RUN_HOURS setting.'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+            default=False, help='Only list the runs which would be failed.'),
+    )
+    help = "Marks runs which haven't been heard from for too long as failed. Runs waiting on the queue aren't touched. A run can be left in progress if the listener running it is killed, or its results can't be delivered, so this can be run regularly from cron."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        hours = options.get('hours') or settings.STALE_RUN_HOURS
+        runs = Run.objects.stale(hours).select_related('command').order_by(
+            'id')
+        reaped = 0
+        for run in list(runs):
+            if options.get('dry_run'):
+                if verbosity:
+                    print "%s: run %s would be failed" % (run.command.slug,
+                        run.id)
+                continue
+            run.abandon(u"Failed by reap_runs as nothing was heard from it "
+                "for %s hours" % hours)
+            reaped += 1
+            if verbosity > 1:
+                print "%s: failed run %s" % (run.command.slug, run.id)
+        if verbosity and not options.get('dry_run'):
+            print "failed %s stale runs" % reaped
+            if reaped:
+                warn_if_not_shared()
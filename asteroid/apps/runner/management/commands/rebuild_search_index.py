@@ -0,0 +1,50 @@
+"Fill in the search index from the output of every finished run"
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from runner.models import Run, UNFINISHED
+from runner import search
+
+def index_runs(runs):
+    "add a batch of runs to the index"
+    for run in runs:
+        search.index_run(run)
+index_runs = transaction.commit_on_success(index_runs)
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=100,
+            help='How many runs to index at a time.'),
+        make_option('--keep', action='store_true', dest='keep',
+            default=False, help="Add to the index rather than starting again."),
+    )
+    help = "Creates the search index for the SEARCH_BACKEND setting if need be, empties it and adds the output of every finished run. Runs are indexed in batches, each in its own transaction."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        batch_size = options.get('batch_size') or 100
+
+        backend = search.get_backend()
+        backend.install()
+        if not options.get('keep'):
+            backend.clear()
+        transaction.commit_unless_managed()
+
+        runs = Run.objects.exclude(status__in=UNFINISHED).order_by('id').only(
+            'id', 'command', 'output_length')
+        indexed = 0
+        last_id = 0
+        while True:
+            batch = list(runs.filter(id__gt=last_id)[:batch_size])
+            index_runs(batch)
+            indexed += len(batch)
+            if verbosity > 1:
+                print "indexed %s runs" % indexed
+            if len(batch) < batch_size:
+                break
+            last_id = batch[-1].id
+        if verbosity:
+            print "indexed the output of %s runs" % indexed
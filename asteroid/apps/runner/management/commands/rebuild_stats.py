@@ -0,0 +1,66 @@
+"Work out the daily statistics of each command from its runs"
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+
+from runner.models import Run, CommandStat, UNFINISHED, seconds
+from runner import caching, stats
+
+def rollup(runs, rollups):
+    """
+    Add runs, which are value lists, to the statistics for each command and
+    day. Runs from before we recorded when runs finished are taken to have
+    finished when they were last updated.
+    """
+    for command_id, status, created, updated, started, finished, duration \
+            in runs:
+        finished = finished or updated
+        if duration is None:
+            duration = max(0, seconds(finished - (started or created)))
+        stat = rollups.setdefault((command_id, finished.date()), CommandStat(
+            command_id = command_id,
+            day = finished.date(),
+        ))
+        stat.runs += 1
+        if status == "failed":
+            stat.failures += 1
+        stat.total_duration += duration
+        stat.histogram = stats.add(stat.histogram, duration)
+
+def rebuild(batch_size):
+    "replace the statistics, returning how many rows there are now"
+    CommandStat.objects.all().delete()
+    runs = Run.objects.exclude(status__in=UNFINISHED).order_by('id')
+    fields = ('id', 'command', 'status', 'created_date', 'updated_date',
+        'started_at', 'finished_at', 'duration')
+    rollups = {}
+    last_id = 0
+    while True:
+        batch = list(runs.filter(id__gt=last_id).values_list(*fields)[
+            :batch_size])
+        rollup([row[1:] for row in batch], rollups)
+        if len(batch) < batch_size:
+            break
+        last_id = batch[-1][0]
+    for stat in rollups.values():
+        stat.save()
+    return len(rollups)
+rebuild = transaction.commit_on_success(rebuild)
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size',
+            default=1000, help='How many runs to load at a time.'),
+    )
+    help = "Throws away the daily statistics of each command and works them out again from the runs which haven't been deleted. Useful after upgrading, as runs from before statistics were kept aren't counted."
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity', 1))
+        rows = rebuild(options.get('batch_size') or 1000)
+        # the statistics are cached along with the runs
+        caching.bump(caching.RUNS)
+        if verbosity:
+            print "rebuilt %s days of statistics" % rows
+            caching.warn_if_not_shared()
@@ -0,0 +1,140 @@
+"""
+Counters, gauges and histograms of what the web tier is doing and where
+its time goes, served at /metrics in the Prometheus text format. They're
+kept in memory and need nothing outside the standard library, so the page
+is just as useful read by hand as scraped.
+
+Each process keeps its own numbers, so with several web processes each
+one needs scraping and the numbers adding up by whatever scrapes them.
+Nothing is kept across restarts, counters start from zero again.
+"""
+
+import threading
+import time
+
+from django.db import connection
+from django.utils.functional import wraps
+
+from runner.prometheus import DEFAULT_BUCKETS, RUN_BUCKETS, SIZE_BUCKETS, \
+    CONTENT_TYPE, Counter, Gauge, Histogram, Registry
+
+REGISTRY = Registry()
+
+def counter(name, help, labels=()):
+    return REGISTRY.register(Counter(name, help, labels))
+
+def gauge(name, help, labels=(), function=None):
+    return REGISTRY.register(Gauge(name, help, labels, function))
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, help, labels, buckets))
+
+# database queries, timed by wrapping the cursors django hands out
+
+QUERIES = counter("asteroid_database_queries_total",
+    "Database queries made")
+QUERY_SECONDS = histogram("asteroid_database_query_seconds",
+    "How long each database query took")
+
+# the most queries kept for a thread by capture_queries
+MAX_CAPTURED = 1000
+
+# the time this thread has spent on queries, so views can tell how much of
+# their time was spent in the database
+_queries = threading.local()
+
+def query_time():
+    "how many queries this thread has made, and how long they took"
+    return getattr(_queries, 'count', 0), getattr(_queries, 'seconds', 0.0)
+
+def record_query(elapsed, sql=None):
+    QUERIES.inc()
+    QUERY_SECONDS.observe(elapsed)
+    _queries.count = getattr(_queries, 'count', 0) + 1
+    _queries.seconds = getattr(_queries, 'seconds', 0.0) + elapsed
+    captured = getattr(_queries, 'captured', None)
+    if captured is not None and len(captured) < MAX_CAPTURED:
+        captured.append((sql, elapsed))
+
+def capture_queries():
+    "start keeping the sql and time of each query this thread makes"
+    _queries.captured = []
+
+def captured_queries():
+    """
+    stop keeping queries, returning the sql, with placeholders for the
+    parameters, and time of each one made since capture_queries
+    """
+    captured = getattr(_queries, 'captured', None) or []
+    _queries.captured = None
+    return captured
+
+class TimedCursor(object):
+    "a database cursor which times its queries"
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            record_query(time.time() - start, sql)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            record_query(time.time() - start, sql)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+def time_queries():
+    """
+    Time every query made through the database connection. Django has no
+    hook for this outside of debug mode, so the cursors it hands out are
+    wrapped. Calling this again does nothing.
+    """
+    wrapper_class = connection.__class__
+    if getattr(wrapper_class, 'timed_queries', False):
+        return
+    cursor = wrapper_class.cursor
+    def timed_cursor(self):
+        return TimedCursor(cursor(self))
+    wrapper_class.cursor = wraps(cursor)(timed_cursor)
+    wrapper_class.timed_queries = True
+
+# views
+
+VIEW_SECONDS = histogram("asteroid_view_seconds",
+    "How long views took to respond", ["view"])
+VIEW_DATABASE_SECONDS = histogram("asteroid_view_database_seconds",
+    "How long views spent waiting on the database", ["view"])
+VIEW_QUERIES = histogram("asteroid_view_queries",
+    "How many database queries views made", ["view"], SIZE_BUCKETS)
+
+def instrumented(name):
+    """
+    Decorator which times a view, along with how long it spent on database
+    queries and how many it made, under the given name
+    """
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            count, seconds = query_time()
+            timer = VIEW_SECONDS.time(view=name)
+            try:
+                return view(request, *args, **kwargs)
+            finally:
+                timer.stop()
+                now_count, now_seconds = query_time()
+                VIEW_DATABASE_SECONDS.observe(now_seconds - seconds,
+                    view=name)
+                VIEW_QUERIES.observe(now_count - count, view=name)
+        return wraps(view)(wrapper)
+    return decorator
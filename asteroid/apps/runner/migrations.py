@@ -0,0 +1,287 @@
+"""
+A small schema migration system for the runner app. Django will happily
+create new tables with syncdb but won't touch existing ones, so changes to
+existing tables are made here instead.
+
+Migrations are functions registered in order with the migration decorator.
+Each one is written so it can be run against a database which already has
+the change, which means a freshly created database and one which has been
+upgraded over time end up in the same state. The ones which have been run
+are recorded in the runner_migration table.
+
+Migrations are applied automatically after syncdb, or can be run by hand
+against a live database with the migrate_runner management command.
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+from runner.models import Migration, Command, Run, OutputChunk
+from runner.compression import compress
+from runner import search
+
+# the registered migrations, in the order they should be run
+MIGRATIONS = []
+
+def migration(name):
+    "decorator which registers a function as the next migration"
+    def register(func):
+        MIGRATIONS.append((name, func))
+        return func
+    return register
+
+def quote_name(name):
+    return connection.ops.quote_name(name)
+
+def sql_literal(value):
+    "format a python value for use as a column default"
+    if isinstance(value, bool):
+        if settings.DATABASE_ENGINE == 'sqlite3':
+            return value and '1' or '0'
+        return value and 'true' or 'false'
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    return "'%s'" % unicode(value).replace("'", "''")
+
+def table_columns(table):
+    "the names of the columns in a table"
+    cursor = connection.cursor()
+    description = connection.introspection.get_table_description(cursor, table)
+    return [row[0] for row in description]
+
+def index_exists(table, name):
+    """
+    check for an index by name, which django can't tell us itself. For
+    databases we don't know how to ask this is None
+    """
+    cursor = connection.cursor()
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' "
+            "AND name = %s", [name])
+    elif settings.DATABASE_ENGINE.startswith('postgresql'):
+        cursor.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+            [name])
+    elif settings.DATABASE_ENGINE == 'mysql':
+        cursor.execute("SHOW INDEX FROM %s WHERE Key_name = %%s" %
+            quote_name(table), [name])
+    else:
+        return None
+    return cursor.fetchone() is not None
+
+def execute_if_possible(sql):
+    """
+    run a schema change which fails if it's already been made, returning
+    whether it worked
+    """
+    sid = transaction.savepoint()
+    try:
+        connection.cursor().execute(sql)
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        return False
+    transaction.savepoint_commit(sid)
+    return True
+
+def add_column(model, name):
+    "add the column for a field on the model if it isn't already there"
+    table = model._meta.db_table
+    field = model._meta.get_field(name)
+    if field.column in table_columns(table):
+        return False
+    sql = "ALTER TABLE %s ADD COLUMN %s %s" % (quote_name(table),
+        quote_name(field.column), field.db_type())
+    if not field.null:
+        # existing rows need a value for the new column
+        sql += " DEFAULT %s NOT NULL" % sql_literal(field.get_default())
+    connection.cursor().execute(sql)
+    return True
+
+def create_index(model, name, columns):
+    "create an index over the given columns unless it already exists"
+    table = model._meta.db_table
+    exists = index_exists(table, name)
+    if exists:
+        return False
+    sql = "CREATE INDEX %s ON %s (%s)" % (
+        quote_name(name),
+        quote_name(table),
+        ", ".join([quote_name(column) for column in columns])
+    )
+    if exists is None:
+        # we can't tell, so see whether creating it works
+        return execute_if_possible(sql)
+    connection.cursor().execute(sql)
+    return True
+
+def drop_index(model, name):
+    "drop an index if it exists"
+    table = model._meta.db_table
+    exists = index_exists(table, name)
+    if exists is False:
+        return False
+    if settings.DATABASE_ENGINE == 'mysql':
+        sql = "DROP INDEX %s ON %s" % (quote_name(name), quote_name(table))
+    else:
+        sql = "DROP INDEX %s" % quote_name(name)
+    if exists is None:
+        return execute_if_possible(sql)
+    connection.cursor().execute(sql)
+    return True
+
+def applied_migrations():
+    "the names of the migrations which have already been run"
+    return set(Migration.objects.values_list('name', flat=True))
+
+def pending_migrations():
+    "the migrations which haven't been run yet, in order"
+    applied = applied_migrations()
+    return [(name, func) for name, func in MIGRATIONS if name not in applied]
+
+def migrate(verbosity=1):
+    "run any pending migrations, each in its own transaction"
+    for name, func in pending_migrations():
+        if verbosity:
+            print "Applying runner migration %s" % name
+        apply_migration(name, func)
+
+def apply_migration(name, func):
+    func()
+    Migration.objects.create(name=name)
+apply_migration = transaction.commit_on_success(apply_migration)
+
+# The migrations themselves. These should only use the columns they know
+# about, as later migrations may not have been run yet when they are, which
+# means sticking to values() and update() rather than whole model instances.
+
+@migration('0001_command_last_run')
+def command_last_run():
+    "store the latest run details on each command"
+    added = [add_column(Command, name) for name in
+        ('last_run_id', 'last_run_status', 'last_run_date')]
+    if not any(added):
+        return
+    for command_id in Command.objects.values_list('id', flat=True):
+        latest = Run.objects.filter(command=command_id).order_by(
+            '-updated_date').values('id', 'status', 'updated_date')[:1]
+        for run in latest:
+            Command.objects.filter(id=command_id).update(
+                last_run_id = run['id'],
+                last_run_status = run['status'],
+                last_run_date = run['updated_date'],
+            )
+
+@migration('0002_run_indexes')
+def run_indexes():
+    """
+    Index runs the way they are listed, newest first optionally limited to
+    a command or a status. The id is included as the tie breaker used by
+    the pagination. Descending scans of these work fine so we don't need
+    descending indexes.
+    """
+    create_index(Run, 'runner_run_updated', ['updated_date', 'id'])
+    create_index(Run, 'runner_run_command_updated',
+        ['command_id', 'updated_date', 'id'])
+    create_index(Run, 'runner_run_status_updated',
+        ['status', 'updated_date', 'id'])
+    # superseded by the first of the above
+    drop_index(Run, 'runner_run_updated_date')
+
+@migration('0003_output_chunks')
+def output_chunks():
+    """
+    Move the output of existing runs out of the single output column and
+    into chunks. The old column is emptied as each run is moved but left in
+    place, as sqlite can't drop columns.
+    """
+    add_column(Run, 'output_length')
+    if 'output' not in table_columns(Run._meta.db_table):
+        return
+    run_table = quote_name(Run._meta.db_table)
+    chunk_table = quote_name(OutputChunk._meta.db_table)
+    # the chunk table is created by syncdb, so it may already have the
+    # columns added by later migrations which need filling in too
+    compressed = 'encoding' in table_columns(OutputChunk._meta.db_table)
+    size = 64 * 1024
+    cursor = connection.cursor()
+    run_id = 0
+    while True:
+        # one run at a time, so we only ever hold one output in memory
+        cursor.execute("SELECT id, output FROM %s WHERE id > %%s AND "
+            "output IS NOT NULL ORDER BY id LIMIT 1" % run_table, [run_id])
+        row = cursor.fetchone()
+        if row is None:
+            break
+        run_id, output = row
+        for offset in range(0, len(output), size):
+            if compressed:
+                encoding, data, original_size = compress(
+                    output[offset:offset + size])
+                cursor.execute("INSERT INTO %s (run_id, %s, data, encoding, "
+                    "original_size) VALUES (%%s, %%s, %%s, %%s, %%s)" % (
+                    chunk_table, quote_name('offset')),
+                    [run_id, offset, data, encoding, original_size])
+            else:
+                cursor.execute("INSERT INTO %s (run_id, %s, data) "
+                    "VALUES (%%s, %%s, %%s)" % (chunk_table,
+                    quote_name('offset')),
+                    [run_id, offset, output[offset:offset + size]])
+        cursor.execute("UPDATE %s SET output = NULL, output_length = %%s "
+            "WHERE id = %%s" % run_table, [len(output), run_id])
+
+@migration('0004_chunk_compression')
+def chunk_compression():
+    """
+    Record how each chunk is compressed. Existing chunks are left as they
+    are, the compress_output command compresses them.
+    """
+    add_column(OutputChunk, 'encoding')
+    add_column(OutputChunk, 'original_size')
+
+@migration('0005_command_retention')
+def command_retention():
+    "add the retention policy to commands, which keeps every run by default"
+    for name in ('keep_runs', 'keep_days', 'keep_failures'):
+        add_column(Command, name)
+
+@migration('0006_command_target')
+def command_target():
+    "add the target of commands, which any listener can run by default"
+    add_column(Command, 'target')
+
+@migration('0007_command_concurrency')
+def command_concurrency():
+    "add the concurrency policy to commands, which lets runs overlap"
+    for name in ('concurrency', 'max_concurrent'):
+        add_column(Command, name)
+
+@migration('0008_search_index')
+def search_index():
+    """
+    Create the search index. Runs are added as they finish, the output of
+    existing runs can be added with the rebuild_search_index command. The
+    table for the like backend is always created so the backend can be
+    changed without changing the schema.
+    """
+    search.LikeBackend().install()
+    search.get_backend().install()
+
+@migration('0009_run_timing')
+def run_timing():
+    """
+    record when runs start and finish. The statistics table is created by
+    syncdb, and can be filled in from existing runs with rebuild_stats
+    """
+    for name in ('started_at', 'finished_at', 'exit_code', 'duration'):
+        add_column(Run, name)
+
+@migration('0010_run_heartbeat')
+def run_heartbeat():
+    """
+    record when we last heard about each run. Runs already in progress are
+    counted as heard from when they were last updated, as before, so lost
+    ones can still be reaped
+    """
+    if add_column(Run, 'heartbeat'):
+        Run.objects.filter(status="in_progress").update(
+            heartbeat=F('updated_date'))
@@ -1,22 +1,165 @@
 "Models for Asteroid"
 
-import commands
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
+
+from django.utils.functional import wraps
 
 from django.utils import simplejson
 from django.utils.safestring import mark_safe
 from django.conf import settings
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.backends import util
+from django.db.models import Q, F
+from django.db.models.signals import post_save, post_delete
+
+from runner.executor import execute
+from runner.background import get_executor, Busy
+from runner.compression import compress, decompress, choose_encoding, \
+    ENCODINGS, COMPACT_SIZE
+from runner.publisher import get_publisher, DEFAULT_TARGET, \
+    CONNECTION_ERRORS
+from runner import caching, metrics, search, stats
 
-from amqplib import client_0_8 as amqp
+def atomic(func):
+    """
+    Decorator which runs func in a transaction of its own, unless we're
+    already in a transaction in which case it becomes part of that one.
+    """
+    def wrapper(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        return transaction.commit_on_success(func)(*args, **kwargs)
+    return wraps(func)(wrapper)
+
+def typecast_timestamp(value):
+    """
+    Django reads the microseconds of sqlite dates through a float, which
+    comes back a microsecond short for about one date in a hundred. Runs
+    are paged and pruned by comparing their updated dates exactly, so we
+    read the microseconds as they were written.
+    """
+    date = util.typecast_timestamp(value)
+    if isinstance(date, datetime) and '.' in value:
+        microseconds = value.split('.', 1)[1][:6]
+        date = date.replace(microsecond=int(microseconds.ljust(6, '0')))
+    return date
+
+if settings.DATABASE_ENGINE == 'sqlite3':
+    from django.db.backends.sqlite3.base import Database
+    for name in ("datetime", "timestamp", "TIMESTAMP"):
+        Database.register_converter(name, typecast_timestamp)
+
+# how many chunks to load at a time when compacting output
+COMPACT_BATCH = 20
+
+RUNS_STARTED = metrics.counter("asteroid_runs_started_total",
+    "Runs started, by how they were started", ["how"])
+RUNS_REJECTED = metrics.counter("asteroid_runs_rejected_total",
+    "Runs rejected by the concurrency policy of their command")
+RUNS_FINISHED = metrics.counter("asteroid_runs_finished_total",
+    "Runs finished, by status", ["status"])
+RUN_SECONDS = metrics.histogram("asteroid_run_seconds",
+    "How long runs took from starting to finishing",
+    buckets=metrics.RUN_BUCKETS)
 
 # set of available statuses for runs
 STATUSES=(
+    ('queued','Queued'),
     ('in_progress','In progress'),
     ('succeeded','Succeeded'),
     ('failed','Failed'),
 )
 
+# runs with these statuses haven't finished yet
+UNFINISHED = ('queued', 'in_progress')
+
+# what to do when a command is run while too many of its runs are already
+# in progress, see Command.admit_run
+CONCURRENCY_POLICIES = (
+    ('allow', 'Run it anyway'),
+    ('queue', 'Queue it until a run finishes'),
+    ('coalesce', 'Show the run already in progress'),
+    ('reject', 'Refuse to run it'),
+)
+
+class RunRejected(Exception):
+    "Raised when a command won't run because of its concurrency policy"
+    pass
+
+# the fields needed to list runs
+SUMMARY_FIELDS = (
+    'status',
+    'created_date',
+    'updated_date',
+    'command__title',
+    'command__slug',
+)
+
+class RunManager(models.Manager):
+    "Adds the narrow querysets used when listing runs"
+
+    def summaries(self):
+        """
+        Runs with only the fields needed for listing them loaded, along with
+        the title and slug of their command. The command itself and its
+        description can be long and aren't needed for lists.
+        """
+        return self.get_query_set().select_related('command').only(
+            *SUMMARY_FIELDS)
+
+    def stale(self, hours, now=None):
+        """
+        Runs in progress which we haven't heard from for longer than the
+        given number of hours, which we assume have been lost along with
+        whatever was running them. Runs which never got going, because no
+        listener took them off the queue, count from when they were created.
+        """
+        cutoff = (now or datetime.today()) - timedelta(hours=hours)
+        return self.get_query_set().filter(status="in_progress").filter(
+            Q(heartbeat__lt=cutoff) |
+            Q(heartbeat__isnull=True, created_date__lt=cutoff))
+
+    def waiting_in_process(self, runs):
+        """
+        Mark runs which are waiting for a background thread as heard from.
+        Unlike runs on the queue they're lost if this process stops, so
+        need to be reaped if they don't get going.
+        """
+        now = datetime.today()
+        for run in runs:
+            run.heartbeat = now
+        self.get_query_set().filter(id__in=[run.id for run in runs]).update(
+            heartbeat=now)
+
+    def create_many(self, commands):
+        """
+        Create an in progress run of each of the commands, which can include
+        the same command more than once, all in one transaction. Rather
+        than recording each run against its command as it's created, only
+        the last run of each command is recorded.
+        """
+        now = datetime.today()
+        runs = []
+        for command in commands:
+            run = Run(
+                command = command,
+                command_run = command.command_to_run,
+                created_date = now,
+                updated_date = now,
+                started_at = now,
+            )
+            # skip Run.save, which records the run against the command
+            models.Model.save(run)
+            runs.append(run)
+        latest = {}
+        for run in runs:
+            latest[run.command_id] = run
+        for run in latest.values():
+            run.command.record_run(run)
+        return runs
+    create_many = atomic(create_many)
+
 class Run(models.Model):
     """
     A run represents a single execution of a command. It stores both the 
@@ -28,23 +171,255 @@ class Run(models.Model):
     updated_date = models.DateTimeField(default=datetime.today)
     command = models.ForeignKey("Command", related_name='command', help_text="The command which resulted in this run.")
     command_run = models.TextField(help_text="The actual command run. Stored in case the command is later changed.")
-    output = models.TextField(null=True, blank=True, help_text="The output resulting from this run.")
+    output_length = models.IntegerField(default=0, editable=False, help_text="How much output the run has produced so far, in characters. The output itself is stored in chunks.")
     status = models.CharField("Status", max_length=10, choices=STATUSES, default="in_progress", help_text="Is the command currently running, or did is succeed or fail.")
+    # when the command started and finished running, and how it went
+    started_at = models.DateTimeField(null=True, blank=True, editable=False)
+    finished_at = models.DateTimeField(null=True, blank=True, editable=False)
+    exit_code = models.IntegerField(null=True, blank=True, editable=False)
+    duration = models.FloatField(null=True, blank=True, editable=False, help_text="How long the command took to run, in seconds.")
+    # when we last heard from whatever is running the command, see stale
+    heartbeat = models.DateTimeField(null=True, blank=True, editable=False)
+
+    objects = RunManager()
 
     class Meta:
         "meta information about Runs"
-        # Last in first out makes more sense
+        # Last in first out makes more sense. The indexes which support
+        # this are created in runner.migrations
         ordering = ['-updated_date']
 
     def get_absolute_url(self):
         "runs exist in the url structure underneath their command"
         return "/commands/%s/%s" % (self.command.slug, self.id)
 
+    def append_output(self, output):
+        """
+        Add to the end of the output of this run. Each piece is stored as a 
+        new chunk so the output we already have is never touched.
+        """
+        if not output:
+            return
+        OutputChunk.objects.create_chunk(self, self.output_length, output)
+        self.output_length += len(output)
+        # output shows the command is still going
+        self.heartbeat = datetime.today()
+        Run.objects.filter(id=self.id).update(
+            output_length = self.output_length,
+            heartbeat = self.heartbeat,
+        )
+    append_output = atomic(append_output)
+
+    def mark_started(self):
+        """
+        Record that the command has actually started running, which for
+        runs sent to a listener can be a while after they were created
+        """
+        self.started_at = self.heartbeat = datetime.today()
+        Run.objects.filter(id=self.id).update(
+            started_at = self.started_at,
+            heartbeat = self.heartbeat,
+        )
+
+    def set_output(self, output):
+        """
+        Replace all of the output of this run. It's stored in chunks the
+        size compacting makes, so reading part of it never loads the lot.
+        """
+        output = output or u""
+        self.chunks.all().delete()
+        for offset in range(0, len(output), COMPACT_SIZE):
+            OutputChunk.objects.create_chunk(self, offset,
+                output[offset:offset + COMPACT_SIZE])
+        self.output_length = len(output)
+        Run.objects.filter(id=self.id).update(output_length=self.output_length)
+    set_output = atomic(set_output)
+
+    def read_output(self, start=0, end=None):
+        """
+        Read part of the output, from the start offset up to but not 
+        including the end offset. Offsets count characters from the start
+        of the output. Only the chunks covering that part are loaded.
+        """
+        if end is None or end > self.output_length:
+            end = self.output_length
+        start = max(0, start)
+        if start >= end:
+            return u""
+        # find the chunk the start falls in
+        first = list(self.chunks.filter(offset__lte=start).order_by(
+            '-offset').values_list('offset', flat=True)[:1])
+        first = first and first[0] or 0
+        chunks = self.chunks.filter(offset__gte=first, offset__lt=end)
+        output = u"".join([decompress(encoding, data) for encoding, data
+            in chunks.values_list('encoding', 'data')])
+        return output[start - first:end - first]
+
+    def iter_output(self):
+        """
+        The whole of the output a chunk at a time, so it can be copied
+        somewhere without ever holding all of it
+        """
+        position = -1
+        while True:
+            chunks = list(self.chunks.filter(offset__gt=position).values_list(
+                'offset', 'encoding', 'data')[:COMPACT_BATCH])
+            for offset, encoding, data in chunks:
+                position = offset
+                yield decompress(encoding, data)
+            if len(chunks) < COMPACT_BATCH:
+                break
+
+    def tail_output(self, size):
+        "return the offset and text of the last size characters of output"
+        start = max(0, self.output_length - size)
+        return start, self.read_output(start)
+
+    def compact_output(self):
+        """
+        Rewrite the output of a finished run as fewer, bigger chunks, which
+        compress far better than the small pieces output arrives in. Only a
+        chunk's worth of output is held in memory at a time. Returns the
+        number of chunks written.
+        """
+        written = 0
+        group = []
+        size = 0
+        position = -1
+        while True:
+            chunks = list(self.chunks.filter(offset__gt=position).values_list(
+                'id', 'offset', 'encoding', 'data')[:COMPACT_BATCH])
+            for chunk_id, offset, encoding, data in chunks:
+                position = offset
+                text = decompress(encoding, data)
+                group.append((chunk_id, offset, encoding, text))
+                size += len(text)
+                if size >= COMPACT_SIZE:
+                    written += self._rewrite_chunks(group)
+                    group = []
+                    size = 0
+            if len(chunks) < COMPACT_BATCH:
+                break
+        if group:
+            written += self._rewrite_chunks(group)
+        return written
+    compact_output = atomic(compact_output)
+
+    def _rewrite_chunks(self, group):
+        "replace a group of chunks with one starting in the same place"
+        if len(group) == 1 and group[0][2] == choose_encoding(
+                len(group[0][3].encode('utf-8'))):
+            # already as good as it's going to get
+            return 0
+        OutputChunk.objects.filter(
+            id__in=[chunk_id for chunk_id, offset, encoding, text in group]
+        ).delete()
+        OutputChunk.objects.create_chunk(self, group[0][1],
+            u"".join([text for chunk_id, offset, encoding, text in group]))
+        return 1
+
+    def execute(self):
+        """
+        Run the command, storing the output as it arrives and finishing the
+        run with its exit code. If we can't run it at all the run fails.
+        """
+        self.mark_started()
+        try:
+            code = execute(self.command_run, self.append_output)
+        except Exception, e:
+            self.append_output(u"Unable to run command: %s\n" % e)
+            code = -1
+        self.finish(code)
+
+    def queue_message(self):
+        """
+        The JSON document we put on the queue for a listener to run this,
+        with the urls to send the results back to
+        """
+        return simplejson.dumps({
+            'webhook': "%s%s/hook/" % (settings.DOMAIN,
+                self.get_absolute_url()),
+            # listeners can send results for many runs at once here
+            'batch_webhook': "%s/hooks/" % settings.DOMAIN,
+            'run': self.id,
+            'slug': self.command.slug,
+            'command': self.command_run,
+            # so listeners can tell how long it waited on the queue
+            'queued_at': time.time(),
+        })
+
+    def run_in_background(self):
+        """
+        Leave one of the background threads to execute the run. If too many
+        runs are already waiting the run fails straight away. The thread
+        uses its own connection so the run must have been committed.
+        """
+        try:
+            get_executor().submit(Run.execute, self)
+        except Busy:
+            self.append_output(u"Too many commands are waiting to run, "
+                "try again later.\n")
+            self.finish(-1)
+
+    def finish(self, code):
+        """
+        Record how the command went from its exit code, and how long it
+        took. Only these are saved so any output appended along the way is
+        left alone.
+        """
+        # 0 is good, anything else is an error state
+        if code == 0:
+            self.status = "succeeded"
+        else:
+            self.status = "failed"
+        self.exit_code = int(code)
+        self.finished_at = self.updated_date = datetime.today()
+        # runs from before we recorded when they started began when they
+        # were created
+        self.duration = seconds(self.finished_at -
+            (self.started_at or self.created_date))
+        Run.objects.filter(id=self.id).update(
+            status = self.status,
+            updated_date = self.updated_date,
+            finished_at = self.finished_at,
+            exit_code = self.exit_code,
+            duration = self.duration,
+        )
+        RUNS_FINISHED.inc(status=self.status)
+        RUN_SECONDS.observe(self.duration)
+        # the stats go first, as recording the run moves the cached pages
+        # on, and a page cached in between would keep the old stats
+        CommandStat.objects.record(self)
+        self.command.record_run(self)
+        # the output won't change now, so can be searched
+        search.index_run(self)
+        self.command.start_queued()
+
+    def abandon(self, reason):
+        "fail a run which will never finish, saying why in its output"
+        self.append_output(u"\n%s\n" % reason)
+        self.finish(-1)
+
+    def is_finished(self):
+        "whether the run has succeeded or failed"
+        return self.status not in UNFINISHED
+
+    def start(self):
+        """
+        Start the run whichever way the settings say to. With the queue it's
+        run by a listener, otherwise on a background thread or, failing
+        that, right here.
+        """
+        start_runs([self])
+
     def save(self, *args, **kwargs):
         "we want to update the updated date if we save the command"
-        self.updated_date = str(datetime.today())
+        self.updated_date = datetime.today()
         super(Run, self).save()
-        
+        # the command keeps a copy of its latest run so listing commands
+        # doesn't need a query per command
+        self.command.record_run(self)
+
     def __unicode__(self):
         "friendly output"
         if self.status == "in_progress":
@@ -53,6 +428,19 @@ class Run(models.Model):
             status = self.status
         return "%s %s on %s" % (self.command, status, self.created_date.strftime("%a %B %Y at %H:%M"))
 
+class CommandManager(models.Manager):
+    "Adds a list of the targets commands are sent to"
+
+    def targets(self):
+        """
+        the targets of all the commands along with the default target,
+        which listeners use unless they're told otherwise, each listed once
+        """
+        targets = self.get_query_set().order_by().values_list('target',
+            flat=True).distinct()
+        return sorted(set([DEFAULT_TARGET] +
+            [target or DEFAULT_TARGET for target in targets]))
+
 class Command(models.Model):
     "Commands represent shell scripts which can be run from the web front end"
     title = models.CharField(max_length=200, help_text="A descritive name for this command.")
@@ -61,6 +449,21 @@ class Command(models.Model):
     updated_date = models.DateTimeField(default=datetime.today)
     description = models.TextField(null=True, blank=True, help_text="Include a more detailed description of this command.")
     command_to_run = models.TextField(help_text="A valid shell command. Be carefull as this is going to be executed as the web server user when the command is run.")
+    # denormalised details of the latest run, maintained by Run.save
+    last_run_id = models.IntegerField(null=True, blank=True, editable=False)
+    last_run_status = models.CharField(max_length=10, choices=STATUSES, null=True, blank=True, editable=False)
+    last_run_date = models.DateTimeField(null=True, blank=True, editable=False)
+    # how long to keep runs for, see runner.retention
+    keep_runs = models.PositiveIntegerField(null=True, blank=True, help_text="Keep this many of the latest runs. Leave this and keep days empty to keep every run.")
+    keep_days = models.PositiveIntegerField(null=True, blank=True, help_text="Keep runs from this many days.")
+    keep_failures = models.BooleanField(default=False, help_text="Keep every failed run, however old.")
+    # which listeners run the command, see runner.publisher
+    target = models.SlugField(max_length=100, blank=True, default="", help_text="The group of listeners which should run this command, for instance linux or deploy. Leave empty to let any listener run it.")
+    # what happens to runs which would overlap, see admit_run
+    concurrency = models.CharField(max_length=10, choices=CONCURRENCY_POLICIES, default="allow", help_text="What to do when the command is run while earlier runs are still in progress.")
+    max_concurrent = models.PositiveIntegerField(null=True, blank=True, help_text="How many runs can be in progress at once. Leave empty for one at a time. This has no effect if runs are allowed to overlap.")
+
+    objects = CommandManager()
     
     def __unicode__(self):
         "friendly output"
@@ -68,79 +471,205 @@ class Command(models.Model):
 
     def status(self):
         "the status of the command is the status of the last run"
-        # wrapped in a try/except to catch the case before the command is run
+        # the command hasn't been run yet if we don't have a last run
+        return self.last_run_status or "not run yet"
+
+    def record_run(self, run):
+        """
+        Store the details of the given run as the latest run. We use an
+        update rather than save so the updated date of the command itself
+        is left alone. The cached pages are moved on once it's stored, so
+        none are cached with the old details.
+        """
+        # lists of commands show their status, so only need refreshing
+        # if that's changed
+        changed = self.last_run_status != run.status
+        self.last_run_id = run.id
+        self.last_run_status = run.status
+        self.last_run_date = run.updated_date
+        Command.objects.filter(id=self.id).update(
+            last_run_id = self.last_run_id,
+            last_run_status = self.last_run_status,
+            last_run_date = self.last_run_date,
+        )
+        if changed:
+            caching.bump(caching.RUNS, caching.COMMANDS)
+        else:
+            caching.bump(caching.RUNS)
+
+    def refresh_last_run(self):
+        "recalculate the latest run details from the runs themselves"
         try:
             run = Run.objects.filter(command=self)[:1][0]
-            return run.status
         except IndexError:
-            return "not run yet"
+            # no runs left so we go back to not having been run
+            caching.bump(caching.RUNS, caching.COMMANDS)
+            self.last_run_id = self.last_run_status = self.last_run_date = None
+            Command.objects.filter(id=self.id).update(
+                last_run_id = None,
+                last_run_status = None,
+                last_run_date = None,
+            )
+        else:
+            self.record_run(run)
 
-    def run(self):
+    def expired_runs(self, now=None):
         """
-        We can use the application without the message queue, which isn't
-        as good for long running commands and means commands will only be
-        executed on the same machine as the web application is running
+        The finished runs which are no longer covered by the retention
+        policy. A run is kept if it's one of the latest keep_runs runs or
+        from the last keep_days days, so with neither set nothing expires.
         """
-        # create an in progress run
-        run = Run(
-            command = self,
-            command_run = self.command_to_run,
-        )
-        run.save()
-        
-        # execute the command and store the output and error code
-        code, output = commands.getstatusoutput(self.command_to_run)
+        if self.keep_runs is None and self.keep_days is None:
+            return Run.objects.none()
+        runs = Run.objects.filter(command=self).exclude(status__in=UNFINISHED)
+        if self.keep_runs is not None:
+            # find the oldest run we keep, everything before it can go
+            boundary = list(Run.objects.filter(command=self).order_by(
+                '-updated_date', '-id').values_list('updated_date', 'id')[
+                self.keep_runs:self.keep_runs + 1])
+            if not boundary:
+                return Run.objects.none()
+            date, pk = boundary[0]
+            runs = runs.filter(Q(updated_date__lt=date) |
+                Q(updated_date=date, id__lte=pk))
+        if self.keep_days is not None:
+            now = now or datetime.today()
+            runs = runs.filter(
+                updated_date__lt=now - timedelta(days=self.keep_days))
+        if self.keep_failures:
+            runs = runs.exclude(status="failed")
+        return runs
 
-        # 0 is good, anything else is an error state
-        if code == 0:
-            run.status = "succeeded"
-        else:
-            run.status = "failed"
-        run.output = output
-        run.save()
-        
-        # return the saved run object
-        return run
-        
-    def queue_run(self):
+    def routing_key(self):
+        "the routing key runs are published with, and so who runs them"
+        return self.target or DEFAULT_TARGET
+
+    def concurrency_limit(self):
+        "how many runs can be in progress at once, or None for no limit"
+        if self.concurrency == "allow":
+            return None
+        return self.max_concurrent or 1
+
+    def lock(self):
         """
-        Create a run object, setting it's status to in progress then
-        send a JSON document containing the command_to_run details and the
-        run identifier to the queue
+        Lock the row of the command until the end of the transaction, so
+        only one process at a time can decide what to do with its runs.
+        Django has no select for update, but an update takes the same lock.
         """
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s SET id = id WHERE id = %%s" %
+            connection.ops.quote_name(Command._meta.db_table), [self.id])
 
-        # again we create an in progress run
+    def admit_run(self):
+        """
+        Decide what to do with a new run of the command under its
+        concurrency policy. Returns the run and whether it needs starting.
+        If too many runs are in progress the new run is queued, or the
+        latest run in progress is returned instead, or the run is rejected
+        with RunRejected. The command is locked while we look so two
+        requests can't both take the last free place.
+        """
+        limit = self.concurrency_limit()
+        if limit is None:
+            return self.create_run(), True
+        self.lock()
+        unfinished = Run.objects.filter(command=self, status__in=UNFINISHED)
+        counts = dict(unfinished.order_by().values_list('status').annotate(
+            models.Count('id')))
+        # runs can't jump the queue
+        if counts.get('in_progress', 0) < limit and not counts.get('queued'):
+            return self.create_run(), True
+        if self.concurrency == "queue":
+            return self.create_run(status="queued"), False
+        if self.concurrency == "coalesce":
+            running = list(unfinished.filter(status="in_progress").order_by(
+                '-id')[:1])
+            if running:
+                return running[0], False
+            return self.create_run(), True
+        RUNS_REJECTED.inc()
+        raise RunRejected("%s already has %s runs in progress" % (self,
+            counts.get('in_progress', 0)))
+    admit_run = atomic(admit_run)
+
+    def promote_queued(self):
+        """
+        Move as many of the queued runs, oldest first, to in progress as
+        there's now room for, returning them. They still need starting.
+        If the command no longer limits its runs they all go.
+        """
+        self.lock()
+        queued = Run.objects.filter(command=self, status="queued").order_by(
+            'id')
+        limit = self.concurrency_limit()
+        if limit is not None:
+            running = Run.objects.filter(command=self, status="in_progress")
+            room = limit - running.count()
+            if room <= 0:
+                return []
+            queued = queued[:room]
+        runs = list(queued)
+        for run in runs:
+            run.status = "in_progress"
+            run.started_at = run.updated_date = datetime.today()
+            Run.objects.filter(id=run.id).update(
+                status = run.status,
+                updated_date = run.updated_date,
+                started_at = run.started_at,
+            )
+        if runs:
+            self.record_run(runs[-1])
+        return runs
+    promote_queued = atomic(promote_queued)
+
+    def start_queued(self):
+        """
+        start any queued runs there's now room for. Runs queued before the
+        policy was changed from queue are started too, or they'd never be
+        """
+        if self.concurrency != "queue" and not Run.objects.filter(
+                command=self, status="queued").count():
+            return []
+        runs = self.promote_queued()
+        start_runs(runs)
+        return runs
+
+    def trigger(self):
+        """
+        Run the command whichever way the settings say to, following its
+        concurrency policy, and return the run. Runs are only started if
+        there's room for them.
+        """
+        run, start = self.admit_run()
+        if start:
+            run.start()
+        return run
+
+    def create_run(self, status="in_progress"):
+        "create a run of this command, in progress unless we say otherwise"
         run = Run(
             command = self,
             command_run = self.command_to_run,
+            status = status,
         )
+        if status == "in_progress":
+            run.started_at = datetime.today()
         run.save()
+        return run
+
+    def run(self):
+        """
+        We can use the application without the message queue, which isn't
+        as good for long running commands and means commands will only be
+        executed on the same machine as the web application is running
+        """
+        # create an in progress run
+        run = self.create_run()
         
-        # pre-json data structure
-        obj = {
-            'webhook': "%s%s%s/hook/" % (settings.DOMAIN, self.get_absolute_url(), run.id),
-            'command': self.command_to_run,
-        }
+        # execute the command, storing the output as it arrives
+        run.execute()
         
-        json = simplejson.dumps(obj)
-        # put json on message queue
-        conn = amqp.Connection(settings.QUEUE_ADDRESS)
-        # and get a channel
-        chan = conn.channel()
-
-        # define your exchange
-        # if they already exist then we check they are of the correct type
-        chan.exchange_declare(exchange='asteroid', type="direct", 
-        durable=False, auto_delete=True)
-
-        # and publish a message
-        chan.basic_publish(amqp.Message(json), exchange="asteroid", routing_key="all")
-
-        # close everything afterwards
-        chan.close()
-        conn.close()
-
-        # return the run object
+        # return the saved run object
         return run
 
     def run_link(self):
@@ -156,4 +685,269 @@ class Command(models.Model):
     def save(self, *args, **kwargs):
         "we want to update the updated date if we save the command"
         self.updated_date = str(datetime.today())
+        existing = self.id is not None
         super(Command, self).save()
+        # a change to the concurrency policy may make room for queued runs
+        if existing:
+            self.start_queued()
+
+def start_runs(runs):
+    """
+    Start in progress runs the way the settings say to. With the queue they
+    are published in one go for each target, and any we can't publish fail
+    straight away rather than waiting for a listener which will never come.
+    """
+    if not runs:
+        return
+    if settings.QUEUE_COMMANDS:
+        RUNS_STARTED.inc(len(runs), how="queue")
+        targets = {}
+        for run in runs:
+            targets.setdefault(run.command.routing_key(), []).append(run)
+        unsent = []
+        for target in sorted(targets):
+            if unsent:
+                # the queue was unreachable a moment ago, so don't wait on it
+                unsent.extend(targets[target])
+                continue
+            try:
+                get_publisher().publish_many([run.queue_message()
+                    for run in targets[target]], routing_key=target)
+            except CONNECTION_ERRORS, e:
+                unsent.extend(targets[target][getattr(e, 'sent', 0):])
+        for run in unsent:
+            run.abandon(u"Unable to send the command to the message queue, "
+                "try again later.")
+    elif settings.BACKGROUND_COMMANDS:
+        Run.objects.waiting_in_process(runs)
+        # the threads use their own connections, so need to be able to see
+        # the runs even if we're part way through a transaction
+        if transaction.is_managed():
+            transaction.commit()
+        RUNS_STARTED.inc(len(runs), how="background")
+        for run in runs:
+            run.run_in_background()
+    else:
+        RUNS_STARTED.inc(len(runs), how="request")
+        for run in runs:
+            run.execute()
+
+def trigger_many(commands):
+    """
+    Run each of the commands, which can include the same command more than
+    once, the way the settings say to. Returns the runs in the same order,
+    with None for any which were rejected. Runs of commands which allow
+    overlapping runs are created together, the others are admitted one at
+    a time under the policy of their command.
+    """
+    created = iter(Run.objects.create_many([command for command in commands
+        if command.concurrency_limit() is None]))
+    runs = []
+    starting = []
+    for command in commands:
+        if command.concurrency_limit() is None:
+            run, start = created.next(), True
+        else:
+            try:
+                run, start = command.admit_run()
+            except RunRejected:
+                run, start = None, False
+        runs.append(run)
+        if start:
+            starting.append(run)
+    start_runs(starting)
+    return runs
+
+class OutputChunkManager(models.Manager):
+    "Custom manager which compresses output as it's stored"
+
+    def create_chunk(self, run, offset, output):
+        "store a piece of output for a run, compressed if worthwhile"
+        encoding, data, size = compress(output)
+        return self.create(
+            run = run,
+            offset = offset,
+            data = data,
+            encoding = encoding,
+            original_size = size,
+        )
+
+class OutputChunk(models.Model):
+    """
+    A piece of the output of a run. Output is stored as a series of chunks
+    so adding to it never means rewriting what's already there, and any
+    part of it can be read without loading the rest. Larger chunks are
+    stored compressed, see runner.compression.
+    """
+    run = models.ForeignKey(Run, related_name='chunks')
+    offset = models.IntegerField(help_text="Where in the output of the run this chunk starts, in characters.")
+    data = models.TextField()
+    encoding = models.CharField(max_length=10, choices=ENCODINGS, default="", blank=True, help_text="How the data is compressed, if at all.")
+    original_size = models.IntegerField(default=0, help_text="The size of the output in this chunk before compression, in bytes.")
+
+    objects = OutputChunkManager()
+
+    class Meta:
+        "meta information about output chunks"
+        ordering = ['offset']
+        # this also gives us the index for reading ranges of output
+        unique_together = (('run', 'offset'),)
+
+    def text(self):
+        "the output stored in this chunk"
+        return decompress(self.encoding, self.data)
+
+    def __unicode__(self):
+        "friendly output"
+        return "%s from %s" % (self.run, self.offset)
+
+def seconds(delta):
+    "a timedelta in seconds"
+    return delta.days * 86400 + delta.seconds + delta.microseconds / 1e6
+
+class CommandStatManager(models.Manager):
+    "Keeps the daily statistics up to date as runs finish"
+
+    def record(self, run):
+        """
+        Count a finished run in the statistics for its command on the day
+        it finished. Updating the counts first locks the row, so nobody else
+        can change the durations while we add to them.
+        """
+        day = run.finished_at.date()
+        stat = self.filter(command=run.command_id, day=day)
+        failed = run.status == "failed" and 1 or 0
+        counts = {
+            'runs': F('runs') + 1,
+            'failures': F('failures') + failed,
+            'total_duration': F('total_duration') + run.duration,
+        }
+        if not stat.update(**counts):
+            savepoint = transaction.savepoint()
+            try:
+                self.create(command_id=run.command_id, day=day, runs=1,
+                    failures=failed, total_duration=run.duration,
+                    histogram=stats.add("", run.duration))
+                transaction.savepoint_commit(savepoint)
+                return
+            except IntegrityError:
+                # another run of the command finished at the same time
+                transaction.savepoint_rollback(savepoint)
+                stat.update(**counts)
+        histogram = stat.values_list('histogram', flat=True)[0]
+        stat.update(histogram=stats.add(histogram, run.duration))
+    record = atomic(record)
+
+    def recent(self, days, today=None):
+        "the statistics for the last few days, including today"
+        today = today or datetime.today().date()
+        return self.get_query_set().filter(
+            day__gt=today - timedelta(days=days))
+
+    def summaries(self, days, today=None):
+        """
+        The statistics for each command over the last few days combined,
+        keyed by command id. This is one query however many commands there
+        are.
+        """
+        grouped = {}
+        for stat in self.recent(days, today).order_by():
+            grouped.setdefault(stat.command_id, []).append(stat)
+        return dict([(command_id, combine(group))
+            for command_id, group in grouped.items()])
+
+class CommandStat(models.Model):
+    """
+    How the runs of a command which finished on a day went, kept up to date
+    as runs finish. Durations are kept as a histogram, see runner.stats.
+    Deleting runs doesn't change the statistics.
+    """
+    command = models.ForeignKey(Command, related_name='stats')
+    day = models.DateField()
+    runs = models.PositiveIntegerField(default=0)
+    failures = models.PositiveIntegerField(default=0)
+    total_duration = models.FloatField(default=0, help_text="How long all the runs took together, in seconds.")
+    histogram = models.TextField(blank=True, default="", help_text="How many runs took each length of time.")
+
+    objects = CommandStatManager()
+
+    class Meta:
+        "meta information about statistics"
+        unique_together = (('command', 'day'),)
+        ordering = ['-day']
+
+    def failure_rate(self):
+        "the fraction of runs which failed"
+        return self.runs and float(self.failures) / self.runs or 0.0
+
+    def failure_percent(self):
+        "the percentage of runs which failed"
+        return int(round(self.failure_rate() * 100))
+
+    def mean_duration(self):
+        "how long a run took on average, in seconds"
+        return self.runs and self.total_duration / self.runs or None
+
+    def p50(self):
+        "roughly how long the median run took, in seconds"
+        return stats.percentile(self.histogram, 0.5)
+
+    def p95(self):
+        "roughly how long all but the slowest twentieth of runs took"
+        return stats.percentile(self.histogram, 0.95)
+
+    def __unicode__(self):
+        "friendly output"
+        return "%s on %s" % (self.command_id, self.day)
+
+def combine(stats_list):
+    "add several days of statistics together, without saving them"
+    combined = CommandStat(
+        runs = sum([stat.runs for stat in stats_list]),
+        failures = sum([stat.failures for stat in stats_list]),
+        total_duration = sum([stat.total_duration for stat in stats_list]),
+        histogram = stats.merge([stat.histogram for stat in stats_list]),
+    )
+    if stats_list:
+        combined.command_id = stats_list[0].command_id
+    return combined
+
+class Migration(models.Model):
+    """
+    Records a schema migration which has been applied to the database. See
+    runner.migrations for the migrations themselves.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    applied_date = models.DateTimeField(default=datetime.today)
+
+    def __unicode__(self):
+        "friendly output"
+        return self.name
+
+def forget_deleted_run(sender, instance, **kwargs):
+    "if the latest run of a command is deleted fall back to the one before"
+    commands = Command.objects.filter(id=instance.command_id, 
+        last_run_id=instance.id)
+    for command in commands:
+        command.refresh_last_run()
+        # keep a command we already have in memory in step
+        cached = getattr(instance, '_command_cache', None)
+        if cached is not None:
+            cached.last_run_id = command.last_run_id
+            cached.last_run_status = command.last_run_status
+            cached.last_run_date = command.last_run_date
+
+post_delete.connect(forget_deleted_run, sender=Run)
+
+def command_changed(sender, instance, **kwargs):
+    "commands appear in lists of runs as well as lists of commands"
+    caching.bump(caching.COMMANDS, caching.RUNS)
+
+def run_deleted(sender, instance, **kwargs):
+    "a deleted run needs taking out of any lists of runs, and searches"
+    caching.bump(caching.RUNS)
+    search.remove_runs([instance.id])
+
+post_save.connect(command_changed, sender=Command)
+post_delete.connect(command_changed, sender=Command)
+post_delete.connect(run_deleted, sender=Run)
@@ -0,0 +1,110 @@
+"""
+Keyset pagination for runs. Rather than counting and offsetting into the
+whole table we remember the updated date and id of the run at the edge of
+the current page and ask for the runs either side of it, so every page
+costs the same as the first.
+"""
+
+import base64
+from datetime import datetime
+
+from django.db.models import Q
+
+# how many runs to show on each page
+PER_PAGE = 10
+
+class InvalidToken(ValueError):
+    "Raised when a page token can't be decoded"
+    pass
+
+def encode_token(run):
+    "make an opaque url safe token from the position of a run"
+    value = "%s.%06d|%d" % (
+        run.updated_date.strftime("%Y-%m-%d %H:%M:%S"),
+        run.updated_date.microsecond,
+        run.id
+    )
+    return base64.urlsafe_b64encode(value).rstrip("=")
+
+def decode_token(token):
+    "turn a token back into the updated date and id of a run"
+    try:
+        # the padding is stripped to keep the urls tidy
+        value = base64.urlsafe_b64decode(str(token) + "=" * (-len(token) % 4))
+        date, pk = value.split("|")
+        date, microsecond = date.split(".")
+        date = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        return date.replace(microsecond=int(microsecond)), int(pk)
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidToken(token)
+
+class Page(object):
+    "A page of runs along with the tokens for the pages either side of it"
+
+    def __init__(self, object_list, next_token=None, previous_token=None):
+        self.object_list = object_list
+        self.next_token = next_token
+        self.previous_token = previous_token
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.previous_token is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+def paginate(queryset, after=None, before=None, per_page=PER_PAGE):
+    """
+    Return the page of runs from the queryset, newest first, which comes
+    after or before the run identified by the given token. With no token
+    we return the first page.
+    """
+    queryset = queryset.order_by('-updated_date', '-id')
+
+    if before:
+        date, pk = decode_token(before)
+        # walk backwards from the token and flip the results round
+        runs = list(queryset.filter(
+            Q(updated_date__gt=date) | Q(updated_date=date, id__gt=pk)
+        ).reverse()[:per_page + 1])
+        if len(runs) <= per_page:
+            # we've run out of newer runs, so this is the first page
+            return paginate(queryset, per_page=per_page)
+        runs = runs[:per_page]
+        runs.reverse()
+        return Page(runs, encode_token(runs[-1]), encode_token(runs[0]))
+
+    if after:
+        date, pk = decode_token(after)
+        queryset = queryset.filter(
+            Q(updated_date__lt=date) | Q(updated_date=date, id__lt=pk)
+        )
+
+    # fetch an extra run so we know if there is another page
+    runs = list(queryset[:per_page + 1])
+    next_token = previous_token = None
+    if len(runs) > per_page:
+        runs = runs[:per_page]
+        next_token = encode_token(runs[-1])
+    if after and runs:
+        previous_token = encode_token(runs[0])
+    return Page(runs, next_token, previous_token)
+
+def page_from_request(request, queryset, per_page=PER_PAGE):
+    "paginate the queryset using the tokens from the query string"
+    after = request.GET.get('after')
+    before = request.GET.get('before')
+    try:
+        page = paginate(queryset, after, before, per_page)
+    except InvalidToken:
+        # a broken token gets the first page
+        return paginate(queryset, per_page=per_page)
+    if not page.object_list and (after or before):
+        # as does a token past the end of the runs
+        return paginate(queryset, per_page=per_page)
+    return page
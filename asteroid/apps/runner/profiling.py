@@ -0,0 +1,284 @@
+"""
+Profiles of requests, to find out which pages are slow and why. The
+profiling middleware records how long a sample of requests took, how many
+database queries they made and how long those took, how long rendering
+templates took and how big the responses were. The latest profiles are
+kept in memory in each process and shown to staff at /admin/profiling/,
+along with the queries a request made more than once, which usually means
+something is being looked up in a loop.
+
+PROFILING_SAMPLE_RATE is the fraction of requests to profile. It's 0 by
+default, in which case the middleware takes itself out of the way, and
+requests which aren't sampled cost no more than picking a random number.
+"""
+
+import random
+import threading
+import time
+from datetime import datetime
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponseRedirect
+from django.shortcuts import render_to_response
+from django.template import RequestContext, Template
+
+from runner import metrics
+
+# the most queries made more than once we keep for each profile, and how
+# much of each query we keep
+MAX_DUPLICATES = 20
+MAX_SQL_LENGTH = 1000
+
+# how many of the slowest requests to list
+SLOWEST_REQUESTS = 20
+
+class Profile(object):
+    "what happened during a request"
+
+    def __init__(self, path, method, view, status, seconds, queries,
+            query_seconds, template_seconds, size, duplicates, date=None):
+        self.path = path
+        self.method = method
+        self.view = view
+        self.status = status
+        self.seconds = seconds
+        self.queries = queries
+        self.query_seconds = query_seconds
+        self.template_seconds = template_seconds
+        self.size = size
+        # the sql, count and total time of each query made more than once
+        self.duplicates = duplicates
+        self.date = date or datetime.now()
+
+def find_duplicates(queries):
+    "the queries which were made more than once, the most repeated first"
+    found = {}
+    for sql, seconds in queries:
+        count, total = found.get(sql, (0, 0.0))
+        found[sql] = (count + 1, total + seconds)
+    duplicates = [(sql[:MAX_SQL_LENGTH], count, total)
+        for sql, (count, total) in found.items() if count > 1]
+    duplicates.sort(key=lambda duplicate: (-duplicate[1], -duplicate[2]))
+    return duplicates[:MAX_DUPLICATES]
+
+class ProfileBuffer(object):
+    "keeps the latest profiles, forgetting the oldest once it's full"
+
+    def __init__(self, size):
+        self.size = size
+        self.items = []
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def add(self, profile):
+        self.lock.acquire()
+        try:
+            if len(self.items) < self.size:
+                self.items.append(profile)
+            else:
+                self.items[self.next] = profile
+            self.next = (self.next + 1) % self.size
+        finally:
+            self.lock.release()
+
+    def profiles(self):
+        "the profiles we have, newest first"
+        self.lock.acquire()
+        try:
+            items = self.items[self.next:] + self.items[:self.next]
+        finally:
+            self.lock.release()
+        items.reverse()
+        return items
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.items = []
+            self.next = 0
+        finally:
+            self.lock.release()
+
+# there's one buffer per process, created when it's first needed
+_buffer = None
+_buffer_lock = threading.Lock()
+
+def get_buffer():
+    "return the profile buffer for this process"
+    global _buffer
+    _buffer_lock.acquire()
+    try:
+        if _buffer is None:
+            _buffer = ProfileBuffer(settings.PROFILING_BUFFER_SIZE)
+        return _buffer
+    finally:
+        _buffer_lock.release()
+
+# the time this thread has spent rendering templates
+_templates = threading.local()
+
+def template_time():
+    return getattr(_templates, 'seconds', 0.0)
+
+def time_templates():
+    """
+    Time the rendering of templates. Templates which extend or include
+    others render those as they go, so only the outermost is timed. Calling
+    this again does nothing.
+    """
+    if getattr(Template, 'timed', False):
+        return
+    render = Template.render
+    def timed_render(self, context):
+        depth = getattr(_templates, 'depth', 0)
+        if depth:
+            return render(self, context)
+        _templates.depth = 1
+        start = time.time()
+        try:
+            return render(self, context)
+        finally:
+            _templates.depth = 0
+            _templates.seconds = template_time() + time.time() - start
+    Template.render = timed_render
+    Template.timed = True
+
+def view_name(view):
+    return "%s.%s" % (view.__module__, getattr(view, '__name__',
+        view.__class__.__name__))
+
+def response_size(response):
+    """
+    how big a response is. Responses made from an iterator are left alone
+    as measuring them would use them up
+    """
+    if response.has_header('Content-Length'):
+        return int(response['Content-Length'])
+    if getattr(response, '_is_string', True):
+        return len(response.content)
+    return None
+
+class ProfilingMiddleware(object):
+    """
+    Profiles a sample of requests into the buffer. It should come first in
+    MIDDLEWARE_CLASSES so the time the other middleware takes is included.
+    """
+
+    def __init__(self, rate=None, buffer=None):
+        if rate is None:
+            rate = settings.PROFILING_SAMPLE_RATE
+        if not rate:
+            raise MiddlewareNotUsed()
+        self.rate = rate
+        self.buffer = buffer or get_buffer()
+        metrics.time_queries()
+        time_templates()
+
+    def process_request(self, request):
+        if random.random() >= self.rate:
+            return None
+        request.profile_start = (time.time(), template_time())
+        metrics.capture_queries()
+        return None
+
+    def process_view(self, request, view, args, kwargs):
+        if hasattr(request, 'profile_start'):
+            request.profile_view = view_name(view)
+        return None
+
+    def process_response(self, request, response):
+        if not hasattr(request, 'profile_start'):
+            return response
+        start, templates = request.profile_start
+        queries = metrics.captured_queries()
+        self.buffer.add(Profile(
+            path = request.path,
+            method = request.method,
+            view = getattr(request, 'profile_view', None),
+            status = response.status_code,
+            seconds = time.time() - start,
+            queries = len(queries),
+            query_seconds = sum([seconds for sql, seconds in queries]),
+            template_seconds = template_time() - templates,
+            size = response_size(response),
+            duplicates = find_duplicates(queries),
+        ))
+        return response
+
+def average(values):
+    return values and sum(values) / len(values) or 0
+
+def slowest_views(profiles):
+    "what we know about each view, the slowest on average first"
+    views = {}
+    for profile in profiles:
+        views.setdefault(profile.view, []).append(profile)
+    summaries = []
+    for view, found in views.items():
+        sizes = [profile.size for profile in found if profile.size is not None]
+        summaries.append({
+            'view': view,
+            'requests': len(found),
+            'seconds': average([profile.seconds for profile in found]),
+            'max_seconds': max([profile.seconds for profile in found]),
+            'queries': average([float(profile.queries) for profile in found]),
+            'query_seconds': average([profile.query_seconds
+                for profile in found]),
+            'template_seconds': average([profile.template_seconds
+                for profile in found]),
+            'size': sizes and average(sizes),
+        })
+    summaries.sort(key=lambda summary: -summary['seconds'])
+    return summaries
+
+def duplicated_queries(profiles):
+    """
+    the queries made more than once by the same request, with the views
+    which made them, the most repeated first
+    """
+    queries = {}
+    for profile in profiles:
+        for sql, count, seconds in profile.duplicates:
+            found = queries.setdefault(sql, {
+                'sql': sql,
+                'requests': 0,
+                'repeats': 0,
+                'most': 0,
+                'seconds': 0.0,
+                'views': set(),
+            })
+            found['requests'] += 1
+            found['repeats'] += count
+            found['most'] = max(found['most'], count)
+            found['seconds'] += seconds
+            found['views'].add(profile.view)
+    found = queries.values()
+    for query in found:
+        query['views'] = sorted(query['views'])
+    found.sort(key=lambda query: (-query['repeats'], -query['seconds']))
+    return found
+
+def show_profiles(request):
+    """
+    the slowest views and requests and the repeated queries from the
+    profiles this process has, which can be cleared with a POST
+    """
+    profile_buffer = get_buffer()
+    if request.method == "POST":
+        profile_buffer.clear()
+        return HttpResponseRedirect(request.path)
+    profiles = profile_buffer.profiles()
+    slowest = sorted(profiles, key=lambda profile: -profile.seconds)
+    context = {
+        'title': "Profiling",
+        'rate': settings.PROFILING_SAMPLE_RATE,
+        'profiles': profiles,
+        'views': slowest_views(profiles),
+        'slowest': slowest[:SLOWEST_REQUESTS],
+        'duplicates': duplicated_queries(profiles),
+    }
+    return render_to_response('admin/profiling.html', context,
+        context_instance=RequestContext(request))
+show_profiles = staff_member_required(show_profiles)
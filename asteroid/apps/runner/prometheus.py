@@ -0,0 +1,259 @@
+"""
+Counters, gauges and histograms kept in memory and exposed in the
+Prometheus text format. Nothing here needs Django, so the listener, which
+runs on machines without the web tier's settings, shares them with
+runner.metrics.
+"""
+
+import threading
+import time
+
+# the upper bounds of the buckets for timing things done during a request,
+# in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# and for timing commands, which can take hours
+RUN_BUCKETS = (1, 5, 15, 60, 300, 900, 1800, 3600, 3 * 3600, 12 * 3600)
+# and for counting things
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def format_value(value):
+    "a number the way the text format wants it"
+    if value == float("inf"):
+        return "+Inf"
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+def escape(value):
+    return unicode(value).replace("\\", "\\\\").replace("\n", "\\n"
+        ).replace('"', '\\"')
+
+def format_labels(names, values, extra=()):
+    "the labels of a sample, or nothing if it hasn't any"
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, escape(value))
+        for name, value in pairs])
+
+class Metric(object):
+    """
+    Something we keep count of, with a value for each combination of its
+    labels. The labels are given as keyword arguments.
+    """
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("%s takes the labels %s" % (self.name,
+                ", ".join(self.labels) or "nothing"))
+        return tuple([str(labels[name]) for name in self.labels])
+
+    def reset(self):
+        "forget everything counted so far"
+        self.lock.acquire()
+        try:
+            self.values = {}
+        finally:
+            self.lock.release()
+
+    def samples(self):
+        "the name, labels and value of each sample to expose"
+        self.lock.acquire()
+        try:
+            items = sorted(self.values.items())
+        finally:
+            self.lock.release()
+        return [(self.name, format_labels(self.labels, key), value)
+            for key, value in items]
+
+    def expose(self):
+        "the metric in the text format"
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (name, labels, format_value(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    "a count which only goes up"
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+class Gauge(Metric):
+    """
+    A value which goes up and down. Rather than being set, a gauge without
+    labels can be given a function which is called for its value whenever
+    it's exposed.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), function=None):
+        super(Gauge, self).__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            self.values[key] = value
+        finally:
+            self.lock.release()
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            self.values[key] = self.values.get(key, 0) + amount
+        finally:
+            self.lock.release()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def value(self, **labels):
+        if self.function is not None:
+            return self.function()
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, "", self.function())]
+        return super(Gauge, self).samples()
+
+class Timer(object):
+    "times something for a histogram, from when it's created until stop"
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = time.time()
+
+    def stop(self):
+        "record how long it's been, and return it"
+        elapsed = time.time() - self.start
+        self.histogram.observe(elapsed, **self.labels)
+        return elapsed
+
+class Histogram(Metric):
+    """
+    Counts of values in buckets, along with their total, so the text format
+    can be used to work out rates, averages and rough percentiles
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        self.lock.acquire()
+        try:
+            if key not in self.values:
+                # a count for each bucket and for beyond the last, then the
+                # total
+                self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+        finally:
+            self.lock.release()
+
+    def time(self, **labels):
+        "start timing something, call stop on what's returned when it's done"
+        return Timer(self, labels)
+
+    def count(self, **labels):
+        counts = self.values.get(self.key(labels))
+        return counts and sum(counts[:-1]) or 0
+
+    def sum(self, **labels):
+        counts = self.values.get(self.key(labels))
+        return counts and counts[-1] or 0
+
+    def samples(self):
+        samples = []
+        self.lock.acquire()
+        try:
+            items = sorted([(key, list(counts)) for key, counts
+                in self.values.items()])
+        finally:
+            self.lock.release()
+        for key, counts in items:
+            seen = 0
+            bounds = list(self.buckets) + [float("inf")]
+            for bound, count in zip(bounds, counts):
+                seen += count
+                samples.append(("%s_bucket" % self.name, format_labels(
+                    self.labels, key, [("le", format_value(bound))]), seen))
+            labels = format_labels(self.labels, key)
+            samples.append(("%s_sum" % self.name, labels, counts[-1]))
+            samples.append(("%s_count" % self.name, labels, seen))
+        return samples
+
+class Registry(object):
+    "the metrics of a process, which can be exposed together"
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        add a metric, or return the one already registered with its name so
+        modules can be imported more than once
+        """
+        self.lock.acquire()
+        try:
+            existing = self.metrics.get(metric.name)
+            if existing is None:
+                self.metrics[metric.name] = metric
+                return metric
+            if existing.__class__ is not metric.__class__ or \
+                    existing.labels != metric.labels:
+                raise ValueError("%s is already registered differently" %
+                    metric.name)
+            return existing
+        finally:
+            self.lock.release()
+
+    def get(self, name):
+        return self.metrics[name]
+
+    def reset(self):
+        "forget everything counted so far"
+        for metric in self.metrics.values():
+            metric.reset()
+
+    def expose(self):
+        "every metric in the text format"
+        return "".join(["%s\n" % self.metrics[name].expose()
+            for name in sorted(self.metrics)])
+
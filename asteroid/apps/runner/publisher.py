@@ -0,0 +1,183 @@
+"""
+A long lived connection to the message queue for publishing runs. Opening
+a connection, declaring the exchange and closing everything again for each
+run costs several round trips, so instead each process keeps a connection
+and channel open and only declares the exchange the first time it's used.
+
+Runs are published with the target of their command as the routing key.
+The listeners for a target share a queue, so they take turns at its runs,
+and a listener can listen for more than one target.
+
+The exchange and the queues the listeners declare are durable and the
+messages persistent, so runs waiting to be run survive the broker being
+restarted and the listeners being stopped.
+"""
+
+import socket
+import threading
+
+from django.conf import settings
+
+from amqplib import client_0_8 as amqp
+
+from runner import metrics
+from runner.queues import EXCHANGE, DEFAULT_TARGET, queue_name
+
+# messages which are saved to disk by the broker
+PERSISTENT = 2
+
+# the errors which mean our connection to the queue is no good
+CONNECTION_ERRORS = (socket.error, IOError, amqp.AMQPException)
+
+PUBLISH_SECONDS = metrics.histogram("asteroid_publish_seconds",
+    "How long publishing a run to the message queue took, including "
+    "connecting if need be", ["target"])
+PUBLISH_ERRORS = metrics.counter("asteroid_publish_errors_total",
+    "Attempts to publish to the message queue which failed")
+
+class Publisher(object):
+    """
+    Publishes messages to the exchange over a connection which is opened on
+    first use and kept open. If publishing fails we reconnect and try once
+    more. A lock makes it safe to share between threads.
+    """
+
+    def __init__(self, host, exchange=EXCHANGE):
+        self.host = host
+        self.exchange = exchange
+        self.connection = None
+        self.channel = None
+        self.declared = False
+        self.lock = threading.Lock()
+
+    def connect(self):
+        "open the connection and channel, declaring the exchange if need be"
+        self.connection = amqp.Connection(self.host)
+        self.channel = self.connection.channel()
+        if not self.declared:
+            # if it already exists then we check it's of the correct type
+            self.channel.exchange_declare(exchange=self.exchange,
+                type="direct", durable=True, auto_delete=False)
+            self.declared = True
+
+    def reset(self):
+        """
+        Throw away the connection after an error. The exchange is declared
+        again on reconnecting, in case the broker has lost it.
+        """
+        for closeable in (self.channel, self.connection):
+            try:
+                if closeable is not None:
+                    closeable.close()
+            except CONNECTION_ERRORS:
+                pass
+        self.connection = self.channel = None
+        self.declared = False
+
+    def publish(self, body, routing_key=DEFAULT_TARGET):
+        "publish a message, reconnecting and trying again if that fails"
+        self.lock.acquire()
+        try:
+            try:
+                self._publish(body, routing_key)
+            except CONNECTION_ERRORS:
+                self.reset()
+                try:
+                    self._publish(body, routing_key)
+                except CONNECTION_ERRORS:
+                    # leave things ready for a fresh start next time
+                    self.reset()
+                    raise
+        finally:
+            self.lock.release()
+
+    def publish_many(self, bodies, routing_key=DEFAULT_TARGET):
+        """
+        publish several messages one after the other on our channel. If
+        publishing fails part way through we reconnect once and carry on
+        from the message which failed. If that fails too, how many of the
+        messages were published is left on the error as sent.
+        """
+        self.lock.acquire()
+        try:
+            sent = 0
+            retried = False
+            while sent < len(bodies):
+                try:
+                    self._publish(bodies[sent], routing_key)
+                    sent += 1
+                except CONNECTION_ERRORS, e:
+                    self.reset()
+                    if retried:
+                        e.sent = sent
+                        raise
+                    retried = True
+        finally:
+            self.lock.release()
+
+    def _publish(self, body, routing_key):
+        timer = PUBLISH_SECONDS.time(target=routing_key)
+        try:
+            if self.channel is None:
+                self.connect()
+            self.channel.basic_publish(amqp.Message(body,
+                delivery_mode=PERSISTENT),
+                exchange=self.exchange, routing_key=routing_key)
+        except CONNECTION_ERRORS:
+            PUBLISH_ERRORS.inc()
+            raise
+        timer.stop()
+
+    def queue_depths(self, targets):
+        """
+        Return how many messages are waiting on the queue of each target and
+        how many listeners are taking them, keyed by target. Targets which
+        no listener has ever listened for have no queue, and are None.
+        """
+        self.lock.acquire()
+        try:
+            depths = {}
+            for target in targets:
+                try:
+                    if self.channel is None:
+                        self.connect()
+                    name, messages, consumers = self.channel.queue_declare(
+                        queue=queue_name(target), passive=True)
+                    depths[target] = (messages, consumers)
+                except amqp.AMQPChannelException, e:
+                    if e.amqp_reply_code != 404:
+                        self.reset()
+                        raise
+                    # the broker closes the channel when the queue doesn't
+                    # exist, but the connection is still good
+                    self.channel = self.connection.channel()
+                    depths[target] = None
+                except CONNECTION_ERRORS:
+                    self.reset()
+                    raise
+            return depths
+        finally:
+            self.lock.release()
+
+    def close(self):
+        "close the connection, it'll be opened again if we publish again"
+        self.lock.acquire()
+        try:
+            self.reset()
+        finally:
+            self.lock.release()
+
+# there's one publisher per process, created when it's first needed
+_publisher = None
+_publisher_lock = threading.Lock()
+
+def get_publisher():
+    "return the publisher for this process"
+    global _publisher
+    _publisher_lock.acquire()
+    try:
+        if _publisher is None:
+            _publisher = Publisher(settings.QUEUE_ADDRESS)
+        return _publisher
+    finally:
+        _publisher_lock.release()
@@ -0,0 +1,20 @@
+"""
+The names of the exchange and queues runs are published to. Nothing here
+needs Django, so the listener shares them with runner.publisher.
+"""
+
+# the exchange the listeners bind their queues to
+EXCHANGE = "asteroid"
+
+# the target of commands which any listener can run
+DEFAULT_TARGET = "all"
+
+def queue_name(target):
+    """
+    the name of the queue the listeners for a target share, so they take
+    turns at its commands
+    """
+    if target == DEFAULT_TARGET:
+        # the queue listeners have always used
+        return "asteroid_queue"
+    return "asteroid_%s" % target
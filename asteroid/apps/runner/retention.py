@@ -0,0 +1,111 @@
+"""
+Enforce the retention policy of each command, archiving runs which have
+expired to compressed files on disk before deleting them. Runs are dealt
+with in small batches, each archived and then deleted in its own short
+transaction, so the database is never locked for long and pruning can be
+stopped and started again at any point.
+
+Archives are gzipped files with a JSON document per line, one file per
+command per day. The output of a run is written a chunk at a time, so even
+a very long output is never held in memory whole. Each batch is appended as a separate gzip member, which
+gzip and zcat read as one file. If pruning is stopped between archiving a
+batch and deleting it the runs will be archived again next time, so an
+archive may contain the same run more than once.
+"""
+
+import os
+import gzip
+from datetime import datetime
+
+from django.db import connection, transaction
+from django.utils import simplejson
+
+from runner.models import Run, OutputChunk
+
+# how many runs to archive and delete at a time
+BATCH_SIZE = 100
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def archive_path(archive_dir, command, now=None):
+    "the file runs of a command pruned today are archived to"
+    now = now or datetime.today()
+    return os.path.join(archive_dir, "%s-%s.jsonl.gz" % (command.slug,
+        now.strftime("%Y-%m-%d")))
+
+def run_record(run):
+    """
+    everything we know about a run as a dictionary ready for JSON, apart
+    from its output which write_record adds
+    """
+    return {
+        'id': run.id,
+        'command': run.command.slug,
+        'command_run': run.command_run,
+        'status': run.status,
+        'created_date': run.created_date.strftime(DATE_FORMAT),
+        'updated_date': run.updated_date.strftime(DATE_FORMAT),
+    }
+
+def write_record(archive, run):
+    """
+    write a run to an archive as a line of JSON, with its output last. JSON
+    escapes each character on its own, so the output can be encoded a chunk
+    at a time and the pieces joined inside the one string
+    """
+    record = simplejson.dumps(run_record(run))
+    archive.write(record[:-1] + ', "output": "')
+    for output in run.iter_output():
+        archive.write(simplejson.dumps(output)[1:-1])
+    archive.write('"}\n')
+
+def archive_runs(path, runs):
+    "append runs to an archive, making sure they're on disk before we return"
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    raw = open(path, 'ab')
+    try:
+        archive = gzip.GzipFile(fileobj=raw, mode='ab')
+        for run in runs:
+            write_record(archive, run)
+        archive.close()
+        raw.flush()
+        os.fsync(raw.fileno())
+    finally:
+        raw.close()
+
+def delete_runs(ids):
+    """
+    Delete runs along with their output. The output is deleted directly as
+    otherwise django would load all of it just to delete it.
+    """
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE run_id IN (%s)" % (
+        connection.ops.quote_name(OutputChunk._meta.db_table),
+        ", ".join(["%s"] * len(ids))), ids)
+    # deleting the runs through django keeps the latest run of each
+    # command up to date
+    Run.objects.filter(id__in=ids).delete()
+delete_runs = transaction.commit_on_success(delete_runs)
+
+def prune_command(command, archive_dir=None, batch_size=BATCH_SIZE, now=None):
+    """
+    Archive and delete the expired runs of a command, returning how many
+    were pruned. With no archive directory runs are deleted without being
+    archived.
+    """
+    expired = command.expired_runs(now).order_by('id')
+    pruned = 0
+    last_id = 0
+    while True:
+        runs = list(expired.filter(id__gt=last_id).select_related(
+            'command')[:batch_size])
+        if not runs:
+            break
+        if archive_dir:
+            archive_runs(archive_path(archive_dir, command, now), runs)
+        delete_runs([run.id for run in runs])
+        pruned += len(runs)
+        last_id = runs[-1].id
+    return pruned
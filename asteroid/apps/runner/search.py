@@ -0,0 +1,293 @@
+"""
+Search over the output of runs. Runs are added to a search index as they
+finish, so finding which runs printed an error doesn't mean reading
+through the output of every run.
+
+The index is kept by a backend, chosen with the SEARCH_BACKEND setting.
+The fts5 backend uses the full text search built into sqlite. The like
+backend works with any database, but has to look through every run so is
+much slower. Without a setting fts5 is used if the database has it, and
+like otherwise. Another backend can be used by giving the dotted path to
+its class. The rebuild_search_index command fills in the index from
+scratch, for instance after changing backend.
+
+Only the start and end of long outputs are indexed, so indexing a run
+never means loading all of a huge output, or storing it all again.
+
+Searches look for the words of the query next to each other, in order,
+and return the newest runs first along with a snippet of their output.
+The matching parts of a snippet are marked with HIGHLIGHT_START and
+HIGHLIGHT_END.
+"""
+
+import re
+import sys
+import traceback
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.encoding import force_unicode
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from runner import metrics
+
+# how many results to return at a time
+RESULTS = 20
+# roughly how many characters of output to include either side of a match
+SNIPPET_SIZE = 80
+# the most output of a run to index, in characters. Half comes from the
+# start of the output and half from the end, where errors tend to be
+MAX_INDEXED = 256 * 1024
+
+INDEX_ERRORS = metrics.counter("asteroid_search_index_errors_total",
+    "Runs which couldn't be added to the search index")
+
+# marks the matching parts of snippets, characters which won't turn up in
+# output we'd want to search
+HIGHLIGHT_START = u"\x02"
+HIGHLIGHT_END = u"\x03"
+
+class SearchError(Exception):
+    "Raised when a query can't be searched for"
+    pass
+
+def quote_name(name):
+    return connection.ops.quote_name(name)
+
+def table_exists(table):
+    """
+    check for a table before creating it, as some databases commit any
+    transaction we're in when a table is created
+    """
+    return table in connection.introspection.get_table_list(
+        connection.cursor())
+
+class Fts5Backend(object):
+    """
+    Keeps the output of runs in an sqlite full text search table, keyed on
+    the run id.
+    """
+    table = "runner_search"
+
+    def install(self):
+        "create the index if it doesn't exist yet"
+        if table_exists(self.table):
+            return
+        connection.cursor().execute("CREATE VIRTUAL TABLE %s USING "
+            "fts5(output, command_id UNINDEXED)" % quote_name(self.table))
+
+    def index(self, run_id, command_id, output):
+        "add the output of a run to the index, replacing anything already there"
+        self.remove([run_id])
+        connection.cursor().execute("INSERT INTO %s (rowid, output, "
+            "command_id) VALUES (%%s, %%s, %%s)" % quote_name(self.table),
+            [run_id, output, command_id])
+
+    def remove(self, run_ids):
+        "take runs out of the index"
+        if not run_ids:
+            return
+        connection.cursor().execute("DELETE FROM %s WHERE rowid IN (%s)" % (
+            quote_name(self.table), ", ".join(["%s"] * len(run_ids))),
+            list(run_ids))
+
+    def clear(self):
+        "empty the index"
+        connection.cursor().execute("DELETE FROM %s" % quote_name(self.table))
+
+    def search(self, query, command_id=None, before=None, limit=RESULTS):
+        """
+        The ids of the newest runs whose output contains the query, each
+        with a snippet of the output around a match
+        """
+        # searching for the query as a phrase means nothing in it is taken
+        # as search syntax
+        sql = ["SELECT rowid, snippet(%s, 0, %%s, %%s, '...', %%s) FROM %s "
+            "WHERE %s MATCH %%s" % ((quote_name(self.table),) * 3)]
+        params = [HIGHLIGHT_START, HIGHLIGHT_END, max(1, SNIPPET_SIZE / 5),
+            u'output:"%s"' % query.replace('"', '""')]
+        if command_id is not None:
+            sql.append("AND command_id = %s")
+            params.append(command_id)
+        if before is not None:
+            sql.append("AND rowid < %s")
+            params.append(before)
+        sql.append("ORDER BY rowid DESC LIMIT %s")
+        params.append(limit)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(" ".join(sql), params)
+        except Exception, e:
+            # the driver's errors differ, but the query is all that can be
+            # wrong by now
+            raise SearchError(force_unicode(e))
+        return [(run_id, snippet) for run_id, snippet in cursor.fetchall()]
+
+class LikeBackend(object):
+    """
+    Keeps the output of runs in an ordinary table and looks through all of
+    it with LIKE, which any database can do.
+    """
+    table = "runner_searchtext"
+
+    def install(self):
+        "create the index if it doesn't exist yet"
+        if table_exists(self.table):
+            return
+        connection.cursor().execute("CREATE TABLE %s (run_id integer NOT NULL PRIMARY "
+            "KEY, command_id integer NOT NULL, output text NOT NULL)" %
+            quote_name(self.table))
+
+    def index(self, run_id, command_id, output):
+        "add the output of a run to the index, replacing anything already there"
+        self.remove([run_id])
+        connection.cursor().execute("INSERT INTO %s (run_id, command_id, "
+            "output) VALUES (%%s, %%s, %%s)" % quote_name(self.table),
+            [run_id, command_id, output])
+
+    def remove(self, run_ids):
+        "take runs out of the index"
+        if not run_ids:
+            return
+        connection.cursor().execute("DELETE FROM %s WHERE run_id IN (%s)" % (
+            quote_name(self.table), ", ".join(["%s"] * len(run_ids))),
+            list(run_ids))
+
+    def clear(self):
+        "empty the index"
+        connection.cursor().execute("DELETE FROM %s" % quote_name(self.table))
+
+    def search(self, query, command_id=None, before=None, limit=RESULTS):
+        """
+        The ids of the newest runs whose output contains the query, each
+        with a snippet of the output around a match
+        """
+        # escaped with ! as databases don't agree on backslashes
+        pattern = u"%%%s%%" % re.sub(r'([!%_])', r'!\1', query)
+        sql = ["SELECT run_id, output FROM %s WHERE output LIKE %%s "
+            "ESCAPE '!'" % quote_name(self.table)]
+        params = [pattern]
+        if command_id is not None:
+            sql.append("AND command_id = %s")
+            params.append(command_id)
+        if before is not None:
+            sql.append("AND run_id < %s")
+            params.append(before)
+        sql.append("ORDER BY run_id DESC LIMIT %s")
+        params.append(limit)
+        cursor = connection.cursor()
+        cursor.execute(" ".join(sql), params)
+        return [(run_id, make_snippet(output, query))
+            for run_id, output in cursor.fetchall()]
+
+def make_snippet(output, query):
+    "the output around the first place the query turns up, highlighted"
+    start = output.lower().find(query.lower())
+    if start == -1:
+        return output[:SNIPPET_SIZE * 2]
+    end = start + len(query)
+    before = max(0, start - SNIPPET_SIZE)
+    after = min(len(output), end + SNIPPET_SIZE)
+    return u"%s%s%s%s%s%s%s" % (
+        before > 0 and u"..." or u"",
+        output[before:start],
+        HIGHLIGHT_START,
+        output[start:end],
+        HIGHLIGHT_END,
+        output[end:after],
+        after < len(output) and u"..." or u"",
+    )
+
+def split_snippet(snippet):
+    "a snippet without its highlighting, and where the highlights were"
+    text = []
+    highlights = []
+    length = 0
+    for i, part in enumerate(re.split(u"[%s%s]" % (HIGHLIGHT_START,
+            HIGHLIGHT_END), snippet)):
+        # the parts inside the marks are every other part
+        if i % 2:
+            highlights.append([length, length + len(part)])
+        text.append(part)
+        length += len(part)
+    return u"".join(text), highlights
+
+def highlight(snippet):
+    "a snippet ready for a page, with the matches in mark elements"
+    return mark_safe(escape(snippet).replace(HIGHLIGHT_START, u"<mark>"
+        ).replace(HIGHLIGHT_END, u"</mark>"))
+
+BACKENDS = {
+    'fts5': Fts5Backend,
+    'like': LikeBackend,
+}
+
+# whether the database has fts5, which only needs checking once
+_fts5 = []
+
+def fts5_available():
+    "whether the database is sqlite with full text search built in"
+    if not _fts5:
+        available = False
+        if settings.DATABASE_ENGINE == 'sqlite3':
+            cursor = connection.cursor()
+            try:
+                cursor.execute(
+                    "SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+                available = bool(cursor.fetchone()[0])
+            except Exception:
+                # too old an sqlite to tell us
+                pass
+        _fts5.append(available)
+    return _fts5[0]
+
+def get_backend():
+    "the search backend the settings ask for"
+    name = settings.SEARCH_BACKEND
+    if name is None:
+        name = fts5_available() and 'fts5' or 'like'
+    if name in BACKENDS:
+        return BACKENDS[name]()
+    module, attr = name.rsplit(".", 1)
+    return getattr(__import__(module, {}, {}, [attr]), attr)()
+
+def indexed_output(run):
+    "the output of a run to index, only loading the parts we need"
+    if run.output_length <= MAX_INDEXED:
+        return run.read_output()
+    half = MAX_INDEXED / 2
+    return u"%s\n...\n%s" % (run.read_output(0, half),
+        run.tail_output(half)[1])
+
+def index_run(run):
+    """
+    add the output of a finished run to the index. A run which can't be
+    indexed has still finished, so errors are reported rather than raised
+    """
+    sid = transaction.savepoint()
+    try:
+        get_backend().index(run.id, run.command_id, indexed_output(run))
+    except Exception:
+        transaction.savepoint_rollback(sid)
+        INDEX_ERRORS.inc()
+        traceback.print_exc(file=sys.stderr)
+    else:
+        transaction.savepoint_commit(sid)
+    transaction.commit_unless_managed()
+
+def remove_runs(run_ids):
+    "take deleted runs out of the index"
+    get_backend().remove(run_ids)
+    transaction.commit_unless_managed()
+
+def search(query, command_id=None, before=None, limit=RESULTS):
+    """
+    Search the output of runs, returning the ids of the newest runs which
+    match along with a snippet of their output. Pass the last id as before
+    to get the next page of results.
+    """
+    query = query.strip()
+    if not query:
+        return []
+    return get_backend().search(query, command_id, before, limit)
@@ -0,0 +1,66 @@
+"""
+Summaries of how long runs take. Keeping every duration to work out
+percentiles would mean reading every run, so instead durations are counted
+in buckets which double in size, and percentiles are worked out from the
+counts. Each estimate is within a factor of two of the real value, which
+is plenty for spotting a command getting slower.
+"""
+
+# the upper bound of each bucket in seconds, from a tenth of a second to
+# around ten days. Anything longer goes in the last bucket
+BUCKETS = [0.1 * 2 ** i for i in range(24)]
+
+def bucket(duration):
+    "the index of the bucket a duration is counted in"
+    for i, bound in enumerate(BUCKETS):
+        if duration <= bound:
+            return i
+    return len(BUCKETS) - 1
+
+def parse(histogram):
+    "turn a stored histogram back into a list of counts"
+    counts = [0] * len(BUCKETS)
+    if histogram:
+        for i, count in enumerate(histogram.split(",")):
+            counts[i] = int(count)
+    return counts
+
+def to_text(counts):
+    "store a list of counts as text"
+    # trailing empty buckets are left off to save space
+    while counts and not counts[-1]:
+        counts = counts[:-1]
+    return ",".join([str(count) for count in counts])
+
+def add(histogram, duration):
+    "count another duration in a stored histogram"
+    counts = parse(histogram)
+    counts[bucket(duration)] += 1
+    return to_text(counts)
+
+def merge(histograms):
+    "combine several stored histograms into one"
+    counts = [0] * len(BUCKETS)
+    for histogram in histograms:
+        for i, count in enumerate(parse(histogram)):
+            counts[i] += count
+    return to_text(counts)
+
+def percentile(histogram, fraction):
+    """
+    Estimate the duration the given fraction of runs took no longer than,
+    or None if there aren't any. We assume the durations are spread evenly
+    through each bucket.
+    """
+    counts = parse(histogram)
+    total = sum(counts)
+    if not total:
+        return None
+    target = fraction * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= target:
+            lower = i and BUCKETS[i - 1] or 0
+            return lower + (BUCKETS[i] - lower) * (target - seen) / count
+        seen += count
+    return BUCKETS[-1]
@@ -0,0 +1,26 @@
+"Template filters for showing how long runs took"
+
+from django import template
+
+register = template.Library()
+
+@register.filter('duration')
+def duration(value):
+    "Show a number of seconds in the largest units which make sense"
+    if value is None or value == "":
+        return "-"
+    value = float(value)
+    if value < 60:
+        return "%.1fs" % value
+    minutes, seconds = divmod(int(round(value)), 60)
+    if minutes < 60:
+        return "%dm %02ds" % (minutes, seconds)
+    hours, minutes = divmod(minutes, 60)
+    return "%dh %02dm" % (hours, minutes)
+
+@register.filter('milliseconds')
+def milliseconds(value):
+    "Show a number of seconds as milliseconds, for things which are quick"
+    if value is None or value == "":
+        return "-"
+    return "%.1fms" % (float(value) * 1000)
@@ -0,0 +1,43 @@
+"Template tag for caching parts of pages, see runner.caching"
+
+from django import template
+from django.template import resolve_variable
+
+from runner import caching
+
+register = template.Library()
+
+class CachedFragmentNode(template.Node):
+    def __init__(self, nodelist, name, groups, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.groups = groups
+        self.vary_on = vary_on
+
+    def render(self, context):
+        vary_on = [resolve_variable(var, context) for var in self.vary_on]
+        value, key = caching.lookup(self.name, self.groups, vary_on)
+        if value is None:
+            value = self.nodelist.render(context)
+            caching.store(key, value)
+        return value
+
+@register.tag('cachedfragment')
+def do_cachedfragment(parser, token):
+    """
+    Cache the contents of the tag until something in the groups changes.
+    Any extra variables are used to cache different versions.
+
+    {% cachedfragment dashboard_runs runs %}
+        ...
+    {% endcachedfragment %}
+
+    {% cachedfragment command_runs commands,runs command.id %}
+    """
+    nodelist = parser.parse(('endcachedfragment',))
+    parser.delete_first_token()
+    bits = token.contents.split()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(
+            "%r tag requires a name and the groups it depends on" % bits[0])
+    return CachedFragmentNode(nodelist, bits[1], bits[2].split(","), bits[3:])
@@ -1,7 +1,20 @@
 from django.conf import settings
 settings.QUEUE_COMMANDS = False
+settings.BACKGROUND_COMMANDS = False
 
 from admin import *
 from models import *
 from views import *
-from templatetags import *
\ No newline at end of file
+from templatetags import *
+from pagination import *
+from migrations import *
+from executor import *
+from publisher import *
+from background import *
+from compression import *
+from retention import *
+from api import *
+from search import *
+from stats import *
+from metrics import *
+from profiling import *
@@ -1,5 +1,7 @@
 from test_extensions.django_common import DjangoCommon
- 
+
+from runner.models import Command, Run
+
 class AdminTests(DjangoCommon):
     "Tests for the site admin"
 
@@ -25,4 +27,31 @@ class AdminTests(DjangoCommon):
         response = self.client.get('/admin/runner/run/add/')
         self.assert_code(response, 200)
         response = self.client.get('/admin/runner/command/add/')
-        self.assert_code(response, 200)
\ No newline at end of file
+        self.assert_code(response, 200)
+
+    def test_run_shows_end_of_output(self):
+        command = Command.objects.create(title="test", slug="test",
+            command_to_run="ls")
+        run = command.create_run()
+        run.append_output(u"x" * 10000)
+        run.append_output(u"<the end>")
+        self.login_as_admin()
+        response = self.client.get('/admin/runner/run/%s/' % run.id)
+        self.assert_code(response, 200)
+        self.assert_response_contains("&lt;the end&gt;", response)
+        self.assert_response_contains('href="/commands/test/%s"' % run.id,
+            response)
+        self.deny_contains("x" * 9000, response.content)
+
+    def test_run_selected_commands(self):
+        for slug in ("one", "two"):
+            Command.objects.create(title=slug, slug=slug, command_to_run="ls")
+        self.login_as_admin()
+        response = self.client.post('/admin/runner/command/', {
+            'action': 'run_selected',
+            '_selected_action': [command.id for command in Command.objects.all()],
+        })
+        self.assert_code(response, 302)
+        self.assert_count(2, Run)
+        self.assert_equal(["succeeded", "succeeded"],
+            [command.status() for command in Command.objects.all()])
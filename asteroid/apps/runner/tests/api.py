@@ -0,0 +1,123 @@
+from test_extensions.django_common import DjangoCommon
+
+from django.conf import settings
+from django.db import connection
+from django.utils import simplejson
+
+from runner.models import Run, Command
+
+class ApiTests(DjangoCommon):
+    "Tests for the JSON API"
+
+    def setUp(self):
+        self.command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "ls",
+        )
+        for i in range(12):
+            run = Run.objects.create(
+                command = self.command,
+                command_run = self.command.command_to_run,
+            )
+            run.append_output("output %s" % i)
+            run.finish(i % 2)
+        self.run = run
+
+    def get(self, url, code=200):
+        response = self.client.get(url)
+        self.assert_code(response, code)
+        return simplejson.loads(response.content)
+
+    def test_commands(self):
+        result = self.get('/api/commands/')
+        self.assert_equal(1, len(result['commands']))
+        command = result['commands'][0]
+        self.assert_equal("test", command['slug'])
+        self.assert_equal("failed", command['status'])
+        self.assert_equal("/commands/test/", command['url'])
+
+    def test_command(self):
+        result = self.get('/api/commands/test/?fields=title,status')
+        self.assert_equal({"title": "test", "status": "failed"}, result)
+
+    def test_missing_command(self):
+        self.assert_contains("error", self.get('/api/commands/bob/', 404))
+
+    def test_unknown_field(self):
+        self.get('/api/commands/?fields=title,bob', 400)
+
+    def test_errors_about_unicode(self):
+        result = self.get(u'/api/commands/?fields=\xe9'.encode('utf-8'), 400)
+        self.assert_equal(u"Unknown field \xe9", result['error'])
+        result = self.get(u'/api/commands/\xe9/'.encode('utf-8'), 404)
+        self.assert_equal(u"No command \xe9", result['error'])
+
+    def test_runs_are_paged(self):
+        result = self.get('/api/runs/')
+        self.assert_equal(10, len(result['runs']))
+        self.assert_equal(12, result['runs'][0]['id'])
+        self.assertFalse('output' in result['runs'][0])
+        self.assert_equal(None, result['previous'])
+        result = self.get('/api/runs/?after=%s' % result['next'])
+        self.assert_equal([2, 1], [run['id'] for run in result['runs']])
+        self.assert_equal(None, result['next'])
+
+    def test_runs_with_fields(self):
+        result = self.get('/api/runs/?fields=id,output&per_page=2')
+        self.assert_equal([{"id": 12, "output": "output 11"},
+            {"id": 11, "output": "output 10"}], result['runs'])
+
+    def test_runs_dont_load_unwanted_columns(self):
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            self.get('/api/runs/?fields=id,status')
+            sql = connection.queries[-1]['sql']
+        finally:
+            settings.DEBUG = False
+        self.deny_contains('command_run', sql)
+        self.deny_contains('runner_command', sql)
+        self.deny_contains('runner_outputchunk', sql)
+
+    def test_runs_filtered(self):
+        result = self.get('/api/commands/test/runs/?status=failed&fields=id')
+        self.assert_equal([12, 10, 8, 6, 4, 2],
+            [run['id'] for run in result['runs']])
+        result = self.get('/api/runs/?command=test&status=succeeded&per_page=100')
+        self.assert_equal(6, len(result['runs']))
+        result = self.get('/api/runs/?since=2000-01-01&until=2000-01-02')
+        self.assert_equal([], result['runs'])
+
+    def test_runs_with_bad_filters(self):
+        self.get('/api/runs/?status=bob', 400)
+        self.get('/api/runs/?since=yesterday', 400)
+        self.get('/api/runs/?per_page=1000', 400)
+        self.get('/api/runs/?after=bob', 400)
+        self.get('/api/runs/?command=bob', 404)
+
+    def test_run(self):
+        result = self.get('/api/commands/test/12/')
+        self.assert_equal("failed", result['status'])
+        self.assert_equal("output 11", result['output'])
+        self.assert_equal(0, result['output_start'])
+        self.assert_equal("test", result['command'])
+
+    def test_run_of_other_command(self):
+        Command.objects.create(title="other", slug="other", command_to_run="ls")
+        self.get('/api/commands/other/12/', 404)
+
+    def test_run_status(self):
+        result = self.get('/api/commands/test/12/status/')
+        self.assert_equal("failed", result['status'])
+        self.assert_equal(9, result['output_length'])
+        self.assertTrue(result['complete'])
+
+    def test_run_output(self):
+        result = self.get('/api/commands/test/12/output/?start=2&end=6')
+        self.assert_equal("tput", result['output'])
+        self.assert_equal(6, result['end'])
+        result = self.get('/api/commands/test/12/output/?start=7')
+        self.assert_equal("11", result['output'])
+        self.assert_equal(9, result['end'])
+        self.get('/api/commands/test/12/output/?start=6&end=2', 400)
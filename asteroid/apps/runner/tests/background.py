@@ -0,0 +1,123 @@
+import threading
+
+from test_extensions.django_common import DjangoCommon
+
+from django.conf import settings
+from django.core.management import call_command
+from django.test import TransactionTestCase
+
+from runner import models
+from runner.background import BackgroundExecutor, Busy
+from runner.models import Run, Command
+
+class BackgroundTests(DjangoCommon):
+    "Tests for running commands on background threads"
+
+    def setUp(self):
+        self.executor = BackgroundExecutor(2, 2)
+        self.done = []
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_jobs_are_run(self):
+        for i in range(4):
+            self.executor.submit(self.done.append, i)
+            self.executor.wait()
+        self.assert_equal([0, 1, 2, 3], self.done)
+
+    def test_errors_dont_stop_workers(self):
+        self.executor.submit(lambda: 1 / 0)
+        self.executor.submit(self.done.append, 1)
+        self.executor.wait()
+        self.assert_equal([1], self.done)
+
+    def test_concurrency_is_bounded(self):
+        release = threading.Event()
+        started = threading.Semaphore(0)
+        running = []
+        def job(i):
+            running.append(i)
+            started.release()
+            release.wait()
+        try:
+            # two running and two waiting fills the executor
+            for i in range(2):
+                self.executor.submit(job, i)
+                started.acquire()
+            for i in range(2, 4):
+                self.executor.submit(job, i)
+            self.assertRaises(Busy, self.executor.submit, job, 4)
+        finally:
+            release.set()
+        self.executor.wait()
+        self.assert_equal([0, 1, 2, 3], sorted(running))
+
+    def test_full_executor_fails_run(self):
+        command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "ls",
+        )
+        class FullExecutor(object):
+            def submit(self, func, *args):
+                raise Busy()
+        get_executor = models.get_executor
+        models.get_executor = lambda: FullExecutor()
+        settings.BACKGROUND_COMMANDS = True
+        try:
+            run = command.trigger()
+        finally:
+            settings.BACKGROUND_COMMANDS = False
+            models.get_executor = get_executor
+        run = Run.objects.get(id=run.id)
+        self.assert_equal("failed", run.status)
+        self.assert_contains("Too many commands", run.read_output())
+
+class BackgroundRunTests(DjangoCommon):
+    """
+    Tests for running commands from a request on the background threads.
+    The threads have their own connections, which can't see inside the
+    transaction tests are normally wrapped in, so these tests flush the
+    database before and after instead.
+    """
+
+    def _fixture_setup(self):
+        TransactionTestCase._fixture_setup.im_func(self)
+
+    def _fixture_teardown(self):
+        call_command('flush', verbosity=0, interactive=False)
+
+    def setUp(self):
+        self.executor = BackgroundExecutor(1, 1)
+        self.get_executor = models.get_executor
+        models.get_executor = lambda: self.executor
+        settings.BACKGROUND_COMMANDS = True
+
+    def tearDown(self):
+        settings.BACKGROUND_COMMANDS = False
+        models.get_executor = self.get_executor
+        self.executor.shutdown()
+
+    def run_command(self, command_to_run):
+        "run a command through the site, returning its run once it's done"
+        Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = command_to_run,
+        )
+        response = self.client.get('/commands/test/run/')
+        self.assert_code(response, 302)
+        self.executor.wait()
+        self.assert_equal(1, len(self.executor.threads))
+        return Run.objects.get()
+
+    def test_runs_succeed_on_a_thread(self):
+        run = self.run_command("echo hello")
+        self.assert_equal("succeeded", run.status)
+        self.assert_equal("hello\n", run.read_output())
+
+    def test_runs_fail_on_a_thread(self):
+        run = self.run_command("exit 3")
+        self.assert_equal("failed", run.status)
+        self.assert_equal(3, run.exit_code)
@@ -0,0 +1,35 @@
+from test_extensions.django_common import DjangoCommon
+
+from runner import compression
+from runner.compression import compress, decompress, choose_encoding, \
+    PLAIN, ZLIB, LZMA, COMPRESS_MIN_SIZE
+
+class CompressionTests(DjangoCommon):
+    "Tests for compressing stored output"
+
+    def test_round_trip(self):
+        text = u"caf\xe9 ok\n" * 5000
+        encoding, data, size = compress(text)
+        self.assertNotEqual(PLAIN, encoding)
+        self.assert_equal(len(text.encode('utf-8')), size)
+        self.assert_equal(text, decompress(encoding, data))
+
+    def test_small_output_left_alone(self):
+        self.assert_equal((PLAIN, u"abc", 3), compress(u"abc"))
+        self.assert_equal(u"abc", decompress(PLAIN, u"abc"))
+
+    def test_incompressible_output_left_alone(self):
+        import os, base64
+        text = unicode(base64.b64encode(os.urandom(COMPRESS_MIN_SIZE * 2)))
+        self.assert_equal(PLAIN, compress(text)[0])
+
+    def test_encoding_chosen_by_size(self):
+        self.assert_equal(PLAIN, choose_encoding(10))
+        self.assert_equal(ZLIB, choose_encoding(COMPRESS_MIN_SIZE))
+        if compression.lzma is None:
+            self.assert_equal(ZLIB, choose_encoding(10 ** 6))
+        else:
+            self.assert_equal(LZMA, choose_encoding(10 ** 6))
+
+    def test_unknown_encoding(self):
+        self.assertRaises(ValueError, decompress, "bob", "")
@@ -0,0 +1,40 @@
+from test_extensions.django_common import DjangoCommon
+
+from runner.executor import execute
+
+class ExecutorTests(DjangoCommon):
+    "Tests for running commands and streaming their output"
+
+    def setUp(self):
+        self.chunks = []
+
+    def test_output_is_passed_on(self):
+        code = execute("echo hello", self.chunks.append)
+        self.assert_equal(0, code)
+        self.assert_equal(u"hello\n", u"".join(self.chunks))
+
+    def test_exit_code(self):
+        self.assert_equal(3, execute("exit 3", self.chunks.append))
+
+    def test_stderr_is_included(self):
+        execute("echo oops >&2", self.chunks.append)
+        self.assert_equal(u"oops\n", u"".join(self.chunks))
+
+    def test_output_is_chunked(self):
+        execute("seq 1 20000", self.chunks.append, flush_size=1024)
+        self.assertTrue(len(self.chunks) > 1)
+        for chunk in self.chunks:
+            self.assertTrue(len(chunk) < 1024 + 4096)
+        expected = "".join(["%s\n" % i for i in range(1, 20001)])
+        self.assert_equal(expected, u"".join(self.chunks))
+
+    def test_output_is_sent_while_running(self):
+        execute("echo first; sleep 1; echo second", self.chunks.append,
+            flush_interval=0.2)
+        self.assert_equal([u"first\n", u"second\n"], self.chunks)
+
+    def test_split_characters_are_decoded(self):
+        # a two byte character split across the flush
+        execute("printf 'a\\303'; sleep 1; printf '\\251b'", 
+            self.chunks.append, flush_interval=0.2)
+        self.assert_equal(u"a\xe9b", u"".join(self.chunks))
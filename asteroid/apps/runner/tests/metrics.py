@@ -0,0 +1,159 @@
+from test_extensions.django_common import DjangoCommon
+
+from runner import metrics, background, publisher
+from runner.background import BackgroundExecutor
+from runner.metrics import Registry, Counter, Gauge, Histogram
+from runner.models import Run, Command
+from runner.tests.publisher import FakeBroker
+
+class RegistryTests(DjangoCommon):
+    "Tests for keeping metrics and exposing them in the text format"
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.register(Counter("things_total",
+            "Things", ["kind"]))
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        counter.inc(kind="b")
+        self.assert_equal(3, counter.value(kind="a"))
+        self.assert_equal("# HELP things_total Things\n"
+            "# TYPE things_total counter\n"
+            'things_total{kind="a"} 3\n'
+            'things_total{kind="b"} 1\n', self.registry.expose())
+
+    def test_labels_must_match(self):
+        counter = Counter("things_total", "Things", ["kind"])
+        self.assert_raises(ValueError, counter.inc)
+        self.assert_raises(ValueError, counter.inc, kind="a", other="b")
+
+    def test_label_values_are_escaped(self):
+        counter = Counter("things_total", "Things", ["kind"])
+        counter.inc(kind='say "hi"\n')
+        self.assert_equal('things_total{kind="say \\"hi\\"\\n"} 1',
+            counter.expose().split("\n")[-1])
+
+    def test_histogram(self):
+        histogram = self.registry.register(Histogram("took_seconds", "Took",
+            buckets=[1, 5]))
+        for value in (0.5, 2, 3, 10):
+            histogram.observe(value)
+        self.assert_equal(4, histogram.count())
+        self.assert_equal(15.5, histogram.sum())
+        self.assert_equal([
+            'took_seconds_bucket{le="1"} 1',
+            'took_seconds_bucket{le="5"} 3',
+            'took_seconds_bucket{le="+Inf"} 4',
+            'took_seconds_sum 15.5',
+            'took_seconds_count 4',
+        ], self.registry.expose().strip().split("\n")[2:])
+
+    def test_timer(self):
+        histogram = Histogram("took_seconds", "Took", ["view"])
+        elapsed = histogram.time(view="a").stop()
+        self.assert_equal(1, histogram.count(view="a"))
+        self.assert_equal(elapsed, histogram.sum(view="a"))
+
+    def test_gauge(self):
+        gauge = Gauge("running", "Running")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assert_equal(1, gauge.value())
+        waiting = Gauge("waiting", "Waiting", function=lambda: 7)
+        self.assert_equal("waiting 7", waiting.expose().split("\n")[-1])
+
+    def test_registering_again_returns_the_metric(self):
+        counter = self.registry.register(Counter("things_total", "Things"))
+        self.assert_equal(counter, self.registry.register(
+            Counter("things_total", "Things")))
+        self.assert_raises(ValueError, self.registry.register,
+            Gauge("things_total", "Things"))
+
+    def test_reset(self):
+        counter = self.registry.register(Counter("things_total", "Things"))
+        counter.inc()
+        self.registry.reset()
+        self.assert_equal(0, counter.value())
+
+class InstrumentationTests(DjangoCommon):
+    "Tests for the metrics kept by the web tier"
+
+    def setUp(self):
+        metrics.REGISTRY.reset()
+        self.command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "echo hello",
+        )
+
+    def test_queries_are_timed(self):
+        count, seconds = metrics.query_time()
+        queries = metrics.QUERIES.value()
+        list(Command.objects.all())
+        self.assert_equal(count + 1, metrics.query_time()[0])
+        self.assert_equal(queries + 1, metrics.QUERIES.value())
+        self.assert_equal(queries + 1, metrics.QUERY_SECONDS.count())
+
+    def test_views_are_timed(self):
+        response = self.client.get('/')
+        self.assert_code(response, 200)
+        self.assert_equal(1, metrics.VIEW_SECONDS.count(view="dashboard"))
+        self.assert_equal(1, metrics.VIEW_QUERIES.count(view="dashboard"))
+        self.assertTrue(metrics.VIEW_QUERIES.sum(view="dashboard") > 0)
+
+    def test_finished_runs_are_counted(self):
+        self.command.run()
+        self.assert_equal(1, metrics.REGISTRY.get(
+            "asteroid_runs_finished_total").value(status="succeeded"))
+        self.assert_equal(1, metrics.REGISTRY.get(
+            "asteroid_run_seconds").count())
+
+    def test_webhook_results_are_counted(self):
+        run = self.command.create_run()
+        response = self.client.post('%s/hook/' % run.get_absolute_url(),
+            '{"status": 0, "output": "done"}', content_type='application/json')
+        self.assert_code(response, 200)
+        response = self.client.post('%s/hook/' % run.get_absolute_url(),
+            '{"status": 0, "output": "done"}', content_type='application/json')
+        self.assert_code(response, 200)
+        response = self.client.post('%s/hook/' % run.get_absolute_url(),
+            '{"started": true}', content_type='application/json')
+        self.assert_code(response, 400)
+        results = metrics.REGISTRY.get("asteroid_webhook_results_total")
+        self.assert_equal(1, results.value(outcome="ok"))
+        self.assert_equal(1, results.value(outcome="already_finished"))
+        self.assert_equal(1, results.value(outcome="not_in_progress"))
+        self.assert_equal(3, metrics.VIEW_SECONDS.count(view="run_web_hook"))
+
+    def test_publishing_is_timed(self):
+        amqp = publisher.amqp
+        publisher.amqp = FakeBroker()
+        try:
+            publisher.Publisher("localhost").publish("hello", "linux")
+        finally:
+            publisher.amqp = amqp
+        self.assert_equal(1, publisher.PUBLISH_SECONDS.count(target="linux"))
+
+    def test_background_jobs_are_timed(self):
+        executor = BackgroundExecutor(1, 1)
+        try:
+            executor.submit(lambda: None)
+            executor.wait()
+        finally:
+            executor.shutdown()
+        self.assert_equal(1, background.WAIT_SECONDS.count())
+        self.assert_equal(1, background.JOB_SECONDS.count())
+        self.assert_equal(0, background.JOBS_RUNNING.value())
+
+    def test_metrics_page(self):
+        self.command.run()
+        response = self.client.get('/metrics')
+        self.assert_code(response, 200)
+        self.assert_equal(metrics.CONTENT_TYPE, response['Content-Type'])
+        self.assert_response_contains(
+            'asteroid_runs_finished_total{status="succeeded"} 1', response)
+        self.assert_response_contains("# TYPE asteroid_run_seconds histogram",
+            response)
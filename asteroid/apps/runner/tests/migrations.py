@@ -0,0 +1,150 @@
+from test_extensions.django_common import DjangoCommon
+
+from django.conf import settings
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase
+
+from runner.models import Run, Command, Migration
+from runner.migrations import MIGRATIONS, migrate, pending_migrations, \
+    index_exists, table_columns, output_chunks, create_index, drop_index
+from runner.pagination import paginate
+
+class RecordingCursor(object):
+    "Wraps a database cursor, keeping the sql and parameters it executes"
+
+    def __init__(self, cursor, queries):
+        self.cursor = cursor
+        self.queries = queries
+
+    def execute(self, sql, params=()):
+        self.queries.append((sql, params))
+        return self.cursor.execute(sql, params)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+class MigrationTests(DjangoCommon):
+    """
+    Tests for the schema migrations. Looking at the schema on sqlite commits
+    the transaction tests are normally wrapped in, so these tests flush the
+    database before and after instead.
+    """
+
+    def _fixture_setup(self):
+        TransactionTestCase._fixture_setup.im_func(self)
+
+    def _fixture_teardown(self):
+        call_command('flush', verbosity=0, interactive=False)
+
+    def setUp(self):
+        command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "ls",
+        )
+        for i in range(15):
+            run = Run.objects.create(
+                command = command,
+                command_run = command.command_to_run,
+            )
+        self.run = run
+        self.command = command
+
+    def test_migrations_applied_by_syncdb(self):
+        self.assert_equal([], pending_migrations())
+        self.assert_count(len(MIGRATIONS), Migration)
+
+    def test_migrations_can_be_run_again(self):
+        Migration.objects.all().delete()
+        migrate(verbosity=0)
+        self.assert_equal([], pending_migrations())
+
+    def test_indexes_created(self):
+        for name in ('runner_run_updated', 'runner_run_command_updated',
+                'runner_run_status_updated'):
+            self.assertTrue(index_exists('runner_run', name))
+
+    def test_indexes_on_databases_we_cant_ask(self):
+        engine = settings.DATABASE_ENGINE
+        settings.DATABASE_ENGINE = 'oracle'
+        try:
+            self.assert_equal(None, index_exists('runner_run',
+                'runner_run_updated'))
+            self.assertFalse(create_index(Run, 'runner_run_updated',
+                ['updated_date', 'id']))
+            self.assertTrue(create_index(Run, 'runner_run_test', ['status']))
+            self.assertTrue(drop_index(Run, 'runner_run_test'))
+            self.assertFalse(drop_index(Run, 'runner_run_test'))
+        finally:
+            settings.DATABASE_ENGINE = engine
+        self.assertFalse(index_exists('runner_run', 'runner_run_test'))
+
+    def test_output_moved_into_chunks(self):
+        cursor = connection.cursor()
+        if 'output' not in table_columns('runner_run'):
+            cursor.execute("ALTER TABLE runner_run ADD COLUMN output text NULL")
+        cursor.execute("UPDATE runner_run SET output = %s WHERE id = %s",
+            ["x" * 100000, self.run.id])
+        output_chunks()
+        run = Run.objects.get(id=self.run.id)
+        self.assert_equal(100000, run.output_length)
+        self.assert_equal(2, run.chunks.count())
+        self.deny_contains("", run.chunks.values_list('encoding', flat=True))
+        self.assert_equal("x" * 100000, run.read_output())
+        cursor.execute("SELECT COUNT(*) FROM runner_run WHERE output IS NOT NULL")
+        self.assert_equal(0, cursor.fetchone()[0])
+
+    def query_plans(self, url):
+        "request a url and return the query plans for its queries on runs"
+        queries = []
+        cursor = connection.cursor
+        connection.cursor = lambda: RecordingCursor(cursor(), queries)
+        try:
+            self.client.get(url)
+        finally:
+            del connection.cursor
+        plans = []
+        for sql, params in queries:
+            if 'runner_run' not in sql:
+                continue
+            explain = connection.cursor()
+            explain.execute("EXPLAIN QUERY PLAN %s" % sql, params)
+            plans.append((sql, [row[-1] for row in explain.fetchall()]))
+        return plans
+
+    def assert_uses_indexes(self, url):
+        """
+        each query on the runs table should be answered from an index, and
+        pages of runs should come out of the index in order
+        """
+        if settings.DATABASE_ENGINE != 'sqlite3':
+            return
+        plans = self.query_plans(url)
+        self.assertTrue(plans)
+        for sql, plan in plans:
+            for step in plan:
+                if 'runner_run' in step:
+                    self.assert_contains('USING', step, sql)
+                if 'LIMIT' in sql:
+                    self.deny_contains('TEMP B-TREE FOR ORDER BY', step)
+
+    def test_dashboard_uses_indexes(self):
+        self.assert_uses_indexes('/')
+
+    def test_runs_use_indexes(self):
+        self.assert_uses_indexes('/runs/')
+
+    def test_runs_page_uses_indexes(self):
+        page = paginate(Run.objects.all())
+        self.assert_uses_indexes('/runs/?after=%s' % page.next_token)
+
+    def test_command_uses_indexes(self):
+        self.assert_uses_indexes('/commands/test/')
+
+    def test_run_uses_indexes(self):
+        self.assert_uses_indexes(self.run.get_absolute_url() + '/')
+
+    def test_status_filter_uses_indexes(self):
+        self.login_as_admin()
+        self.assert_uses_indexes('/admin/runner/run/?status__exact=failed')
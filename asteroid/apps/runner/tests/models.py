@@ -1,8 +1,12 @@
 from test_extensions.django_common import DjangoCommon
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
-from runner.models import Run, Command
+from django.core.management import call_command
+
+from runner.models import Run, Command, OutputChunk, RunRejected, \
+    trigger_many
+from runner.compression import COMPACT_SIZE
 
 class RunTests(DjangoCommon):
     "Tests for the Run model"
@@ -33,7 +37,85 @@ class RunTests(DjangoCommon):
     def test_string_method_when_not_in_progress(self):
         self.run.status = "succeeded"
         self.assert_equal("test succeeded on %s" % datetime.now().strftime("%a %B %Y at %H:%M"), str(self.run))
-        
+
+    def test_read_output_across_chunks(self):
+        for piece in ("abc", "def", "ghi"):
+            self.run.append_output(piece)
+        run = Run.objects.get(id=self.run.id)
+        self.assert_equal(9, run.output_length)
+        self.assert_count(3, OutputChunk)
+        self.assert_equal("abcdefghi", run.read_output())
+        self.assert_equal("cdefg", run.read_output(2, 7))
+        self.assert_equal("def", run.read_output(3, 6))
+        self.assert_equal("", run.read_output(9))
+
+    def test_tail_output(self):
+        for piece in ("abc", "def", "ghi"):
+            self.run.append_output(piece)
+        self.assert_equal((5, "fghi"), self.run.tail_output(4))
+        self.assert_equal((0, "abcdefghi"), self.run.tail_output(100))
+
+    def test_set_output(self):
+        self.run.append_output("abc")
+        self.run.set_output("xyz")
+        self.assert_equal("xyz", Run.objects.get(id=self.run.id).read_output())
+        self.assert_count(1, OutputChunk)
+
+    def test_set_output_is_chunked(self):
+        output = u"".join([u"line %s\n" % i for i in range(20000)])
+        self.run.set_output(output)
+        run = Run.objects.get(id=self.run.id)
+        self.assert_equal(len(output), run.output_length)
+        self.assert_equal(range(0, len(output), COMPACT_SIZE),
+            list(run.chunks.order_by('offset').values_list('offset',
+            flat=True)))
+        self.assert_equal(output, run.read_output())
+        self.assert_equal(output[-10:], run.tail_output(10)[1])
+
+    def test_iter_output(self):
+        pieces = [u"line %s\n" % i for i in range(45)]
+        for piece in pieces:
+            self.run.append_output(piece)
+        self.assert_equal(pieces, list(Run.objects.get(
+            id=self.run.id).iter_output()))
+
+    def test_large_output_is_compressed(self):
+        self.run.append_output(u"building \xe9\n" * 1000)
+        chunk = OutputChunk.objects.get(run=self.run)
+        self.assertNotEqual("", chunk.encoding)
+        self.assertTrue(len(chunk.data) < 1000)
+        self.assert_equal(12000, chunk.original_size)
+        run = Run.objects.get(id=self.run.id)
+        self.assert_equal(u"building \xe9\n" * 1000, run.read_output())
+        self.assert_equal(u"\xe9\nbui", run.read_output(9, 14))
+
+    def test_small_output_is_not_compressed(self):
+        self.run.append_output("abc")
+        chunk = OutputChunk.objects.get(run=self.run)
+        self.assert_equal("", chunk.encoding)
+        self.assert_equal("abc", chunk.data)
+
+    def test_compact_output(self):
+        for i in range(200):
+            self.run.append_output("line %s\n" % i)
+        self.run.finish(0)
+        expected = "".join(["line %s\n" % i for i in range(200)])
+        self.assert_equal(1, self.run.compact_output())
+        chunk = OutputChunk.objects.get(run=self.run)
+        self.assert_equal(0, chunk.offset)
+        self.assertNotEqual("", chunk.encoding)
+        self.assert_equal(expected, Run.objects.get(id=self.run.id).read_output())
+        # there's nothing more to do the second time round
+        self.assert_equal(0, self.run.compact_output())
+
+    def test_compress_output_command(self):
+        from django.core.management import call_command
+        for i in range(200):
+            self.run.append_output("line %s\n" % i)
+        self.run.finish(0)
+        call_command('compress_output', verbosity=0)
+        self.assert_count(1, OutputChunk)
+        self.assert_equal("line 199\n", Run.objects.get(id=self.run.id).tail_output(9)[1])
 
 class CommandTests(DjangoCommon):
     "Tests for the Command model"
@@ -71,6 +153,16 @@ class CommandTests(DjangoCommon):
         self.command.run()
         self.assert_equal("succeeded", self.command.status())
 
+    def test_run_stores_output(self):
+        self.command.command_to_run = "echo hello"
+        run = self.command.run()
+        self.assert_equal("hello\n", Run.objects.get(id=run.id).read_output())
+
+    def test_append_output(self):
+        self.run.append_output("one ")
+        self.run.append_output("two")
+        self.assert_equal("one two", Run.objects.get(id=self.run.id).read_output())
+
     def test_run_that_fails(self):
         self.command.command_to_run = "return 2"
         self.command.run()
@@ -79,5 +171,177 @@ class CommandTests(DjangoCommon):
     def test_get_absolute_url(self):
         self.assert_equal("/commands/test/", self.command.get_absolute_url())
 
+    def test_status_stored_on_command(self):
+        self.command.run()
+        command = Command.objects.get(id=self.command.id)
+        self.assert_equal("succeeded", command.last_run_status)
+        self.assert_equal(Run.objects.all()[0].id, command.last_run_id)
+
+    def test_deleting_latest_run_falls_back_to_previous(self):
+        latest = self.command.run()
+        latest.delete()
+        command = Command.objects.get(id=self.command.id)
+        self.assert_equal("in_progress", command.status())
+        self.assert_equal(self.run.id, command.last_run_id)
+
+    def test_backfill_last_runs(self):
+        from django.core.management import call_command
+        Command.objects.update(last_run_id=None, last_run_status=None)
+        self.assert_equal("not run yet", Command.objects.get(id=self.command.id).status())
+        call_command('backfill_last_runs', verbosity=0)
+        self.assert_equal("in_progress", Command.objects.get(id=self.command.id).status())
+
     def test_run_link(self):
         self.assert_equal('<a href="/commands/test/run">Run command</a>', self.command.run_link())
+
+class ConcurrencyTests(DjangoCommon):
+    "Tests for what happens when a command is run while it's running"
+
+    def setUp(self):
+        self.command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "echo hello",
+        )
+        # a run which hasn't finished yet
+        self.running = self.command.create_run()
+
+    def policy(self, concurrency, max_concurrent=None):
+        self.command.concurrency = concurrency
+        self.command.max_concurrent = max_concurrent
+        self.command.save()
+
+    def test_overlapping_runs_are_allowed_by_default(self):
+        run = self.command.trigger()
+        self.assert_equal("succeeded", run.status)
+        self.assert_counts([2], [Run])
+
+    def test_run_is_queued(self):
+        self.policy("queue")
+        run = self.command.trigger()
+        self.assert_equal("queued", run.status)
+        self.assert_equal("", Run.objects.get(id=run.id).read_output())
+        # and started once the earlier run finishes
+        self.running.finish(0)
+        run = Run.objects.get(id=run.id)
+        self.assert_equal("succeeded", run.status)
+        self.assert_equal("hello\n", run.read_output())
+
+    def test_queued_runs_start_in_order(self):
+        self.policy("queue")
+        first = self.command.trigger()
+        second = self.command.trigger()
+        self.assert_equal(["queued", "queued"], [Run.objects.get(
+            id=run.id).status for run in (first, second)])
+        # make room without starting anything
+        Run.objects.filter(id=self.running.id).update(status="failed")
+        self.assert_equal([first.id], [run.id for run in
+            self.command.promote_queued()])
+        self.assert_equal(["in_progress", "queued"], [Run.objects.get(
+            id=run.id).status for run in (first, second)])
+
+    def test_queued_runs_start_when_policy_changes(self):
+        self.policy("queue")
+        queued = self.command.trigger()
+        self.policy("allow")
+        self.assert_equal("succeeded", Run.objects.get(id=queued.id).status)
+        self.assert_equal("succeeded", self.command.trigger().status)
+
+    def test_queued_runs_start_under_another_policy(self):
+        self.policy("queue")
+        queued = self.command.trigger()
+        # as if the policy was changed without saving the command
+        self.command.concurrency = "reject"
+        self.running.finish(0)
+        self.assert_equal("succeeded", Run.objects.get(id=queued.id).status)
+        self.assert_equal("succeeded", self.command.trigger().status)
+
+    def test_run_is_coalesced(self):
+        self.policy("coalesce")
+        run = self.command.trigger()
+        self.assert_equal(self.running.id, run.id)
+        self.assert_counts([1], [Run])
+
+    def test_run_is_rejected(self):
+        self.policy("reject")
+        self.assert_raises(RunRejected, self.command.trigger)
+        self.assert_counts([1], [Run])
+        response = self.client.get('/commands/test/run/')
+        self.assert_code(response, 409)
+
+    def test_max_concurrent(self):
+        self.policy("reject", 2)
+        other = self.command.create_run()
+        self.assert_raises(RunRejected, self.command.trigger)
+        other.finish(0)
+        self.assert_equal("succeeded", self.command.trigger().status)
+
+    def test_policy_applies_once_running_run_finishes(self):
+        self.policy("reject")
+        self.running.finish(0)
+        self.assert_equal("succeeded", self.command.trigger().status)
+
+    def test_trigger_many(self):
+        self.policy("reject")
+        other = Command.objects.create(title="other", slug="other",
+            command_to_run="true")
+        runs = trigger_many([self.command, other, other])
+        self.assert_equal(None, runs[0])
+        self.assert_equal(["succeeded", "succeeded"],
+            [run.status for run in runs[1:]])
+        self.assert_counts([3], [Run])
+
+class StaleRunTests(DjangoCommon):
+    "Tests for failing runs which have been lost"
+
+    def setUp(self):
+        self.command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "echo hello",
+        )
+        self.lost = self.command.create_run()
+        Run.objects.filter(id=self.lost.id).update(
+            heartbeat=datetime.today() - timedelta(hours=30))
+        self.running = self.command.create_run()
+        self.running.mark_started()
+
+    def test_stale_runs(self):
+        self.assert_equal([self.lost.id],
+            [run.id for run in Run.objects.stale(24)])
+        self.assert_equal([], list(Run.objects.stale(48)))
+
+    def test_output_keeps_runs_alive(self):
+        self.lost.append_output("still going")
+        self.assert_equal([], list(Run.objects.stale(24)))
+
+    def test_runs_which_never_started_count_from_creation(self):
+        waiting = self.command.create_run()
+        self.deny_contains(waiting.id,
+            [run.id for run in Run.objects.stale(24)])
+        Run.objects.filter(id=waiting.id).update(
+            created_date=datetime.today() - timedelta(hours=30))
+        self.assert_contains(waiting.id,
+            [run.id for run in Run.objects.stale(24)])
+
+    def test_reap_runs_command(self):
+        call_command('reap_runs', hours=24, verbosity=0)
+        run = Run.objects.get(id=self.lost.id)
+        self.assert_equal("failed", run.status)
+        self.assertTrue("Failed by reap_runs" in run.read_output())
+        self.assert_equal("in_progress",
+            Run.objects.get(id=self.running.id).status)
+
+    def test_reaping_starts_queued_runs(self):
+        self.command.concurrency = "queue"
+        self.command.max_concurrent = 2
+        self.command.save()
+        queued = self.command.trigger()
+        self.assert_equal("queued", queued.status)
+        call_command('reap_runs', hours=24, verbosity=0)
+        self.assert_equal("succeeded", Run.objects.get(id=queued.id).status)
+
+    def test_dry_run_changes_nothing(self):
+        call_command('reap_runs', hours=24, dry_run=True, verbosity=0)
+        self.assert_equal("in_progress",
+            Run.objects.get(id=self.lost.id).status)
@@ -0,0 +1,78 @@
+from test_extensions.django_common import DjangoCommon
+
+from runner.models import Run, Command
+from runner.pagination import paginate, encode_token, decode_token, \
+    InvalidToken
+
+class PaginationTests(DjangoCommon):
+    "Tests for the keyset pagination of runs"
+
+    def setUp(self):
+        self.command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "ls",
+        )
+        for i in range(25):
+            Run.objects.create(
+                command = self.command,
+                command_run = self.command.command_to_run,
+            )
+        self.assert_counts([25, 1], [Run, Command])
+
+    def test_token_round_trip(self):
+        run = Run.objects.all()[0]
+        self.assert_equal((run.updated_date, run.id), 
+            decode_token(encode_token(run)))
+
+    def test_invalid_token(self):
+        self.assert_raises(InvalidToken, decode_token, "not-a-token")
+
+    def test_first_page(self):
+        page = paginate(Run.objects.all())
+        self.assert_equal(10, len(page))
+        self.assert_equal(list(Run.objects.all()[:10]), page.object_list)
+        self.assertTrue(page.has_next())
+        self.assertFalse(page.has_previous())
+
+    def test_walking_forwards_visits_every_run_once(self):
+        page = paginate(Run.objects.all())
+        seen = list(page.object_list)
+        while page.has_next():
+            page = paginate(Run.objects.all(), after=page.next_token)
+            seen.extend(page.object_list)
+        self.assert_equal(list(Run.objects.all()), seen)
+        self.assert_equal(5, len(page))
+
+    def test_walking_backwards(self):
+        first = paginate(Run.objects.all())
+        second = paginate(Run.objects.all(), after=first.next_token)
+        third = paginate(Run.objects.all(), after=second.next_token)
+        back = paginate(Run.objects.all(), before=third.previous_token)
+        self.assert_equal(second.object_list, back.object_list)
+        back = paginate(Run.objects.all(), before=back.previous_token)
+        self.assert_equal(first.object_list, back.object_list)
+        self.assertFalse(back.has_previous())
+
+    def test_dates_are_read_exactly(self):
+        # read through a float this comes back as 248 microseconds
+        date = Run.objects.all()[0].updated_date.replace(microsecond=249)
+        Run.objects.update(updated_date=date)
+        self.assert_equal(date, Run.objects.all()[0].updated_date)
+        page = paginate(Run.objects.all())
+        page = paginate(Run.objects.all(), after=page.next_token)
+        self.assert_equal(list(Run.objects.all()[10:20]), page.object_list)
+
+    def test_views_accept_tokens(self):
+        page = paginate(Run.objects.all())
+        response = self.client.get('/runs/?after=%s' % page.next_token)
+        self.assert_code(response, 200)
+        self.assert_response_contains('?before=', response)
+        response = self.client.get('/commands/test/?after=%s' % page.next_token)
+        self.assert_code(response, 200)
+
+    def test_views_ignore_broken_tokens(self):
+        response = self.client.get('/runs/?after=broken')
+        self.assert_code(response, 200)
+        response = self.client.get('/commands/test/?before=broken')
+        self.assert_code(response, 200)
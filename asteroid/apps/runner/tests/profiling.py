@@ -0,0 +1,115 @@
+from test_extensions.django_common import DjangoCommon
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpRequest, HttpResponse
+
+from runner import profiling
+from runner.models import Command
+from runner.profiling import ProfilingMiddleware, ProfileBuffer, Profile
+
+def profile(view, seconds, duplicates=()):
+    return Profile("/", "GET", view, 200, seconds, 1, 0.0, 0.0, 10,
+        list(duplicates))
+
+class ProfilingTests(DjangoCommon):
+    "Tests for profiling a sample of requests"
+
+    def setUp(self):
+        self.rate = settings.PROFILING_SAMPLE_RATE
+        settings.PROFILING_SAMPLE_RATE = 1
+        profiling.get_buffer().clear()
+        Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "echo hello",
+        )
+
+    def tearDown(self):
+        settings.PROFILING_SAMPLE_RATE = self.rate
+        profiling.get_buffer().clear()
+
+    def test_not_used_unless_sampling(self):
+        self.assert_raises(MiddlewareNotUsed, ProfilingMiddleware, 0)
+
+    def test_requests_are_profiled(self):
+        response = self.client.get('/commands/')
+        self.assert_code(response, 200)
+        found = profiling.get_buffer().profiles()
+        self.assert_equal(1, len(found))
+        self.assert_equal("runner.views.list_commands", found[0].view)
+        self.assert_equal(200, found[0].status)
+        self.assert_equal(len(response.content), found[0].size)
+        self.assertTrue(found[0].queries > 0)
+        self.assertTrue(found[0].template_seconds > 0)
+        self.assertTrue(found[0].seconds >= found[0].template_seconds)
+
+    def test_unsampled_requests_are_left_alone(self):
+        middleware = ProfilingMiddleware(0.5, ProfileBuffer(10))
+        random = profiling.random.random
+        profiling.random.random = lambda: 0.7
+        try:
+            request = HttpRequest()
+            middleware.process_request(request)
+            middleware.process_response(request, HttpResponse("hello"))
+        finally:
+            profiling.random.random = random
+        self.assert_equal([], middleware.buffer.profiles())
+
+    def test_duplicated_queries(self):
+        middleware = ProfilingMiddleware(1, ProfileBuffer(10))
+        request = HttpRequest()
+        middleware.process_request(request)
+        for i in range(3):
+            Command.objects.get(slug="test")
+        list(Command.objects.all())
+        middleware.process_response(request, HttpResponse("hello"))
+        found = middleware.buffer.profiles()[0]
+        self.assert_equal(4, found.queries)
+        self.assert_equal(1, len(found.duplicates))
+        sql, count, seconds = found.duplicates[0]
+        self.assert_equal(3, count)
+        self.assertTrue(sql.startswith("SELECT"))
+
+    def test_buffer_keeps_the_latest(self):
+        buffer = ProfileBuffer(3)
+        for i in range(5):
+            buffer.add(profile("view%s" % i, 0.1))
+        self.assert_equal(["view4", "view3", "view2"],
+            [found.view for found in buffer.profiles()])
+
+    def test_slowest_views(self):
+        views = profiling.slowest_views([profile("fast", 0.1),
+            profile("slow", 0.5), profile("slow", 0.3)])
+        self.assert_equal(["slow", "fast"], [view['view'] for view in views])
+        self.assert_equal(2, views[0]['requests'])
+        self.assert_equal(0.5, views[0]['max_seconds'])
+
+    def test_duplicated_queries_across_requests(self):
+        queries = profiling.duplicated_queries([
+            profile("one", 0.1, [("SELECT a", 3, 0.1)]),
+            profile("two", 0.1, [("SELECT a", 5, 0.1), ("SELECT b", 2, 0.1)]),
+        ])
+        self.assert_equal(["SELECT a", "SELECT b"],
+            [query['sql'] for query in queries])
+        self.assert_equal(8, queries[0]['repeats'])
+        self.assert_equal(5, queries[0]['most'])
+        self.assert_equal(["one", "two"], queries[0]['views'])
+
+    def test_profiles_page_is_for_staff(self):
+        response = self.client.get('/admin/profiling/')
+        self.assert_response_contains('Log in', response)
+        self.login_as_admin()
+        self.client.get('/commands/')
+        response = self.client.get('/admin/profiling/')
+        self.assert_code(response, 200)
+        self.assert_response_contains('runner.views.list_commands', response)
+
+    def test_profiles_can_be_cleared(self):
+        self.login_as_admin()
+        self.client.get('/commands/')
+        response = self.client.post('/admin/profiling/')
+        self.assert_code(response, 302)
+        # only the request which cleared them is left
+        self.assert_equal(["runner.profiling.show_profiles"],
+            [found.view for found in profiling.get_buffer().profiles()])
@@ -0,0 +1,154 @@
+from test_extensions.django_common import DjangoCommon
+
+import socket
+
+from runner import publisher
+from runner.publisher import Publisher
+
+class FakeChannel(object):
+    "Records what's done with a channel"
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def exchange_declare(self, **kwargs):
+        self.broker.declared += 1
+
+    def queue_declare(self, queue, passive):
+        if queue not in self.broker.queues:
+            raise self.broker.AMQPChannelException(404, "NOT_FOUND",
+                (50, 10))
+        return (queue,) + self.broker.queues[queue]
+
+    def basic_publish(self, msg, exchange, routing_key):
+        if self.broker.fail:
+            self.broker.fail -= 1
+            raise socket.error("connection reset")
+        self.broker.published.append((msg.body, exchange, routing_key))
+
+    def close(self):
+        pass
+
+class FakeBroker(object):
+    "Stands in for the amqp module, counting connections and messages"
+
+    def __init__(self):
+        self.connections = 0
+        self.declared = 0
+        self.fail = 0
+        self.published = []
+        self.queues = {}
+        self.AMQPException = Exception
+        class AMQPChannelException(Exception):
+            def __init__(self, reply_code, reply_text, method_sig):
+                Exception.__init__(self)
+                self.amqp_reply_code = reply_code
+        self.AMQPChannelException = AMQPChannelException
+
+    def Connection(self, host):
+        self.connections += 1
+        broker = self
+        class Connection(object):
+            def channel(self):
+                return FakeChannel(broker)
+            def close(self):
+                pass
+        return Connection()
+
+    def Message(self, body, **properties):
+        class Message(object):
+            pass
+        msg = Message()
+        msg.body = body
+        msg.properties = properties
+        self.properties = properties
+        return msg
+
+class PublisherTests(DjangoCommon):
+    "Tests for publishing runs to the message queue"
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.amqp = publisher.amqp
+        publisher.amqp = self.broker
+        self.publisher = Publisher("localhost")
+
+    def tearDown(self):
+        publisher.amqp = self.amqp
+
+    def test_publish(self):
+        self.publisher.publish("hello")
+        self.assert_equal([("hello", "asteroid", "all")], self.broker.published)
+
+    def test_messages_are_persistent(self):
+        self.publisher.publish("hello")
+        self.assert_equal(publisher.PERSISTENT,
+            self.broker.properties['delivery_mode'])
+
+    def test_connection_is_reused(self):
+        for i in range(5):
+            self.publisher.publish("hello")
+        self.assert_equal(1, self.broker.connections)
+        self.assert_equal(1, self.broker.declared)
+        self.assert_equal(5, len(self.broker.published))
+
+    def test_reconnects_after_failure(self):
+        self.publisher.publish("one")
+        self.broker.fail = 1
+        self.publisher.publish("two")
+        self.assert_equal(2, self.broker.connections)
+        self.assert_equal(2, self.broker.declared)
+        self.assert_equal(["one", "two"], 
+            [body for body, exchange, key in self.broker.published])
+
+    def test_gives_up_after_second_failure(self):
+        self.broker.fail = 2
+        self.assert_raises(socket.error, self.publisher.publish, "hello")
+        self.publisher.publish("hello")
+        self.assert_equal(1, len(self.broker.published))
+
+    def test_publish_many(self):
+        self.publisher.publish_many(["one", "two", "three"])
+        self.assert_equal(1, self.broker.connections)
+        self.assert_equal(["one", "two", "three"],
+            [body for body, exchange, key in self.broker.published])
+
+    def test_publish_many_carries_on_after_failure(self):
+        self.publisher.publish("one")
+        self.broker.fail = 1
+        self.publisher.publish_many(["two", "three"])
+        self.assert_equal(2, self.broker.connections)
+        self.assert_equal(["one", "two", "three"],
+            [body for body, exchange, key in self.broker.published])
+
+    def test_publish_many_says_how_many_were_sent(self):
+        self.broker.fail = 2
+        try:
+            self.publisher.publish_many(["one", "two"])
+        except socket.error, e:
+            self.assert_equal(0, e.sent)
+        else:
+            self.fail("publish_many should have given up")
+
+    def test_publish_to_target(self):
+        self.publisher.publish("hello", routing_key="linux")
+        self.assert_equal([("hello", "asteroid", "linux")],
+            self.broker.published)
+
+    def test_queue_names(self):
+        self.assert_equal("asteroid_queue", publisher.queue_name("all"))
+        self.assert_equal("asteroid_linux", publisher.queue_name("linux"))
+
+    def test_queue_depths(self):
+        self.broker.queues = {
+            "asteroid_queue": (3, 2),
+            "asteroid_linux": (0, 1),
+        }
+        depths = self.publisher.queue_depths(["all", "deploy", "linux"])
+        self.assert_equal({"all": (3, 2), "deploy": None, "linux": (0, 1)},
+            depths)
+        # a missing queue only costs us the channel
+        self.assert_equal(1, self.broker.connections)
+
+    def test_one_publisher_per_process(self):
+        self.assertTrue(publisher.get_publisher() is publisher.get_publisher())
@@ -0,0 +1,103 @@
+import gzip
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+
+from test_extensions.django_common import DjangoCommon
+
+from django.core.management import call_command
+from django.utils import simplejson
+
+from runner.models import Run, Command, OutputChunk
+from runner.retention import prune_command, archive_path
+
+class RetentionTests(DjangoCommon):
+    "Tests for pruning old runs"
+
+    def setUp(self):
+        self.command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "ls",
+        )
+        # ten runs a day apart, the oldest first, alternately failing
+        self.now = datetime.today()
+        for i in range(10):
+            run = Run.objects.create(
+                command = self.command,
+                command_run = self.command.command_to_run,
+            )
+            run.append_output("run %s" % i)
+            run.finish(i % 2)
+            Run.objects.filter(id=run.id).update(
+                updated_date = self.now - timedelta(days=10 - i))
+        self.archive_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.archive_dir)
+
+    def expired(self, **policy):
+        for name, value in policy.items():
+            setattr(self.command, name, value)
+        runs = self.command.expired_runs(self.now).order_by('id')
+        return list(runs.values_list('id', flat=True))
+
+    def test_nothing_expires_without_a_policy(self):
+        self.assert_equal([], self.expired())
+        self.assert_equal([], self.expired(keep_failures=True))
+
+    def test_keep_runs(self):
+        self.assert_equal([1, 2, 3, 4, 5, 6, 7], self.expired(keep_runs=3))
+        self.assert_equal([], self.expired(keep_runs=10))
+
+    def test_keep_days(self):
+        self.assert_equal([1, 2, 3, 4, 5, 6], self.expired(keep_days=4))
+
+    def test_keep_runs_and_days(self):
+        self.assert_equal([1, 2, 3, 4, 5, 6], self.expired(keep_runs=3,
+            keep_days=4))
+
+    def test_keep_failures(self):
+        self.assert_equal([1, 3, 5, 7], self.expired(keep_runs=3,
+            keep_failures=True))
+
+    def test_in_progress_runs_are_kept(self):
+        Run.objects.filter(id=1).update(status="in_progress")
+        self.assert_equal([2, 3, 4, 5, 6, 7], self.expired(keep_runs=3))
+
+    def test_prune_archives_and_deletes(self):
+        self.command.keep_runs = 3
+        self.assert_equal(7, prune_command(self.command, self.archive_dir,
+            batch_size=3, now=self.now))
+        self.assert_equal([8, 9, 10],
+            sorted(Run.objects.values_list('id', flat=True)))
+        self.assert_count(3, OutputChunk)
+        path = archive_path(self.archive_dir, self.command, self.now)
+        records = [simplejson.loads(line) for line in gzip.open(path)]
+        self.assert_equal(range(1, 8), [record['id'] for record in records])
+        self.assert_equal("run 0", records[0]['output'])
+        self.assert_equal("succeeded", records[0]['status'])
+        # nothing more to do the second time round
+        self.assert_equal(0, prune_command(self.command, self.archive_dir,
+            now=self.now))
+
+    def test_output_is_archived_a_chunk_at_a_time(self):
+        run = Run.objects.get(id=1)
+        for piece in (u' "quoted"\n', u'caf\xe9 ', u'\\ \u2603'):
+            run.append_output(piece)
+        self.command.keep_runs = 9
+        prune_command(self.command, self.archive_dir, now=self.now)
+        path = archive_path(self.archive_dir, self.command, self.now)
+        records = [simplejson.loads(line) for line in gzip.open(path)]
+        self.assert_equal([1], [record['id'] for record in records])
+        self.assert_equal(u'run 0 "quoted"\ncaf\xe9 \\ \u2603',
+            records[0]['output'])
+
+    def test_prune_runs_command(self):
+        Command.objects.filter(id=self.command.id).update(keep_runs=0)
+        call_command('prune_runs', archive_dir=self.archive_dir, verbosity=0)
+        self.assert_count(0, Run)
+        self.assert_equal("not run yet",
+            Command.objects.get(id=self.command.id).status())
+        self.assert_equal(1, len(os.listdir(self.archive_dir)))
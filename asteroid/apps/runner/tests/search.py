@@ -0,0 +1,180 @@
+from test_extensions.django_common import DjangoCommon
+
+from django.conf import settings
+from django.core.management import call_command
+from django.utils import simplejson
+
+from runner.models import Run, Command
+from runner import search
+
+class SearchTests(DjangoCommon):
+    "Tests for searching the output of runs"
+
+    def setUp(self):
+        self.command = Command.objects.create(
+            title = "deploy",
+            slug = "deploy",
+            command_to_run = "echo",
+        )
+        self.other = Command.objects.create(
+            title = "build",
+            slug = "build",
+            command_to_run = "echo",
+        )
+        self.broken = self.finished_run(self.command,
+            "copying files\nerror: disk full\n", 1)
+        self.working = self.finished_run(self.command, "copying files\n", 0)
+        self.also_broken = self.finished_run(self.other,
+            "compiling\nerror: disk full\n", 1)
+
+    def finished_run(self, command, output, code):
+        run = command.create_run()
+        run.append_output(output)
+        run.finish(code)
+        return run
+
+    def found(self, query, **kwargs):
+        return [run_id for run_id, snippet in search.search(query, **kwargs)]
+
+    def test_finished_runs_are_searchable(self):
+        self.assert_equal([self.also_broken.id, self.broken.id],
+            self.found("disk full"))
+        self.assert_equal([], self.found("full disk"))
+        self.assert_equal([], self.found("   "))
+
+    def test_search_by_command(self):
+        self.assert_equal([self.broken.id],
+            self.found("error", command_id=self.command.id))
+
+    def test_search_a_page_at_a_time(self):
+        self.assert_equal([self.also_broken.id], self.found("error", limit=1))
+        self.assert_equal([self.broken.id],
+            self.found("error", before=self.also_broken.id))
+
+    def test_snippets_are_highlighted(self):
+        run_id, snippet = search.search("disk", limit=1)[0]
+        text, highlights = search.split_snippet(snippet)
+        self.assertTrue("error: disk full" in text)
+        self.assert_equal(["disk"], [text[start:end]
+            for start, end in highlights])
+        self.assertTrue(u"<mark>disk</mark>" in search.highlight(snippet))
+
+    def test_search_syntax_is_ignored(self):
+        self.assert_equal([], self.found('error" OR "copying'))
+
+    def test_deleted_runs_are_removed(self):
+        self.broken.delete()
+        self.assert_equal([self.also_broken.id], self.found("disk full"))
+
+    def test_like_backend(self):
+        backend = settings.SEARCH_BACKEND
+        settings.SEARCH_BACKEND = 'like'
+        try:
+            call_command('rebuild_search_index', verbosity=0)
+            self.assert_equal([self.also_broken.id, self.broken.id],
+                self.found("disk full"))
+            self.assert_equal([], self.found("disk_full"))
+            self.assert_equal([self.broken.id],
+                self.found("error", command_id=self.command.id))
+            run_id, snippet = search.search("disk", limit=1)[0]
+            self.assert_equal("compiling\nerror: \x02disk\x03 full\n", snippet)
+        finally:
+            settings.SEARCH_BACKEND = backend
+
+    def test_only_the_ends_of_long_output_are_indexed(self):
+        size = search.MAX_INDEXED
+        search.MAX_INDEXED = 60
+        try:
+            run = self.finished_run(self.command,
+                "starting\n" + "x" * 100 + "\nmiddle\n" + "y" * 100 +
+                "\nerror: out of memory\n", 1)
+        finally:
+            search.MAX_INDEXED = size
+        self.assert_equal([run.id], self.found("starting"))
+        self.assert_equal([run.id], self.found("out of memory"))
+        self.assert_equal([], self.found("middle"))
+
+    def test_indexing_errors_dont_stop_runs_finishing(self):
+        class Broken(object):
+            def index(self, run_id, command_id, output):
+                raise ValueError("index is broken")
+        get_backend = search.get_backend
+        print_exc = search.traceback.print_exc
+        search.get_backend = lambda: Broken()
+        search.traceback.print_exc = lambda file=None: None
+        try:
+            run = self.finished_run(self.command, "more output", 0)
+        finally:
+            search.get_backend = get_backend
+            search.traceback.print_exc = print_exc
+        self.assert_equal("succeeded", Run.objects.get(id=run.id).status)
+        self.assert_equal([], self.found("more output"))
+
+    def test_default_backend(self):
+        backend = settings.SEARCH_BACKEND
+        settings.SEARCH_BACKEND = None
+        try:
+            if search.fts5_available():
+                expected = search.Fts5Backend
+            else:
+                expected = search.LikeBackend
+            self.assertTrue(isinstance(search.get_backend(), expected))
+        finally:
+            settings.SEARCH_BACKEND = backend
+
+    def test_rebuild_search_index(self):
+        search.get_backend().clear()
+        self.assert_equal([], self.found("error"))
+        call_command('rebuild_search_index', verbosity=0)
+        self.assert_equal([self.also_broken.id, self.broken.id],
+            self.found("error"))
+
+    def test_search_page(self):
+        response = self.client.get('/search/', {'q': 'disk full'})
+        self.assert_code(response, 200)
+        self.assert_response_contains("<mark>disk full</mark>", response)
+        self.assert_response_contains(self.broken.get_absolute_url(), response)
+        self.assert_response_doesnt_contain(self.working.get_absolute_url() +
+            '"', response)
+
+    def test_search_page_for_command(self):
+        response = self.client.get('/search/', {'q': 'error',
+            'command': 'build'})
+        self.assert_code(response, 200)
+        self.assert_response_contains(self.also_broken.get_absolute_url(),
+            response)
+        self.assert_response_doesnt_contain(self.broken.get_absolute_url() +
+            '"', response)
+        response = self.client.get('/search/', {'q': 'error',
+            'command': 'bob'})
+        self.assert_code(response, 404)
+
+    def test_search_api(self):
+        response = self.client.get('/api/search/', {'q': 'disk full',
+            'fields': 'id,command'})
+        self.assert_code(response, 200)
+        obj = simplejson.loads(response.content)
+        self.assert_equal([self.also_broken.id, self.broken.id],
+            [result['id'] for result in obj['results']])
+        self.assert_equal('build', obj['results'][0]['command'])
+        result = obj['results'][0]
+        start, end = result['highlights'][0]
+        self.assert_equal("disk full", result['snippet'][start:end])
+        self.assert_equal(None, obj['next'])
+
+    def test_search_api_without_query(self):
+        response = self.client.get('/api/search/')
+        self.assert_code(response, 400)
+
+    def test_search_api_with_bad_unicode_query(self):
+        def broken(*args, **kwargs):
+            raise search.SearchError(u"syntax error near \xe9")
+        original = search.search
+        search.search = broken
+        try:
+            response = self.client.get('/api/search/', {'q': u'"\xe9'})
+        finally:
+            search.search = original
+        self.assert_code(response, 400)
+        self.assert_equal(u"Can't search for \"\xe9",
+            simplejson.loads(response.content)['error'])
@@ -0,0 +1,144 @@
+from test_extensions.django_common import DjangoCommon
+
+from datetime import datetime, timedelta
+
+from django.core.management import call_command
+from django.utils import simplejson
+
+from runner.models import Run, Command, CommandStat
+from runner import caching, stats
+
+class HistogramTests(DjangoCommon):
+    "Tests for estimating percentiles from counts of durations"
+
+    def test_buckets(self):
+        self.assert_equal(0, stats.bucket(0))
+        self.assert_equal(0, stats.bucket(0.1))
+        self.assert_equal(1, stats.bucket(0.15))
+        self.assert_equal(len(stats.BUCKETS) - 1, stats.bucket(10 ** 9))
+
+    def test_add_and_merge(self):
+        histogram = stats.add(stats.add("", 0.05), 0.3)
+        self.assert_equal("1,0,1", histogram)
+        self.assert_equal("2,0,1,1", stats.merge([histogram, "1,0,0,1"]))
+
+    def test_percentiles(self):
+        histogram = ""
+        for i in range(100):
+            histogram = stats.add(histogram, i < 95 and 1.0 or 100.0)
+        # the estimates should be within a factor of two
+        p50 = stats.percentile(histogram, 0.5)
+        self.assertTrue(0.5 < p50 <= 1.6, p50)
+        p99 = stats.percentile(histogram, 0.99)
+        self.assertTrue(50 < p99 <= 205, p99)
+
+    def test_no_percentiles_without_runs(self):
+        self.assert_equal(None, stats.percentile("", 0.5))
+
+class CommandStatTests(DjangoCommon):
+    "Tests for the statistics kept as runs finish"
+
+    def setUp(self):
+        self.command = Command.objects.create(
+            title = "test",
+            slug = "test",
+            command_to_run = "echo hello",
+        )
+
+    def finished_run(self, code, duration):
+        run = self.command.create_run()
+        Run.objects.filter(id=run.id).update(
+            started_at=run.started_at - timedelta(seconds=duration))
+        run.started_at -= timedelta(seconds=duration)
+        run.finish(code)
+        return run
+
+    def test_finish_records_timing(self):
+        run = self.command.run()
+        run = Run.objects.get(id=run.id)
+        self.assert_equal(0, run.exit_code)
+        self.assertTrue(run.started_at <= run.finished_at)
+        self.assertTrue(0 <= run.duration < 10)
+
+    def test_failed_run_records_exit_code(self):
+        run = self.finished_run(3, 5)
+        self.assert_equal(3, Run.objects.get(id=run.id).exit_code)
+        self.assertTrue(5 <= Run.objects.get(id=run.id).duration < 6)
+
+    def test_stats_are_recorded_before_pages_move_on(self):
+        run = self.command.create_run()
+        counted = []
+        bump = caching.bump
+        def recording_bump(*names):
+            counted.append(list(CommandStat.objects.values_list('runs',
+                flat=True)))
+            bump(*names)
+        caching.bump = recording_bump
+        try:
+            run.finish(0)
+        finally:
+            caching.bump = bump
+        self.assertTrue(counted)
+        self.assert_equal([[1]] * len(counted), counted)
+
+    def test_runs_are_counted(self):
+        for code, duration in ((0, 1), (1, 2), (0, 30), (0, 4)):
+            self.finished_run(code, duration)
+        stat = CommandStat.objects.get(command=self.command)
+        self.assert_equal(datetime.today().date(), stat.day)
+        self.assert_equal(4, stat.runs)
+        self.assert_equal(1, stat.failures)
+        self.assert_equal(25, stat.failure_percent())
+        self.assertTrue(37 <= stat.total_duration < 38)
+        self.assertTrue(1 <= stat.p50() <= 4, stat.p50())
+        self.assertTrue(12 < stat.p95() <= 51.2, stat.p95())
+
+    def test_summaries(self):
+        self.finished_run(0, 1)
+        CommandStat.objects.create(command=self.command,
+            day=datetime.today().date() - timedelta(days=3), runs=2,
+            failures=2, total_duration=4, histogram=stats.add(stats.add("",
+            2), 2))
+        CommandStat.objects.create(command=self.command,
+            day=datetime.today().date() - timedelta(days=30), runs=5)
+        summary = CommandStat.objects.summaries(7)[self.command.id]
+        self.assert_equal(3, summary.runs)
+        self.assert_equal(2, summary.failures)
+        self.assert_equal(3, sum(stats.parse(summary.histogram)))
+
+    def test_rebuild_stats(self):
+        for code, duration in ((0, 1), (1, 2)):
+            self.finished_run(code, duration)
+        CommandStat.objects.all().delete()
+        # a run from before timings were kept
+        Run.objects.create(command=self.command, command_run="ls",
+            status="succeeded")
+        call_command('rebuild_stats', verbosity=0)
+        stat = CommandStat.objects.get(command=self.command)
+        self.assert_equal(3, stat.runs)
+        self.assert_equal(1, stat.failures)
+
+    def test_command_page_shows_stats(self):
+        self.finished_run(0, 1)
+        self.finished_run(1, 1)
+        response = self.client.get('/commands/test/')
+        self.assert_code(response, 200)
+        self.assert_response_contains("2 runs, 50% failed", response)
+
+    def test_dashboard_shows_stats(self):
+        self.finished_run(0, 1)
+        response = self.client.get('/')
+        self.assert_code(response, 200)
+        self.assert_response_contains("Last 7 days", response)
+
+    def test_stats_api(self):
+        self.finished_run(0, 1)
+        self.finished_run(1, 1)
+        response = self.client.get('/api/commands/test/stats/')
+        self.assert_code(response, 200)
+        obj = simplejson.loads(response.content)
+        self.assert_equal(1, len(obj['days']))
+        self.assert_equal(2, obj['summary']['runs'])
+        self.assert_equal(0.5, obj['summary']['failure_rate'])
+        self.assert_code(self.client.get('/api/commands/test/stats/',
+            {'days': 0}), 400)
@@ -17,3 +17,18 @@ class TemplateTagTests(DjangoCommon):
         "Example template tag test to check correct rendering"
         expected = 'failed'
         self.assert_render(expected, """{% load correct_status %}{{"failed"|correct_status }}""")
+
+    def test_duration_in_seconds(self):
+        self.assert_render('4.2s', """{% load durations %}{{ 4.24|duration }}""")
+
+    def test_duration_in_minutes(self):
+        self.assert_render('3m 05s', """{% load durations %}{{ 185|duration }}""")
+
+    def test_duration_in_hours(self):
+        self.assert_render('2h 01m', """{% load durations %}{{ 7260|duration }}""")
+
+    def test_unknown_duration(self):
+        self.assert_render('-', """{% load durations %}{{ nothing|duration }}""")
+
+    def test_milliseconds(self):
+        self.assert_render('12.5ms', """{% load durations %}{{ 0.0125|milliseconds }}""")
@@ -1,8 +1,51 @@
 from test_extensions.django_common import DjangoCommon
 
+import socket
+import time
+
 from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils import simplejson
 
 from runner.models import Run, Command
+from runner import caching, models, views
+from runner.conditional import IMMUTABLE_MAX_AGE
+
+class FakePublisher(object):
+    "stands in for the publisher, remembering the runs sent to each target"
+
+    def __init__(self, depths=None, error=None):
+        self.published = []
+        self.depths = depths
+        self.error = error
+        self.attempts = 0
+
+    def publish_many(self, bodies, routing_key):
+        if self.error:
+            raise self.error
+        self.published.append((routing_key, [simplejson.loads(body)['run']
+            for body in bodies]))
+
+    def queue_depths(self, targets):
+        self.attempts += 1
+        if self.error:
+            raise self.error
+        return self.depths
+
+class FakeClock(object):
+    "stands in for the time module, remembering how long it was asked to sleep"
+
+    def __init__(self):
+        self.now = 0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
 
 class ViewTests(DjangoCommon):
     "Tests for the site frontend"
@@ -24,10 +67,232 @@ class ViewTests(DjangoCommon):
         self.run = run
         self.command = command
 
+    def capture_queries(self, url, cached=False):
+        """
+        request the given url and return the sql of the queries it made,
+        with nothing cached unless asked
+        """
+        if not cached:
+            caching.bump(caching.COMMANDS, caching.RUNS)
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            self.client.get(url)
+            return [query['sql'] for query in connection.queries]
+        finally:
+            settings.DEBUG = False
+
+    def count_queries(self, url):
+        "request the given url and return the number of queries it made"
+        return len(self.capture_queries(url))
+
+    def add_runs(self, count, output=None):
+        "create a number of extra runs against our command"
+        for i in range(count):
+            run = Run.objects.create(
+                command = self.command,
+                command_run = self.command.command_to_run,
+            )
+            run.append_output(output)
+
+    def assert_queries_fixed(self, url):
+        "the number of queries for a page shouldn't depend on the runs"
+        queries = self.count_queries(url)
+        self.add_runs(5)
+        self.assert_equal(queries, self.count_queries(url))
+
+    def assert_output_not_loaded(self, url):
+        "large outputs should never be loaded by pages which list runs"
+        self.add_runs(2, output="x" * 100000)
+        for sql in self.capture_queries(url):
+            self.deny_contains('runner_outputchunk', sql)
+
+    def with_queue(self, publisher, func, *args):
+        "call func with the message queue on, and publisher standing in for it"
+        get_publisher = models.get_publisher
+        models.get_publisher = views.get_publisher = lambda: publisher
+        settings.QUEUE_COMMANDS = True
+        cache.delete("asteroid:queue_depths")
+        try:
+            return func(*args)
+        finally:
+            settings.QUEUE_COMMANDS = False
+            models.get_publisher = views.get_publisher = get_publisher
+            cache.delete("asteroid:queue_depths")
+
     def test_dashboard(self):
         response = self.client.get('/')
         self.assert_code(response, 200)
 
+    def test_dashboard_queries_dont_grow_with_commands(self):
+        queries = self.count_queries('/')
+        for i in range(10):
+            command = Command.objects.create(
+                title = "test %s" % i,
+                slug = "test-%s" % i,
+                command_to_run = "ls",
+            )
+            Run.objects.create(
+                command = command,
+                command_run = command.command_to_run,
+            )
+        self.assert_equal(queries, self.count_queries('/'))
+
+    def test_dashboard_query_count(self):
+        self.assert_queries_fixed('/')
+
+    def test_dashboard_doesnt_load_output(self):
+        self.assert_output_not_loaded('/')
+
+    def test_runs_query_count(self):
+        self.assert_queries_fixed('/runs/')
+
+    def test_runs_dont_load_output(self):
+        self.assert_output_not_loaded('/runs/')
+
+    def test_command_query_count(self):
+        self.assert_queries_fixed('/commands/test/')
+
+    def test_command_doesnt_load_output(self):
+        self.assert_output_not_loaded('/commands/test/')
+
+    def test_dashboard_is_cached(self):
+        self.count_queries('/')
+        # all that's left is checking whether anything has changed
+        self.assert_equal(1, len(self.capture_queries('/', cached=True)))
+
+    def test_dashboard_cache_follows_runs(self):
+        response = self.client.get('/')
+        self.assert_response_contains("test in progress", response)
+        self.run.finish(0)
+        response = self.client.get('/')
+        self.assert_response_contains("test succeeded", response)
+        self.assert_response_doesnt_contain("in progress", response)
+
+    def test_dashboard_cache_follows_commands(self):
+        self.client.get('/')
+        self.command.title = "renamed"
+        self.command.save()
+        response = self.client.get('/')
+        self.assert_response_contains("renamed", response)
+        self.assert_response_doesnt_contain(">test<", response)
+
+    def test_command_is_cached(self):
+        self.count_queries('/commands/test/')
+        self.assert_equal(0, len(self.capture_queries('/commands/test/',
+            cached=True)))
+        self.add_runs(1)
+        self.assertTrue(self.capture_queries('/commands/test/', cached=True))
+
+    def test_commands_are_cached(self):
+        self.count_queries('/commands/')
+        self.assert_equal(0, len(self.capture_queries('/commands/',
+            cached=True)))
+
+    def test_missing_pages_are_not_cached(self):
+        Command.objects.all().delete()
+        response = self.client.get('/commands/')
+        self.assert_code(response, 404)
+        Command.objects.create(title="new", slug="new", command_to_run="ls")
+        response = self.client.get('/commands/')
+        self.assert_code(response, 200)
+
+    def test_cache_hits_are_counted(self):
+        before = caching.stats(['dashboard_runs'])['dashboard_runs']
+        self.count_queries('/')
+        self.client.get('/')
+        after = caching.stats()['dashboard_runs']
+        self.assert_equal(before['misses'] + 1, after['misses'])
+        self.assert_equal(before['hits'] + 1, after['hits'])
+
+    def test_only_shared_caches_reach_other_processes(self):
+        backend = settings.CACHE_BACKEND
+        try:
+            settings.CACHE_BACKEND = 'locmem://'
+            self.assertFalse(caching.is_shared())
+            settings.CACHE_BACKEND = 'file:///var/tmp/asteroid_cache'
+            self.assertTrue(caching.is_shared())
+        finally:
+            settings.CACHE_BACKEND = backend
+
+    def test_run_query_count(self):
+        self.run.append_output("x" * 100000)
+        # one of these is checking whether the run has changed
+        self.assert_equal(4, self.count_queries('/commands/test/1/'))
+
+    def test_run_loads_output(self):
+        self.run.append_output("x" * 1000)
+        queries = self.capture_queries('/commands/test/1/')
+        self.assert_contains('runner_outputchunk', queries[-1])
+        response = self.client.get('/commands/test/1/')
+        self.assert_response_contains("x" * 1000, response)
+
+    def test_run_shows_tail_of_long_output(self):
+        self.run.append_output("a" * 70000)
+        self.run.append_output("b" * 70000)
+        response = self.client.get('/commands/test/1/')
+        self.assert_response_contains(">" + "b" * 65536 + "<", response)
+        self.assert_response_contains("?start=", response)
+
+    def test_run_shows_page_of_output(self):
+        self.run.append_output("a" * 70000)
+        self.run.append_output("b" * 70000)
+        response = self.client.get('/commands/test/1/?start=0')
+        self.assert_response_contains("a" * 65536 + "<", response)
+        self.assert_response_contains("?start=65536", response)
+
+    def conditional_get(self, url, response):
+        "request a url again using the validators from a response"
+        headers = {}
+        if response.has_header('ETag'):
+            headers['HTTP_IF_NONE_MATCH'] = response['ETag']
+        if response.has_header('Last-Modified'):
+            headers['HTTP_IF_MODIFIED_SINCE'] = response['Last-Modified']
+        return self.client.get(url, **headers)
+
+    def test_finished_run_not_modified(self):
+        self.run.append_output("done")
+        self.run.finish(0)
+        response = self.client.get('/commands/test/1/')
+        self.assert_code(response, 200)
+        self.assert_contains("max-age=%s" % IMMUTABLE_MAX_AGE,
+            response['Cache-Control'])
+        self.assertTrue(response.has_header('Last-Modified'))
+        response = self.conditional_get('/commands/test/1/', response)
+        self.assert_code(response, 304)
+        self.assert_equal("", response.content)
+
+    def test_run_in_progress_changes_with_output(self):
+        response = self.client.get('/commands/test/1/')
+        self.assert_contains("must-revalidate", response['Cache-Control'])
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assert_code(self.conditional_get('/commands/test/1/', response),
+            304)
+        self.run.append_output("more")
+        self.assert_code(self.conditional_get('/commands/test/1/', response),
+            200)
+
+    def test_dashboard_not_modified(self):
+        response = self.client.get('/')
+        self.assert_code(self.conditional_get('/', response), 304)
+        self.add_runs(1)
+        response = self.conditional_get('/', response)
+        self.assert_code(response, 200)
+        self.assert_code(self.conditional_get('/', response), 304)
+        Run.objects.get(id=2).delete()
+        self.assert_code(self.conditional_get('/', response), 200)
+
+    def test_not_modified_without_rendering(self):
+        self.run.finish(0)
+        response = self.client.get('/commands/test/1/')
+        settings.DEBUG = True
+        connection.queries = []
+        try:
+            self.conditional_get('/commands/test/1/', response)
+            self.assert_equal(1, len(connection.queries))
+        finally:
+            settings.DEBUG = False
+
     def test_commands(self):
         response = self.client.get('/commands/')
         self.assert_code(response, 200)
@@ -73,6 +338,88 @@ class ViewTests(DjangoCommon):
         self.assert_code(response, 200)
         self.assert_counts([2, 1], [Run, Command])
         
+    def test_run_commands(self):
+        Command.objects.create(title="other", slug="other",
+            command_to_run="echo hello")
+        response = self.client.post('/run/', {'command': ['test', 'other'],
+            'count': 2})
+        self.assert_code(response, 200)
+        runs = simplejson.loads(response.content)['runs']
+        self.assert_equal(['test', 'test', 'other', 'other'],
+            [run['command'] for run in runs])
+        self.assert_equal('/commands/other/5', runs[-1]['url'])
+        self.assert_counts([5, 2], [Run, Command])
+        self.assert_equal("hello\n", Run.objects.get(id=5).read_output())
+        self.assert_equal(5, Command.objects.get(slug="other").last_run_id)
+        self.assert_equal("succeeded", Command.objects.get(slug="other").status())
+
+    def test_run_commands_queued(self):
+        publisher = FakePublisher()
+        response = self.with_queue(publisher, self.client.post, '/run/',
+            {'command': 'test', 'count': 3})
+        self.assert_code(response, 200)
+        self.assert_equal([('all', [2, 3, 4])], publisher.published)
+        self.assert_equal("in_progress", Run.objects.get(id=4).status)
+
+    def test_run_commands_by_target(self):
+        Command.objects.create(title="other", slug="other",
+            command_to_run="uname", target="linux")
+        publisher = FakePublisher()
+        response = self.with_queue(publisher, self.client.post, '/run/',
+            {'command': ['test', 'other', 'test']})
+        self.assert_code(response, 200)
+        self.assert_equal([('all', [2, 4]), ('linux', [3])],
+            publisher.published)
+
+    def test_runs_fail_when_the_queue_cant_be_reached(self):
+        publisher = FakePublisher(error=socket.error("connection refused"))
+        response = self.with_queue(publisher, self.client.post, '/run/',
+            {'command': 'test', 'count': 2})
+        self.assert_code(response, 200)
+        for run in Run.objects.filter(id__in=[2, 3]):
+            self.assert_equal("failed", run.status)
+            self.assert_contains("Unable to send the command",
+                run.read_output())
+
+    def test_runs_sent_before_the_queue_failed_are_kept(self):
+        error = socket.error("connection reset")
+        error.sent = 1
+        publisher = FakePublisher(error=error)
+        self.with_queue(publisher, self.client.post, '/run/',
+            {'command': 'test', 'count': 2})
+        self.assert_equal("in_progress", Run.objects.get(id=2).status)
+        self.assert_equal("failed", Run.objects.get(id=3).status)
+
+    def test_dashboard_shows_queues(self):
+        Command.objects.create(title="other", slug="other",
+            command_to_run="uname", target="linux")
+        publisher = FakePublisher(depths={'all': (3, 2), 'linux': None})
+        response = self.with_queue(publisher, self.client.get, '/')
+        self.assert_code(response, 200)
+        for fragment in ("<strong>all</strong> 3 waiting", "(2 listeners)",
+                "<strong>linux</strong> 0 waiting", "(0 listeners)"):
+            self.assert_response_contains(fragment, response)
+
+    def test_dashboard_without_queue(self):
+        publisher = FakePublisher(error=socket.error("connection refused"))
+        responses = self.with_queue(publisher, lambda: [self.client.get('/')
+            for i in range(2)])
+        self.assert_code(responses[0], 200)
+        self.assert_response_contains("The message queue can't be reached.",
+            responses[0])
+        # the broker is only tried once, the failure is remembered
+        self.assert_equal(1, publisher.attempts)
+
+    def test_run_commands_with_bad_requests(self):
+        self.assert_code(self.client.get('/run/'), 405)
+        self.assert_code(self.client.post('/run/', {}), 400)
+        self.assert_code(self.client.post('/run/', {'command': 'test',
+            'count': 'bob'}), 400)
+        self.assert_code(self.client.post('/run/', {'command': 'test',
+            'count': 1000}), 400)
+        self.assert_code(self.client.post('/run/', {'command': 'bob'}), 404)
+        self.assert_counts([1, 1], [Run, Command])
+
     def test_webhook_with_get(self):
         response = self.client.get('/commands/test/1/hook/')
         self.assert_code(response, 405)
@@ -83,4 +430,196 @@ class ViewTests(DjangoCommon):
         
     def test_run_hook_with_bad_request(self):
         response = self.client.post('/commands/test/1/hook/', {'test': 'test',})
-        self.assert_code(response, 400)
\ No newline at end of file
+        self.assert_code(response, 400)
+
+    def test_run_hook_with_json(self):
+        response = self.client.post('/commands/test/1/hook/',
+            '{"status": 0, "output": "done"}', content_type='application/json')
+        self.assert_code(response, 200)
+        run = Run.objects.get(id=1)
+        self.assert_equal("succeeded", run.status)
+        self.assert_equal("done", run.read_output())
+
+    def test_run_hook_without_status(self):
+        response = self.client.post('/commands/test/1/hook/',
+            '{"output": "done"}', content_type='application/json')
+        self.assert_code(response, 400)
+
+    def test_run_hook_appends_output(self):
+        for piece in ('{"output": "one ", "append": true}',
+                '{"output": "two", "append": true}'):
+            response = self.client.post('/commands/test/1/hook/', piece,
+                content_type='application/json')
+            self.assert_code(response, 200)
+        run = Run.objects.get(id=1)
+        self.assert_equal("in_progress", run.status)
+        self.assert_equal("one two", run.read_output())
+        response = self.client.post('/commands/test/1/hook/',
+            '{"output": "", "append": true, "status": 1}',
+            content_type='application/json')
+        self.assert_code(response, 200)
+        run = Run.objects.get(id=1)
+        self.assert_equal("failed", run.status)
+        self.assert_equal("one two", run.read_output())
+        self.assert_equal("failed", Command.objects.get(id=1).status())
+
+    def test_run_hook_records_start(self):
+        Run.objects.filter(id=1).update(started_at=None)
+        response = self.client.post('/commands/test/1/hook/',
+            '{"started": true}', content_type='application/json')
+        self.assert_code(response, 200)
+        self.assert_equal("started", simplejson.loads(response.content))
+        run = Run.objects.get(id=1)
+        self.assert_equal("in_progress", run.status)
+        self.assertTrue(run.started_at is not None)
+        self.assertTrue(run.heartbeat is not None)
+        # a listener given the run again is told it's already been started
+        response = self.client.post('/commands/test/1/hook/',
+            '{"started": true}', content_type='application/json')
+        self.assert_code(response, 200)
+        self.assert_equal("already_started",
+            simplejson.loads(response.content))
+        run.finish(1)
+        response = self.client.post('/commands/test/1/hook/',
+            '{"started": true}', content_type='application/json')
+        self.assert_code(response, 400)
+
+    def test_run_hook_ignores_repeated_output(self):
+        piece = '{"output": "one", "append": true, "offset": 0}'
+        for i in range(2):
+            response = self.client.post('/commands/test/1/hook/', piece,
+                content_type='application/json')
+            self.assert_code(response, 200)
+        self.assert_equal("one", Run.objects.get(id=1).read_output())
+
+    def test_run_hook_refuses_gaps_in_output(self):
+        self.run.append_output("one")
+        response = self.client.post('/commands/test/1/hook/',
+            '{"output": "three", "append": true, "offset": 6, "status": 0}',
+            content_type='application/json')
+        self.assert_code(response, 400)
+        run = Run.objects.get(id=1)
+        self.assert_equal("in_progress", run.status)
+        self.assert_equal("one", run.read_output())
+
+    def batch_hook(self, results):
+        "post results to the batch webhook and return what happened to them"
+        response = self.client.post('/hooks/', simplejson.dumps(results),
+            content_type='application/json')
+        self.assert_code(response, 200)
+        return simplejson.loads(response.content)
+
+    def test_batch_hook_with_get(self):
+        response = self.client.get('/hooks/')
+        self.assert_code(response, 405)
+
+    def test_batch_hook_with_bad_request(self):
+        for body in ('bob', '{"run": 1}', '[{"command": "test"}]'):
+            response = self.client.post('/hooks/', body,
+                content_type='application/json')
+            self.assert_code(response, 400)
+
+    def test_batch_hook_finishes_runs(self):
+        self.add_runs(1)
+        outcomes = self.batch_hook([
+            {"run": 1, "command": "test", "output": "one", "append": True,
+                "offset": 0, "status": 0},
+            {"run": 2, "command": "test", "output": "two", "append": True,
+                "offset": 0, "status": 1},
+        ])
+        self.assert_equal({"1": "ok", "2": "ok"}, outcomes)
+        self.assert_equal("succeeded", Run.objects.get(id=1).status)
+        self.assert_equal("failed", Run.objects.get(id=2).status)
+        self.assert_equal("two", Run.objects.get(id=2).read_output())
+        self.assert_equal("failed", Command.objects.get(id=1).status())
+
+    def test_batch_hook_reports_each_run(self):
+        self.run.finish(0)
+        self.add_runs(1)
+        outcomes = self.batch_hook([
+            {"run": 1, "command": "test", "output": "more", "append": True},
+            {"run": 2, "command": "test"},
+            {"run": 2, "command": "other", "status": 0},
+            {"run": 3, "command": "test", "status": 0},
+        ])
+        self.assert_equal({
+            "1": "not_in_progress",
+            "2": "not_found",
+            "3": "not_found",
+        }, outcomes)
+        self.assert_equal("in_progress", Run.objects.get(id=2).status)
+
+    def test_batch_hook_ignores_repeated_results(self):
+        self.run.append_output("one")
+        outcomes = self.batch_hook([{"run": 1, "command": "test",
+            "output": "one", "append": True, "offset": 0}])
+        self.assert_equal({"1": "duplicate"}, outcomes)
+        self.assert_equal("one", Run.objects.get(id=1).read_output())
+
+    def test_batch_hook_accepts_results_sent_again(self):
+        results = [{"run": 1, "command": "test", "output": "one",
+            "append": True, "offset": 0, "status": 0}]
+        self.assert_equal({"1": "ok"}, self.batch_hook(results))
+        self.assert_equal({"1": "already_finished"}, self.batch_hook(results))
+        self.assert_equal("one", Run.objects.get(id=1).read_output())
+        self.assert_equal("succeeded", Run.objects.get(id=1).status)
+
+    def tail(self, url):
+        "get the JSON from a tail of a run"
+        response = self.client.get(url)
+        self.assert_code(response, 200)
+        return simplejson.loads(response.content)
+
+    def test_tail_returns_new_output(self):
+        self.run.append_output("one ")
+        self.run.append_output("two")
+        result = self.tail('/commands/test/1/tail/?offset=4')
+        self.assert_equal("two", result['output'])
+        self.assert_equal(7, result['offset'])
+        self.assert_equal("in_progress", result['status'])
+        self.assertFalse(result['complete'])
+
+    def test_tail_gives_up_waiting(self):
+        timeout = settings.TAIL_TIMEOUT
+        settings.TAIL_TIMEOUT = 0
+        try:
+            result = self.tail('/commands/test/1/tail/?offset=0')
+        finally:
+            settings.TAIL_TIMEOUT = timeout
+        self.assert_equal("", result['output'])
+        self.assert_equal(0, result['offset'])
+        self.assertFalse(result['complete'])
+
+    def test_tail_checks_less_often_as_it_waits(self):
+        clock = FakeClock()
+        views.time = clock
+        try:
+            self.tail('/commands/test/1/tail/?offset=0')
+        finally:
+            views.time = time
+        self.assert_equal(settings.TAIL_TIMEOUT, sum(clock.sleeps))
+        interval = settings.TAIL_INTERVAL
+        self.assert_equal([interval, interval * 2, interval * 4],
+            clock.sleeps[:3])
+
+    def test_tail_of_finished_run(self):
+        self.run.append_output("done")
+        self.run.finish(0)
+        result = self.tail('/commands/test/1/tail/?offset=4')
+        self.assert_equal("", result['output'])
+        self.assertTrue(result['complete'])
+
+    def test_tail_with_bad_offset(self):
+        response = self.client.get('/commands/test/1/tail/?offset=bob')
+        self.assert_code(response, 400)
+
+    def test_tail_of_non_existent_run(self):
+        response = self.client.get('/commands/test/3/tail/')
+        self.assert_code(response, 404)
+
+    def test_run_in_progress_follows_output(self):
+        response = self.client.get('/commands/test/1/')
+        self.assert_response_contains('/tail/?offset=', response)
+        self.run.finish(0)
+        response = self.client.get('/commands/test/1/')
+        self.assert_response_doesnt_contain('/tail/?offset=', response)
@@ -1,15 +1,53 @@
 "Views for Asteroid"
 
+import time
+
 from django.shortcuts import render_to_response
 from django.template import RequestContext
 from django.shortcuts import get_object_or_404, get_list_or_404
 from django.http import Http404, HttpResponseNotFound, HttpResponseRedirect, HttpResponse, HttpResponseNotAllowed, HttpResponseBadRequest
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, Max
 from django.utils import simplejson
-from django.core.paginator import Paginator, InvalidPage, EmptyPage
+from django.utils.hashcompat import md5_constructor
+
+from runner.models import Command, Run, CommandStat, RunRejected, \
+    UNFINISHED, trigger_many, combine
+from runner.pagination import page_from_request
+from runner.caching import cache_view, get_versions, COMMANDS, RUNS
+from runner.conditional import conditional, IMMUTABLE_MAX_AGE
+from runner.publisher import get_publisher, queue_name, CONNECTION_ERRORS
+from runner.metrics import instrumented
+from runner import metrics, search
+
+# how much output to show on a page, or send in one go to a tail
+OUTPUT_PAGE_SIZE = 64 * 1024
+
+# the most runs which can be started with one request
+MAX_TRIGGER = 100
+
+# how long to remember the depth of the queues for, or that we couldn't
+# reach the message queue, in seconds
+QUEUE_DEPTH_TIMEOUT = 5
+# cached instead of the depths when we couldn't reach the message queue
+UNREACHABLE = "unreachable"
+
+# how many days of statistics to show for a command, and on the dashboard
+COMMAND_STATS_DAYS = 14
+DASHBOARD_STATS_DAYS = 7
+
+WEBHOOK_RESULTS = metrics.counter("asteroid_webhook_results_total",
+    "Results sent to the web hooks, by what happened to them", ["outcome"])
+WEBHOOK_BATCH_SIZE = metrics.histogram("asteroid_webhook_batch_size",
+    "How many results were sent to the batch web hook at once",
+    buckets=metrics.SIZE_BUCKETS)
 
-from runner.models import Command, Run
+if settings.METRICS_TIME_QUERIES:
+    metrics.time_queries()
 
+@instrumented('run_command')
 def run_command(request, command):
     """
     to run a command we simply GET a specific url. We're using GET mainly
@@ -19,15 +57,138 @@ def run_command(request, command):
     # check we have a valid command, if not throw a 404
     existing_command = get_object_or_404(Command, slug__iexact=command)
 
-    # check whether we're using the message queue or not
-    if settings.QUEUE_COMMANDS:
-        run = existing_command.queue_run()
-    else:
-        run = existing_command.run()
+    # run it with the message queue, in the background or right now
+    # depending on the settings, unless it's already running and the
+    # command doesn't allow that
+    try:
+        run = existing_command.trigger()
+    except RunRejected, e:
+        response = HttpResponse("%s\n" % e, content_type="text/plain")
+        response.status_code = 409
+        return response
     
     # redirect to the run that's been created
     return HttpResponseRedirect(run.get_absolute_url())
         
+@instrumented('run_commands')
+def run_commands(request):
+    """
+    Run several commands, or the same command several times, in one go.
+    This takes a POST with a command parameter for the slug of each command
+    to run and optionally a count of how many times to run each of them,
+    and returns the runs as JSON. Commands which don't allow overlapping
+    runs may be queued, share a run already in progress or be rejected.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+
+    slugs = request.POST.getlist('command')
+    try:
+        count = int(request.POST.get('count', 1))
+    except ValueError:
+        return HttpResponseBadRequest()
+    if not slugs or count < 1 or len(slugs) * count > MAX_TRIGGER:
+        return HttpResponseBadRequest()
+
+    commands = dict([(command.slug, command) for command in
+        Command.objects.filter(slug__in=slugs)])
+    if len(commands) < len(set(slugs)):
+        return HttpResponseNotFound()
+
+    triggered = [commands[slug] for slug in slugs for i in range(count)]
+    runs = trigger_many(triggered)
+
+    results = []
+    for command, run in zip(triggered, runs):
+        if run is None:
+            results.append({'command': command.slug, 'rejected': True})
+        else:
+            results.append({
+                'id': run.id,
+                'command': command.slug,
+                'status': run.status,
+                'url': run.get_absolute_url(),
+            })
+    obj = {
+        'runs': results,
+    }
+    return HttpResponse(simplejson.dumps(obj),
+        content_type = 'application/javascript; charset=utf8'
+    )
+
+def record_result(existing_run, obj):
+    """
+    Record a result document from a listener against a run, returning a
+    short description of what happened. A ValueError is raised for documents
+    we can't make sense of.
+
+    Listeners which stream output send it in pieces as it arrives, marked
+    with append, and only include the status with the last piece. They
+    include the offset each piece starts at, so if a piece is sent twice we
+    can tell we already have it. A piece which starts after the end of the
+    output we have is refused, as something before it has gone missing.
+    Before running the command they send a document marked with started,
+    so we know it's going. If a listener has already started it, one which
+    stopped part way through, we say so rather than let it run twice.
+
+    A listener which didn't hear back may send a run's result again after
+    we've recorded it, so a result for a finished run is reported as
+    already finished rather than refused.
+    """
+    # sample json input
+    # json = """{
+    #     "status": 0,
+    #     "output": "bob2",
+    #     "append": true,
+    #     "offset": 0
+    # }"""
+
+    if not isinstance(obj, dict):
+        raise ValueError("Result should be an object")
+
+    # the web hook will only run against in progress tasks
+    # so in theory should only be run once.
+    if existing_run.status != "in_progress":
+        if 'status' in obj:
+            return "already_finished"
+        return "not_in_progress"
+
+    if obj.get('started'):
+        # the listener is about to run the command, unless one already has
+        if existing_run.heartbeat is not None:
+            return "already_started"
+        existing_run.mark_started()
+        return "started"
+
+    if obj.get('append'):
+        # add to the output so far, unless we already have this piece
+        output = obj.get('output')
+        offset = obj.get('offset')
+        if offset is not None and offset > existing_run.output_length:
+            raise ValueError("Output is missing from offset %s" %
+                existing_run.output_length)
+        if offset is not None and offset < existing_run.output_length:
+            output = None
+        if output:
+            existing_run.append_output(output)
+        # and finish the run if this is the last of it
+        if 'status' in obj:
+            existing_run.finish(obj['status'])
+        elif not output:
+            return "duplicate"
+
+    elif 'status' in obj:
+        # replace the output and finish the run with the status code
+        existing_run.set_output(obj.get('output'))
+        existing_run.finish(obj['status'])
+
+    else:
+        # without a status there's nothing to record
+        raise ValueError("Result has no status")
+
+    return "ok"
+
+@instrumented('run_web_hook')
 def run_web_hook(request, command, run):
     """
     The web hook lets the message queue tell us how the command got on. It 
@@ -35,61 +196,90 @@ def run_web_hook(request, command, run):
     When we recieve it we also change the status.
     """
 
-    # we're dealing with a post request
-    if request.POST:
+    # we're dealing with a post request. We check the method rather than
+    # request.POST as a JSON body doesn't populate it
+    if request.method == "POST":
         try:
             # we try and get the run based on the url parameters
             existing_run = Run.objects.get(id=run, command__slug=command)
 
-            # the web hook will only run against in progress tasks
-            # so in theory should only be run once.
-            if existing_run.status == "in_progress":
-
-                # sample json input
-                # json = """{
-                #     "status": 0,
-                #     "output": "bob2"
-                # }"""
-                
-                # get json document from post body in request.POST
-                json = request.raw_post_data
-
-                # not try parse the JSON
-                try:
-                    obj = simplejson.loads(json)
-                except ValueError, e:
-                    # invalid input
-                    return HttpResponseBadRequest()
-
-                # get the status code and convert it to our values
-                if obj['status'] == 0:
-                    code = "succeeded"
-                else:
-                    code = "failed"
-
-                # set the attributes on our run and save it
-                existing_run.status = code # succeeded failed in_progress
-                existing_run.output = obj['output']
-                existing_run.save()
-
-                # return a 200 code as everything went OK
-                return HttpResponse(
-                    content_type = 'application/javascript; charset=utf8'
-                )
-
-            else:
-                # this run is not in progress, only the first response is recorded
-                # should be client error
+            # get json document from post body in request.POST
+            json = request.raw_post_data
+
+            # not try parse the JSON and record it
+            try:
+                outcome = record_result(existing_run, simplejson.loads(json))
+            except ValueError, e:
+                # invalid input
+                WEBHOOK_RESULTS.inc(outcome="bad_request")
                 return HttpResponseBadRequest()
+            WEBHOOK_RESULTS.inc(outcome=outcome)
+
+            if outcome == "not_in_progress":
+                # this run is not in progress, only the first response is
+                # recorded should be client error
+                return HttpResponseBadRequest()
+
+            # return a 200 code as everything went OK, saying what
+            # happened as the batch web hook does
+            return HttpResponse(simplejson.dumps(outcome),
+                content_type = 'application/javascript; charset=utf8'
+            )
 
         except Run.DoesNotExist:
             # we didn't find a run, so throw a 404
+            WEBHOOK_RESULTS.inc(outcome="not_found")
             return HttpResponseNotFound()
 
     else:
         # should be method not allowed as we only respond to post
         return HttpResponseNotAllowed(['POST'])
 
+def run_batch_web_hook(request):
+    """
+    Lets a listener send the results for many runs at once. It accepts a 
+    JSON list of the documents the run web hook takes, each with the id of
+    the run and slug of the command it's for added, and records them all in
+    one transaction. The response is a JSON object of what happened to the
+    result for each run, keyed by run id.
+    """
+    if request.method != "POST":
+        return HttpResponseNotAllowed(['POST'])
+
+    try:
+        results = simplejson.loads(request.raw_post_data)
+        if not isinstance(results, list):
+            raise ValueError("Expected a list of results")
+        ids = [int(result['run']) for result in results]
+    except (ValueError, TypeError, KeyError), e:
+        return HttpResponseBadRequest()
+    WEBHOOK_BATCH_SIZE.observe(len(results))
+
+    # fetch all the runs in one go
+    runs = Run.objects.select_related('command').in_bulk(ids)
+
+    outcomes = {}
+    for run_id, result in zip(ids, results):
+        existing_run = runs.get(run_id)
+        if existing_run is None or \
+                existing_run.command.slug != result.get('command'):
+            outcome = "not_found"
+        else:
+            try:
+                outcome = record_result(existing_run, result)
+            except ValueError, e:
+                outcome = "bad_request"
+        WEBHOOK_RESULTS.inc(outcome=outcome)
+        # a run may have several results in a batch, the last one counts
+        outcomes[str(run_id)] = outcome
+
+    return HttpResponse(simplejson.dumps(outcomes),
+        content_type = 'application/javascript; charset=utf8'
+    )
+run_batch_web_hook = instrumented('run_batch_web_hook')(
+    transaction.commit_on_success(run_batch_web_hook))
+
+@cache_view('list_commands', [COMMANDS])
 def list_commands(request):
     "list all the available commands in the system"
     # if none exist throw a 404
@@ -102,21 +292,11 @@ def list_commands(request):
 
 def list_runs(request):
     "list all the runs that have been made so far"
-    runs = get_list_or_404(Run)
-    
-    paginator = Paginator(runs, 10) # Show 10 runs per page
+    run_list = page_from_request(request, Run.objects.summaries())
 
-    # Make sure page request is an int. If not, deliver first page.
-    try:
-        page = int(request.GET.get('page', '1'))
-    except ValueError:
-        page = 1
-
-    # If page request (9999) is out of range, deliver last page of results.
-    try:
-        run_list = paginator.page(page)
-    except (EmptyPage, InvalidPage):
-        run_list = paginator.page(paginator.num_pages)
+    # there's nothing to list until something has been run
+    if not run_list.object_list:
+        raise Http404
     
     context = {
         'runs': run_list,
@@ -124,14 +304,94 @@ def list_runs(request):
     return render_to_response('list_runs.html', context,
         context_instance=RequestContext(request))
         
+def search_runs(request):
+    """
+    search the output of runs for some text, optionally just the runs of
+    one command. The newest runs come first, a page at a time.
+    """
+    query = request.GET.get('q', '').strip()
+    command = None
+    if request.GET.get('command'):
+        command = get_object_or_404(Command, slug=request.GET['command'])
+    try:
+        before = int(request.GET.get('before') or 0) or None
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    error = False
+    try:
+        found = search.search(query, command and command.id, before)
+    except search.SearchError:
+        found = []
+        error = True
+
+    # runs deleted since they were indexed are left out
+    runs = Run.objects.summaries().in_bulk([run_id for run_id, snippet
+        in found])
+    results = [{
+        'run': runs[run_id],
+        'snippet': search.highlight(snippet),
+    } for run_id, snippet in found if run_id in runs]
+
+    context = {
+        'query': query,
+        'command': command,
+        'results': results,
+        'error': error,
+        'next': len(found) == search.RESULTS and found[-1][0] or None,
+    }
+    return render_to_response('search.html', context,
+        context_instance=RequestContext(request))
+
+def run_state(request, command, run):
+    """
+    The ETag, last modified date and lifetime of the page for a run. While
+    it's running output is added without changing the updated date, so we
+    go by how much output there is. Once it's finished it won't change.
+    """
+    try:
+        state = Run.objects.filter(id=run, command__slug=command).order_by(
+            ).values('status', 'output_length', 'updated_date',
+            'command__updated_date')[0]
+    except (IndexError, ValueError):
+        return None
+    etag = "run-%s-%s-%s-%s" % (run, state['status'], state['output_length'],
+        state['command__updated_date'].isoformat())
+    if state['status'] in UNFINISHED:
+        return etag, None, None
+    last_modified = max(state['updated_date'], state['command__updated_date'])
+    return etag, last_modified, IMMUTABLE_MAX_AGE
+
+@conditional(run_state)
 def show_run(request, command, run):
-    "show an individual run. This will show the output once it's been recieved"
+    """
+    show an individual run. This will show the output once it's been 
+    recieved. Long output is shown a page at a time, starting at the end.
+    """
 
     try:
         # we're checking the id and the command at the same time
-        existing_run = Run.objects.get(id=run, command__slug=command)
+        existing_run = Run.objects.select_related('command').get(
+            id=run, command__slug=command)
+
+        # show the page of output from the requested offset, or the end
+        try:
+            start = int(request.GET['start'])
+        except (KeyError, ValueError):
+            start, output = existing_run.tail_output(OUTPUT_PAGE_SIZE)
+        else:
+            start = max(0, min(start, existing_run.output_length))
+            output = existing_run.read_output(start, start + OUTPUT_PAGE_SIZE)
+        end = start + len(output)
+
         context = {
             'run': existing_run,
+            'output': output,
+            'has_earlier': start > 0,
+            'earlier': max(0, start - OUTPUT_PAGE_SIZE),
+            'has_later': end < existing_run.output_length,
+            'later': end,
+            'in_progress': not existing_run.is_finished(),
         }
         return render_to_response('show_run.html', context,
             context_instance=RequestContext(request))
@@ -140,45 +400,174 @@ def show_run(request, command, run):
         # the run doesn't exist so throw a 404
         raise Http404
 
+def tail_run(request, command, run):
+    """
+    Return any output after the given offset along with the status of the
+    run as JSON. If there isn't any new output yet we wait for some, or for
+    the run to finish, for up to TAIL_TIMEOUT seconds, checking after
+    TAIL_INTERVAL seconds and then less often. This lets a page watch a run
+    without reloading it.
+    """
+    try:
+        offset = max(0, int(request.GET.get('offset', 0)))
+    except ValueError:
+        return HttpResponseBadRequest()
+
+    # we only need the status and length to know if there's anything new
+    runs = Run.objects.only('status', 'output_length')
+    try:
+        existing_run = runs.get(id=run, command__slug=command)
+    except Run.DoesNotExist:
+        raise Http404
+
+    deadline = time.time() + settings.TAIL_TIMEOUT
+    interval = settings.TAIL_INTERVAL
+    while existing_run.output_length <= offset and \
+            not existing_run.is_finished() and time.time() < deadline:
+        time.sleep(max(0, min(interval, deadline - time.time())))
+        interval *= 2
+        existing_run = runs.get(id=existing_run.id)
+
+    offset = min(offset, existing_run.output_length)
+    output = existing_run.read_output(offset, offset + OUTPUT_PAGE_SIZE)
+    offset += len(output)
+    obj = {
+        'offset': offset,
+        'output': output,
+        'status': existing_run.status,
+        'complete': existing_run.is_finished() and \
+            offset >= existing_run.output_length,
+    }
+    return HttpResponse(simplejson.dumps(obj),
+        content_type = 'application/javascript; charset=utf8'
+    )
+
+@cache_view('show_command', [COMMANDS, RUNS])
 def show_command(request, command):
     "show an individual command, along with the last few runs"
 
     # throw a 404 if we don't find anything
     existing_command = get_object_or_404(Command, slug__iexact=command)
     
-    # get all runs
-    runs = Run.objects.filter(command=existing_command)
-    
-    paginator = Paginator(runs, 10) # Show 10 runs per page
+    # get a page of runs for this command
+    run_list = page_from_request(request,
+        Run.objects.summaries().filter(command=existing_command))
 
-    # Make sure page request is an int. If not, deliver first page.
-    try:
-        page = int(request.GET.get('page', '1'))
-    except ValueError:
-        page = 1
-
-    # If page request (9999) is out of range, deliver last page of results.
-    try:
-        run_list = paginator.page(page)
-    except (EmptyPage, InvalidPage):
-        run_list = paginator.page(paginator.num_pages)
+    # a row of statistics per day, so the trend is one small query
+    days = list(CommandStat.objects.recent(COMMAND_STATS_DAYS).filter(
+        command=existing_command))
     
     context = {
         'command': existing_command,
         'runs': run_list,
+        'days': days,
+        'summary': combine(days),
+        'stats_days': COMMAND_STATS_DAYS,
     }
     return render_to_response('show_command.html', context,
         context_instance=RequestContext(request))
         
+def queue_depths(request):
+    """
+    How many runs are waiting for each target and how many listeners it
+    has, or None if we can't reach the message queue. The queue is only
+    asked every few seconds, however often the dashboard is loaded, and
+    if it can't be reached we don't try again for as long, so a broker
+    which is down doesn't hold up every request. The answer is kept on
+    the request, which asks more than once.
+    """
+    if not hasattr(request, 'queue_depths'):
+        request.queue_depths = fetch_queue_depths()
+    return request.queue_depths
+
+def fetch_queue_depths():
+    "the queue depths from the cache, or the message queue if need be"
+    if not settings.QUEUE_COMMANDS:
+        return []
+    key = "asteroid:queue_depths"
+    queues = cache.get(key)
+    if queues == UNREACHABLE:
+        return None
+    if queues is None:
+        targets = Command.objects.targets()
+        try:
+            depths = get_publisher().queue_depths(targets)
+        except CONNECTION_ERRORS:
+            cache.set(key, UNREACHABLE, QUEUE_DEPTH_TIMEOUT)
+            return None
+        queues = []
+        for target in targets:
+            waiting, listeners = depths[target] or (0, 0)
+            queues.append({
+                'target': target,
+                'queue': queue_name(target),
+                'waiting': waiting,
+                'listeners': listeners,
+            })
+        cache.set(key, queues, QUEUE_DEPTH_TIMEOUT)
+    return queues
+
+def dashboard_state(request):
+    """
+    The ETag and last modified date of the dashboard. Every run updates the
+    command it belongs to, so the commands tell us when anything on the
+    page last changed. Deletions don't change any dates, but do change the
+    cache versions.
+    """
+    state = Command.objects.aggregate(Count('id'), Max('updated_date'),
+        Max('last_run_date'))
+    dates = [date for date in (state['updated_date__max'],
+        state['last_run_date__max']) if date is not None]
+    last_modified = dates and max(dates) or None
+    etag = md5_constructor(":".join([str(value) for value in [
+        state['id__count'], state['updated_date__max'],
+        state['last_run_date__max'], queue_depths(request)] +
+        get_versions([COMMANDS, RUNS])
+    ])).hexdigest()
+    return etag, last_modified, None
+
+class RecentStats(object):
+    """
+    The recent statistics of some commands, which are only loaded if a
+    template asks for them
+    """
+
+    def __init__(self, commands, days):
+        self.commands = commands
+        self.days = days
+
+    def by_command(self):
+        "each command which has been run recently, with its statistics"
+        summaries = CommandStat.objects.summaries(self.days)
+        return [(command, summaries[command.id]) for command in self.commands
+            if command.id in summaries]
+
+@instrumented('dashboard')
+@conditional(dashboard_state)
 def dashboard(request):
     "make a nice homepage dashboard with the commands and latest runs"
 
+    # the command status is stored on the command and the run titles come
+    # from a join, so this is a fixed number of queries however many
+    # commands we have. The querysets are only run if the template doesn't
+    # have the lists cached
     commands = Command.objects.filter()
-    runs = Run.objects.filter()[:20]
+    runs = Run.objects.summaries()[:20]
 
     context = {
         'commands': commands,
         'runs': runs,
+        'stats': RecentStats(commands, DASHBOARD_STATS_DAYS),
+        'queues': queue_depths(request),
+        'queueing': settings.QUEUE_COMMANDS,
     }
     return render_to_response('dashboard.html', context,
         context_instance=RequestContext(request))
+
+def show_metrics(request):
+    """
+    the metrics of this process in the Prometheus text format, for a
+    scraper or a person to read
+    """
+    return HttpResponse(metrics.REGISTRY.expose(),
+        content_type=metrics.CONTENT_TYPE)
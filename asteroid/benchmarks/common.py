@@ -0,0 +1,75 @@
+"""
+Shared helpers for the benchmarks. Each benchmark is a script which can be
+run from this directory and prints its results as JSON, so runs can be
+saved and compared over time.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+BENCHMARKS_ROOT = os.path.dirname(os.path.realpath(__file__))
+
+def setup_paths():
+    "put the application on the python path the same way manage.py does"
+    for path in ('../../', '../apps', '../../ext'):
+        path = os.path.realpath(os.path.join(BENCHMARKS_ROOT, path))
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+        'asteroid.configs.common.settings')
+
+def setup_database(path=None):
+    """
+    use an sqlite database for the benchmark, creating the tables if it's
+    new. Without a path a throwaway database is created, which the caller
+    should delete. Returns the path.
+    """
+    from django.conf import settings
+    if path is None:
+        handle, path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+    settings.DATABASE_ENGINE = 'sqlite3'
+    settings.DATABASE_NAME = path
+    from django.core.management import call_command
+    call_command('syncdb', interactive=False, verbosity=0)
+    return path
+
+def percentile(values, percent):
+    "the value below which the given percentage of the sorted values fall"
+    if not values:
+        return 0
+    index = int(round((len(values) - 1) * percent / 100.0))
+    return values[index]
+
+def summarise(timings, elapsed=None):
+    "turn a list of timings in seconds into latency and throughput figures"
+    timings = sorted(timings)
+    if elapsed is None:
+        elapsed = sum(timings)
+    count = len(timings)
+    return {
+        'count': count,
+        'seconds': round(elapsed, 6),
+        'per_second': elapsed and round(count / elapsed, 2) or 0,
+        'mean_ms': count and round(sum(timings) / count * 1000, 4) or 0,
+        'p50_ms': round(percentile(timings, 50) * 1000, 4),
+        'p95_ms': round(percentile(timings, 95) * 1000, 4),
+        'max_ms': count and round(timings[-1] * 1000, 4) or 0,
+    }
+
+def measure(func, count):
+    "call func count times, timing each call"
+    timings = []
+    start = time.time()
+    for i in xrange(count):
+        before = time.time()
+        func()
+        timings.append(time.time() - before)
+    return summarise(timings, time.time() - start)
+
+def output(results):
+    "print results as JSON"
+    from django.utils import simplejson
+    print simplejson.dumps(results, indent=2, sort_keys=True)
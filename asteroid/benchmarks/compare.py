@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Compare two sets of results saved by run_all.py, showing how the timings,
+throughput and query counts of each benchmark changed.
+
+    ./compare.py before.json after.json
+"""
+
+import sys
+
+from common import setup_paths
+setup_paths()
+
+from django.utils import simplejson
+
+# the figures worth comparing, by the end of their name
+COMPARED = ('_ms', 'per_second', '_queries', 'seconds')
+
+def figures(results, prefix=''):
+    "flatten nested results into dotted names and their values"
+    found = {}
+    for key, value in results.items():
+        name = prefix and "%s.%s" % (prefix, key) or key
+        if isinstance(value, dict):
+            found.update(figures(value, name))
+        elif isinstance(value, (int, long, float)) and not isinstance(value,
+                bool) and key.endswith(COMPARED):
+            found[name] = value
+    return found
+
+def change(before, after):
+    "the change from before to after as a percentage"
+    if not before:
+        return ""
+    return "%+.1f%%" % ((after - before) * 100.0 / before)
+
+def main():
+    if len(sys.argv) != 3:
+        print >> sys.stderr, "usage: %s before.json after.json" % sys.argv[0]
+        sys.exit(1)
+    before, after = [simplejson.load(open(path)) for path in sys.argv[1:]]
+    print "before: %s %s" % (before.get('commit'), before.get('date'))
+    print "after:  %s %s" % (after.get('commit'), after.get('date'))
+    before_figures = figures(before['benchmarks'])
+    after_figures = figures(after['benchmarks'])
+    for name in sorted(set(before_figures) & set(after_figures)):
+        print "%-50s %14s %14s %9s" % (name, before_figures[name],
+            after_figures[name], change(before_figures[name],
+            after_figures[name]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+Time how many jobs the listener gets through, from taking messages off
+the queue to the web tier hearing how they went. The listener is run as
+it is in production, but against an in memory broker and a stand in for
+the web hooks which just counts the results, so only the listener itself
+and the commands it runs are being timed.
+
+Messages are only acknowledged once their results have been delivered,
+and the broker hands out no more unacknowledged messages than there are
+workers, so with quick commands the wait for a batch of results to be
+sent is usually what limits throughput.
+
+    ./listener.py --jobs 500 --workers 4 --command true
+"""
+
+import BaseHTTPServer
+import SocketServer
+import imp
+import os
+import threading
+import time
+from optparse import OptionParser
+
+from common import setup_paths, BENCHMARKS_ROOT, output
+setup_paths()
+
+from django.utils import simplejson
+
+from stub_broker import MemoryBroker
+
+LISTENER = os.path.join(BENCHMARKS_ROOT, '..', 'bin', 'asteroid_listen.py')
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ResultSink(object):
+    "stands in for the web hooks, counting the results posted to it"
+
+    def __init__(self):
+        self.posts = 0
+        self.results = 0
+        self.finished_at = None
+        self.closed = False
+        self.lock = threading.Lock()
+        sink = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            # so the listener can keep its connections open
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                results = simplejson.loads(body)
+                if not isinstance(results, list):
+                    results = [results]
+                sink.record(results)
+                reply = simplejson.dumps(dict([(str(result.get('run')), "ok")
+                    for result in results]))
+                self.send_response(200)
+                self.send_header("Content-Type", "application/javascript")
+                self.send_header("Content-Length", str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingServer):
+            def handle_error(self, request, client_address):
+                # connections the listener left open are cut off at exit
+                if not sink.closed:
+                    ThreadingServer.handle_error(self, request,
+                        client_address)
+
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+    def record(self, results):
+        self.lock.acquire()
+        try:
+            self.posts += 1
+            for result in results:
+                if 'status' in result:
+                    self.results += 1
+                    self.finished_at = time.time()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.closed = True
+        self.server.shutdown()
+        self.server.server_close()
+
+def histogram_mean(metrics, name):
+    "the mean of a histogram the listener keeps, in milliseconds"
+    histogram = metrics.get(name)
+    if not histogram.count():
+        return None
+    return round(histogram.sum() / histogram.count() * 1000, 4)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--jobs', type='int', default=500,
+        help='how many jobs to put on the queue')
+    parser.add_option('--workers', type='int', default=4,
+        help='how many commands the listener runs at once')
+    parser.add_option('--command', default='true',
+        help='the command each job runs')
+    options, args = parser.parse_args()
+
+    listen = imp.load_source('asteroid_listen', LISTENER)
+    listen.DEBUG = False
+    broker = MemoryBroker()
+    listen.amqp = broker.client()
+    sink = ResultSink()
+
+    # every job is queued up front, so the listener is never kept waiting
+    for i in range(options.jobs):
+        broker.put(listen.queue_name(listen.DEFAULT_TARGET), simplejson.dumps({
+            'webhook': "%s/commands/benchmark/%s/hook/" % (sink.url, i),
+            'batch_webhook': "%s/hooks/" % sink.url,
+            'run': i,
+            'slug': "benchmark",
+            'command': options.command,
+            'queued_at': time.time(),
+        }))
+    # and once they've all been taken the listener is told to stop, which
+    # it does once it's finished them
+    broker.stop = listen.Shutdown
+
+    start = time.time()
+    try:
+        listen.run("localhost", "asteroid", workers=options.workers)
+    except SystemExit:
+        pass
+    elapsed = (sink.finished_at or time.time()) - start
+    sink.close()
+
+    metrics = listen.metrics
+    output({
+        'benchmark': 'listener',
+        'jobs': options.jobs,
+        'workers': options.workers,
+        'command': options.command,
+        'seconds': round(elapsed, 6),
+        'jobs_per_second': round(sink.results / elapsed, 2),
+        'delivered': sink.results,
+        'posts': sink.posts,
+        'acked': broker.acked,
+        'rejected': broker.rejected,
+        'queue_wait_mean_ms': histogram_mean(metrics,
+            'asteroid_listener_queue_wait_seconds'),
+        'pool_wait_mean_ms': histogram_mean(metrics,
+            'asteroid_listener_pool_wait_seconds'),
+        'execution_mean_ms': histogram_mean(metrics,
+            'asteroid_listener_execution_seconds'),
+        'webhook_mean_ms': histogram_mean(metrics,
+            'asteroid_listener_webhook_seconds'),
+        'webhook_retries': metrics.get(
+            'asteroid_listener_webhook_retries_total').value(),
+    })
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Compare publishing runs over a new connection each time, as runs used to
+be, with the long lived publisher now used. Both publish to a local stub
+broker which can add latency to each round trip.
+
+    ./publish.py --count 1000 --latency 0.001
+"""
+
+import time
+from optparse import OptionParser
+
+from common import setup_paths, measure, output
+setup_paths()
+
+from stub_broker import StubBroker
+from runner import publisher
+
+BODY = '{"webhook": "http://localhost:8001/commands/test/1/hook/", "command": "ls"}'
+
+def publish_with_new_connection(amqp):
+    "the way runs used to be published"
+    conn = amqp.Connection('localhost')
+    chan = conn.channel()
+    chan.exchange_declare(exchange='asteroid', type="direct",
+        durable=False, auto_delete=True)
+    chan.basic_publish(amqp.Message(BODY), exchange="asteroid",
+        routing_key="all")
+    chan.close()
+    conn.close()
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--count', type='int', default=1000,
+        help='how many messages to publish each way')
+    parser.add_option('--latency', type='float', default=0.0005,
+        help='seconds the broker waits before each reply')
+    options, args = parser.parse_args()
+
+    broker = StubBroker(options.latency)
+    amqp = broker.client()
+
+    results = {
+        'benchmark': 'publish',
+        'count': options.count,
+        'latency': options.latency,
+    }
+    results['new_connection'] = measure(
+        lambda: publish_with_new_connection(amqp), options.count)
+
+    publisher.amqp = amqp
+    pooled = publisher.Publisher('localhost')
+    results['pooled'] = measure(lambda: pooled.publish(BODY), options.count)
+    pooled.close()
+
+    # publishing doesn't wait for the broker, so check it got everything
+    deadline = time.time() + 5
+    while len(broker.messages) < options.count * 2 and time.time() < deadline:
+        time.sleep(0.01)
+    results['delivered'] = len(broker.messages)
+
+    output(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Run every benchmark and save their results together as JSON, along with
+when and against which commit they were run, so they can be compared with
+compare.py. Each benchmark runs in its own process so they don't disturb
+each other.
+
+    ./run_all.py --database /var/tmp/asteroid_bench.db --output before.json
+    ./run_all.py --quick
+"""
+
+import os
+import subprocess
+import sys
+from datetime import datetime
+from optparse import OptionParser
+
+from common import setup_paths, BENCHMARKS_ROOT, output
+setup_paths()
+
+from django.utils import simplejson
+
+# the benchmarks and their options, full sized and quick
+BENCHMARKS = (
+    ('publish', [], ['--count', '200']),
+    ('trigger', [], ['--batches', '5']),
+    ('web', [], ['--requests', '10']),
+    ('listener', [], ['--jobs', '20']),
+)
+
+def git_commit():
+    "the commit being benchmarked, if we can tell"
+    try:
+        process = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+            cwd=BENCHMARKS_ROOT, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    except OSError:
+        return None
+    commit = process.communicate()[0].strip()
+    return process.returncode == 0 and commit or None
+
+def run_benchmark(name, arguments):
+    "run a benchmark script, returning its results"
+    script = os.path.join(BENCHMARKS_ROOT, '%s.py' % name)
+    process = subprocess.Popen([sys.executable, script] + arguments,
+        cwd=BENCHMARKS_ROOT, stdout=subprocess.PIPE)
+    stdout = process.communicate()[0]
+    if process.returncode != 0:
+        raise RuntimeError("The %s benchmark failed" % name)
+    return simplejson.loads(stdout)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--database',
+        help='a database filled by seed.py for the web benchmark')
+    parser.add_option('--quick', action='store_true', default=False,
+        help='run smaller benchmarks, to check they work')
+    parser.add_option('--only', action='append',
+        help='run just this benchmark, can be given more than once')
+    parser.add_option('--output',
+        help='save the results to this file rather than printing them')
+    options, args = parser.parse_args()
+
+    results = {
+        'date': datetime.today().isoformat(),
+        'commit': git_commit(),
+        'python': sys.version.split()[0],
+        'quick': options.quick,
+        'benchmarks': {},
+    }
+    for name, full, quick in BENCHMARKS:
+        if options.only and name not in options.only:
+            continue
+        arguments = list(options.quick and quick or full)
+        if name == 'web' and options.database:
+            arguments += ['--database', options.database]
+        print >> sys.stderr, "running %s" % name
+        results['benchmarks'][name] = run_benchmark(name, arguments)
+
+    if options.output:
+        results_file = open(options.output, 'w')
+        try:
+            simplejson.dump(results, results_file, indent=2, sort_keys=True)
+        finally:
+            results_file.close()
+    else:
+        output(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Fill a database with made up commands and runs for the other benchmarks
+to work against. Rows are inserted a batch at a time straight through the
+database cursor, as creating millions of runs through the models would
+take hours. A fixed random seed means the same options always give the
+same data.
+
+Most runs have no output. The latest runs of a few commands are given
+large outputs, stored in compressed chunks the way compacted output is.
+The daily statistics are worked out at the end, but runs aren't added to
+the search index unless asked for.
+
+    ./seed.py --database /var/tmp/asteroid_bench.db --commands 10000 \\
+        --runs 5000000 --large-runs 50 --output-size 1048576
+"""
+
+import random
+import time
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+from common import setup_paths, setup_database, output
+setup_paths()
+
+# how many rows to insert at a time
+BATCH_SIZE = 10000
+
+# the fraction of finished runs which failed
+FAILURE_RATE = 0.1
+# the fraction of runs still in progress
+IN_PROGRESS_RATE = 0.01
+
+def insert(table, columns, rows):
+    "insert rows into a table in batches"
+    from django.db import connection, transaction
+    sql = "INSERT INTO %s (%s) VALUES (%s)" % (
+        connection.ops.quote_name(table),
+        ", ".join([connection.ops.quote_name(column) for column in columns]),
+        ", ".join(["%s"] * len(columns)))
+    cursor = connection.cursor()
+    batch = []
+    count = 0
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH_SIZE:
+            cursor.executemany(sql, batch)
+            transaction.commit_unless_managed()
+            count += len(batch)
+            batch = []
+    if batch:
+        cursor.executemany(sql, batch)
+        transaction.commit_unless_managed()
+        count += len(batch)
+    return count
+
+def db_date(date):
+    from django.db import connection
+    return connection.ops.value_to_db_datetime(date)
+
+def make_commands(count, now):
+    for i in xrange(count):
+        created = db_date(now - timedelta(days=365))
+        yield ("Command %s" % i, "command-%s" % i, created, created,
+            "Made up command number %s" % i, "echo %s" % i, "", "allow",
+            False)
+
+def make_runs(rng, commands, count, days, now):
+    "runs spread over the last few days, oldest first"
+    span = days * 86400
+    for i in xrange(count):
+        started = now - timedelta(seconds=span * (count - i) / count)
+        command_id = rng.randint(1, commands)
+        if rng.random() < IN_PROGRESS_RATE:
+            yield (db_date(started), db_date(started), command_id,
+                "echo %s" % command_id, 0, "in_progress", db_date(started),
+                None, None, None)
+            continue
+        duration = rng.expovariate(1 / 30.0)
+        finished = started + timedelta(seconds=duration)
+        failed = rng.random() < FAILURE_RATE
+        yield (db_date(started), db_date(finished), command_id,
+            "echo %s" % command_id, 0, failed and "failed" or "succeeded",
+            db_date(started), db_date(finished), failed and 1 or 0, duration)
+
+def make_output(size, seed):
+    "a made up build log of about size characters"
+    lines = []
+    length = 0
+    i = 0
+    while length < size:
+        line = "[%06d] step %s: compiled module_%s.c in %sms, %s warnings\n" % (
+            i, seed, i % 97, (i * 7919) % 1000, i % 3)
+        lines.append(line)
+        length += len(line)
+        i += 1
+    return "".join(lines)[:size]
+
+def add_output(run_ids, size):
+    "give runs large outputs, stored in compacted chunks"
+    from django.db import transaction
+    from runner.compression import compress, COMPACT_SIZE
+    from runner.models import Run, OutputChunk
+    text = unicode(make_output(size, 0))
+    # each chunk is compressed once and shared between the runs
+    chunks = []
+    for offset in xrange(0, len(text), COMPACT_SIZE):
+        encoding, data, original_size = compress(text[offset:offset +
+            COMPACT_SIZE])
+        chunks.append((offset, data, encoding, original_size))
+    insert(OutputChunk._meta.db_table,
+        ('run_id', 'offset', 'data', 'encoding', 'original_size'),
+        ((run_id, offset, data, encoding, original_size)
+            for run_id in run_ids
+            for offset, data, encoding, original_size in chunks))
+    Run.objects.filter(id__in=run_ids).update(output_length=len(text))
+    transaction.commit_unless_managed()
+
+def record_latest_runs():
+    "fill in the details of the latest run of each command"
+    from django.db import connection, transaction
+    from runner.models import Command, Run
+    qn = connection.ops.quote_name
+    connection.cursor().execute("""
+        UPDATE %(command)s SET
+            last_run_id = (SELECT MAX(id) FROM %(run)s
+                WHERE %(run)s.command_id = %(command)s.id),
+            last_run_status = (SELECT status FROM %(run)s WHERE id =
+                (SELECT MAX(id) FROM %(run)s
+                WHERE %(run)s.command_id = %(command)s.id)),
+            last_run_date = (SELECT updated_date FROM %(run)s WHERE id =
+                (SELECT MAX(id) FROM %(run)s
+                WHERE %(run)s.command_id = %(command)s.id))
+    """ % {'command': qn(Command._meta.db_table),
+        'run': qn(Run._meta.db_table)})
+    transaction.commit_unless_managed()
+
+def seed(commands, runs, large_runs=50, output_size=1024 * 1024, days=90,
+        index=False, seed=1, statistics=True):
+    """
+    add the commands and runs to an empty database, returning how long
+    each step took
+    """
+    from django.conf import settings
+    from django.core.management import call_command
+    from django.db import connection
+    from runner.models import Command, Run
+
+    if Command.objects.count():
+        raise ValueError("The database already has commands in it")
+    if settings.DATABASE_ENGINE == 'sqlite3':
+        # we can always seed again if the machine falls over
+        connection.cursor().execute("PRAGMA synchronous = OFF")
+
+    rng = random.Random(seed)
+    now = datetime.today()
+    timings = {}
+
+    start = time.time()
+    insert(Command._meta.db_table, ('title', 'slug', 'created_date',
+        'updated_date', 'description', 'command_to_run', 'target',
+        'concurrency', 'keep_failures'), make_commands(commands, now))
+    timings['commands_seconds'] = round(time.time() - start, 3)
+
+    start = time.time()
+    insert(Run._meta.db_table, ('created_date', 'updated_date', 'command_id',
+        'command_run', 'output_length', 'status', 'started_at',
+        'finished_at', 'exit_code', 'duration'),
+        make_runs(rng, commands, runs, days, now))
+    timings['runs_seconds'] = round(time.time() - start, 3)
+    timings['runs_per_second'] = round(runs / max(timings['runs_seconds'],
+        0.001), 2)
+
+    start = time.time()
+    record_latest_runs()
+    timings['latest_runs_seconds'] = round(time.time() - start, 3)
+
+    # the latest finished runs of a few commands get large outputs
+    start = time.time()
+    latest = list(Run.objects.exclude(status="in_progress").order_by('-id'
+        ).values_list('id', flat=True)[:large_runs])
+    add_output(latest, output_size)
+    timings['output_seconds'] = round(time.time() - start, 3)
+
+    if statistics:
+        start = time.time()
+        call_command('rebuild_stats', verbosity=0, batch_size=BATCH_SIZE)
+        timings['stats_seconds'] = round(time.time() - start, 3)
+
+    if index:
+        start = time.time()
+        call_command('rebuild_search_index', verbosity=0)
+        timings['index_seconds'] = round(time.time() - start, 3)
+    return timings
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--database',
+        help='the sqlite database to fill, which should be new')
+    parser.add_option('--commands', type='int', default=10000,
+        help='how many commands to create')
+    parser.add_option('--runs', type='int', default=5000000,
+        help='how many runs to create')
+    parser.add_option('--large-runs', type='int', default=50,
+        help='how many of the latest runs get large outputs')
+    parser.add_option('--output-size', type='int', default=1024 * 1024,
+        help='how many characters of output each of those has')
+    parser.add_option('--days', type='int', default=90,
+        help='how many days the runs are spread over')
+    parser.add_option('--index', action='store_true', default=False,
+        help='add the runs to the search index')
+    parser.add_option('--no-stats', action='store_false', dest='statistics',
+        default=True, help="don't work out the daily statistics, which is "
+        "the slowest part")
+    parser.add_option('--seed', type='int', default=1,
+        help='the random seed, change it for different data')
+    options, args = parser.parse_args()
+    if not options.database:
+        parser.error("--database is needed, the data is for other benchmarks")
+
+    setup_database(options.database)
+    results = {
+        'benchmark': 'seed',
+        'database': options.database,
+        'commands': options.commands,
+        'runs': options.runs,
+        'large_runs': options.large_runs,
+        'output_size': options.output_size,
+    }
+    results.update(seed(options.commands, options.runs, options.large_runs,
+        options.output_size, options.days, options.index, options.seed,
+        options.statistics))
+    output(results)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+A local stand in for the message queue, so the benchmarks can measure the
+cost of talking to a broker without needing RabbitMQ.
+
+The broker listens on a local TCP port and the client half mimics the
+parts of amqplib we use, making the same round trips a real AMQP client
+makes: three to open a connection, one to open a channel, one to declare an
+exchange and one each to close a channel and a connection. Publishing is
+one way, as it is in AMQP. Each reply can be delayed to simulate a broker
+on another machine.
+
+MemoryBroker is simpler again, keeping its queues in memory and handing
+messages straight to a consumer in the same process, so the listener can
+be timed without anything else running. A pipe stands in for the socket,
+becoming readable when there's a message to hand out, so the listener can
+wait on it the way it waits on a real broker.
+"""
+
+import os
+import socket
+import threading
+import time
+
+class StubBroker(object):
+    "Accepts connections and answers requests, keeping published messages"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.messages = []
+        self.lock = threading.Lock()
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(('127.0.0.1', 0))
+        self.server.listen(128)
+        self.port = self.server.getsockname()[1]
+        thread = threading.Thread(target=self.accept)
+        thread.setDaemon(True)
+        thread.start()
+
+    def accept(self):
+        while True:
+            client, address = self.server.accept()
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.setDaemon(True)
+            thread.start()
+
+    def handle(self, client):
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = client.makefile('rb')
+        try:
+            while True:
+                line = stream.readline()
+                if not line:
+                    break
+                parts = line.split()
+                if parts[0] == 'PUBLISH':
+                    exchange, routing_key, length = parts[1:]
+                    body = stream.read(int(length))
+                    self.lock.acquire()
+                    try:
+                        self.messages.append((exchange, routing_key, body))
+                    finally:
+                        self.lock.release()
+                    continue
+                if self.latency:
+                    time.sleep(self.latency)
+                client.sendall('OK\n')
+        finally:
+            stream.close()
+            client.close()
+
+    def client(self):
+        "return an object which can stand in for the amqplib module"
+        return StubAMQP(self.port)
+
+class StubAMQPException(Exception):
+    pass
+
+class StubMessage(object):
+    def __init__(self, body, **properties):
+        self.body = body
+        self.properties = properties
+
+class StubChannel(object):
+    def __init__(self, connection):
+        self.connection = connection
+        connection.request('CHANNEL')
+
+    def exchange_declare(self, exchange, type, **kwargs):
+        self.connection.request('DECLARE %s' % exchange)
+
+    def basic_publish(self, msg, exchange='', routing_key=''):
+        self.connection.send('PUBLISH %s %s %d\n%s' % (exchange,
+            routing_key or '-', len(msg.body), msg.body))
+
+    def close(self):
+        self.connection.request('CLOSE_CHANNEL')
+
+class StubConnection(object):
+    def __init__(self, port):
+        self.socket = socket.create_connection(('127.0.0.1', port))
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = self.socket.makefile('rb')
+        # start, tune and open
+        for step in ('START', 'TUNE', 'OPEN'):
+            self.request(step)
+
+    def send(self, data):
+        try:
+            self.socket.sendall(data)
+        except socket.error, e:
+            raise StubAMQPException(str(e))
+
+    def request(self, line):
+        "send a request and wait for the reply"
+        self.send(line + '\n')
+        if not self.stream.readline():
+            raise StubAMQPException("connection closed")
+
+    def channel(self):
+        return StubChannel(self)
+
+    def close(self):
+        self.request('CLOSE')
+        self.stream.close()
+        self.socket.close()
+
+class StubAMQP(object):
+    "Looks enough like amqplib.client_0_8 for our purposes"
+
+    AMQPException = StubAMQPException
+    Message = StubMessage
+
+    def __init__(self, port):
+        self.port = port
+
+    def Connection(self, host, **kwargs):
+        return StubConnection(self.port)
+
+class MemoryMessage(object):
+    "a message waiting in a MemoryBroker queue"
+
+    def __init__(self, body, delivery_tag):
+        self.body = body
+        self.delivery_tag = delivery_tag
+        self.delivery_info = {'redelivered': False}
+
+class MemoryBroker(object):
+    """
+    A broker which lives in the same process as its one consumer, for
+    timing the listener without a network in the way. Messages are handed
+    out no more than the prefetch count at a time until they're settled,
+    as a real broker does. Once every message has been handed out, waiting
+    for another raises the stop exception, if there is one.
+    """
+
+    def __init__(self):
+        self.queues = {}
+        self.consumers = {}
+        self.prefetch = 0
+        self.unsettled = 0
+        self.acked = 0
+        self.rejected = 0
+        self.next_tag = 1
+        self.stop = None
+        self.condition = threading.Condition()
+        # readable while there's something for wait to do
+        self.readable, self.signal = os.pipe()
+        self.signalled = False
+
+    def put(self, queue, body):
+        "add a message to a queue"
+        self.condition.acquire()
+        try:
+            self.queues.setdefault(queue, []).append(MemoryMessage(body,
+                self.next_tag))
+            self.next_tag += 1
+            self.update()
+        finally:
+            self.condition.release()
+
+    def settle(self, acked):
+        self.condition.acquire()
+        try:
+            self.unsettled -= 1
+            if acked:
+                self.acked += 1
+            else:
+                self.rejected += 1
+            self.update()
+        finally:
+            self.condition.release()
+
+    def consume(self, queue, callback):
+        "hand the messages on a queue to callback"
+        self.condition.acquire()
+        try:
+            self.consumers[queue] = callback
+            self.update()
+        finally:
+            self.condition.release()
+
+    def waiting(self):
+        "the queues with messages for the consumers"
+        return [queue for queue in self.consumers if self.queues.get(queue)]
+
+    def ready(self):
+        "whether waiting would hand out a message or stop"
+        if self.waiting():
+            return not self.prefetch or self.unsettled < self.prefetch
+        return self.stop is not None
+
+    def update(self):
+        "make the pipe readable if there's something to wait for, or not"
+        if self.ready() and not self.signalled:
+            os.write(self.signal, "x")
+            self.signalled = True
+        elif not self.ready() and self.signalled:
+            os.read(self.readable, 1)
+            self.signalled = False
+        self.condition.notify()
+
+    def next_message(self):
+        "wait for a message one of the consumers can have"
+        self.condition.acquire()
+        try:
+            while not self.ready():
+                self.condition.wait(0.1)
+            waiting = self.waiting()
+            if not waiting:
+                raise self.stop()
+            self.unsettled += 1
+            msg = self.queues[waiting[0]].pop(0)
+            self.update()
+            return waiting[0], msg
+        finally:
+            self.condition.release()
+
+    def client(self):
+        "return an object which can stand in for the amqplib module"
+        return MemoryAMQP(self)
+
+class MemoryChannel(object):
+    def __init__(self, broker):
+        self.broker = broker
+
+    def exchange_declare(self, exchange, type, **kwargs):
+        pass
+
+    def queue_declare(self, queue, **kwargs):
+        self.broker.queues.setdefault(queue, [])
+        return queue, len(self.broker.queues[queue]), 0
+
+    def queue_bind(self, queue, exchange, routing_key=''):
+        pass
+
+    def basic_qos(self, prefetch_size, prefetch_count, a_global):
+        self.broker.prefetch = prefetch_count
+
+    def basic_consume(self, queue, no_ack, callback, consumer_tag):
+        self.broker.consume(queue, callback)
+
+    def basic_cancel(self, consumer_tag):
+        pass
+
+    def basic_publish(self, msg, exchange='', routing_key=''):
+        self.broker.put(routing_key, msg.body)
+
+    def basic_ack(self, delivery_tag):
+        self.broker.settle(True)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.broker.settle(False)
+
+    def wait(self):
+        "hand the next message to its consumer"
+        queue, msg = self.broker.next_message()
+        self.broker.consumers[queue](msg)
+
+    def close(self):
+        pass
+
+    # amqplib keeps methods for the channel it has read but not dispatched
+    method_queue = ()
+
+class MemoryTransport(object):
+    "what the listener needs of an amqplib transport, the socket to wait on"
+
+    def __init__(self, broker):
+        self.sock = broker.readable
+
+class MemoryConnection(object):
+    def __init__(self, broker):
+        self.broker = broker
+        self.transport = MemoryTransport(broker)
+
+    def channel(self):
+        return MemoryChannel(self.broker)
+
+    def close(self):
+        pass
+
+class MemoryAMQP(object):
+    "Looks enough like amqplib.client_0_8 to run the listener"
+
+    AMQPException = StubAMQPException
+    Message = StubMessage
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def Connection(self, host, **kwargs):
+        return MemoryConnection(self.broker)
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Compare starting a batch of runs one request at a time, the way clicking
+run on each command does, with starting them all together. Runs are
+published to a local stub broker and stored in a throwaway sqlite
+database.
+
+    ./trigger.py --commands 15 --batches 20 --latency 0.0005
+"""
+
+import os
+import time
+from optparse import OptionParser
+
+from common import setup_paths, setup_database, summarise, output
+setup_paths()
+
+from django.conf import settings
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--commands', type='int', default=15,
+        help='how many commands to trigger in each batch')
+    parser.add_option('--batches', type='int', default=20,
+        help='how many batches to trigger each way')
+    parser.add_option('--latency', type='float', default=0.0005,
+        help='seconds the broker waits before each reply')
+    options, args = parser.parse_args()
+
+    path = setup_database()
+    try:
+        from stub_broker import StubBroker
+        from runner import publisher
+        from runner.models import Command, trigger_many
+
+        broker = StubBroker(options.latency)
+        publisher.amqp = broker.client()
+        settings.QUEUE_COMMANDS = True
+
+        commands = [Command.objects.create(
+            title = "command %s" % i,
+            slug = "command-%s" % i,
+            command_to_run = "true",
+        ) for i in range(options.commands)]
+
+        results = {
+            'benchmark': 'trigger',
+            'commands': options.commands,
+            'batches': options.batches,
+            'latency': options.latency,
+        }
+
+        # time each batch, and report runs per second
+        for name, trigger in (
+                ('one_at_a_time', lambda: [command.trigger()
+                    for command in commands]),
+                ('together', lambda: trigger_many(commands))):
+            timings = []
+            start = time.time()
+            for i in range(options.batches):
+                before = time.time()
+                trigger()
+                timings.append(time.time() - before)
+            elapsed = time.time() - start
+            results[name] = summarise(timings, elapsed)
+            results[name]['runs_per_second'] = round(
+                options.commands * options.batches / elapsed, 2)
+
+        # publishing doesn't wait for the broker, so check it got everything
+        expected = options.commands * options.batches * 2
+        deadline = time.time() + 5
+        while len(broker.messages) < expected and time.time() < deadline:
+            time.sleep(0.01)
+        results['delivered'] = len(broker.messages)
+        results['expected'] = expected
+
+        output(results)
+    finally:
+        os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Time the busiest pages and the web hook against a database full of runs,
+reporting the latency, throughput and number of queries of each. Requests
+go through the whole stack, middleware included, using the django test
+client, so there's no web server in the way.
+
+Give it a database filled by seed.py to see how things hold up with lots
+of data. Timing the web hook adds a few finished runs to it each time.
+Without a database a small throwaway one is seeded first. Caching is
+turned off unless asked for, so the work the views do is measured rather
+than how fast the cache is.
+
+    ./web.py --database /var/tmp/asteroid_bench.db --requests 50
+"""
+
+import os
+import random
+import time
+from optparse import OptionParser
+
+from common import setup_paths, setup_database, summarise, output
+setup_paths()
+
+from django.conf import settings
+
+# the size of the database seeded when none is given
+SMALL_COMMANDS = 200
+SMALL_RUNS = 20000
+SMALL_LARGE_RUNS = 10
+
+def measure_requests(client, requests):
+    """
+    make each of the requests, a method, path and body, timing each one
+    and counting its queries
+    """
+    from runner import metrics
+    timings = []
+    queries = []
+    errors = 0
+    start = time.time()
+    for method, path, body in requests:
+        before_queries = metrics.query_time()[0]
+        before = time.time()
+        if method == "POST":
+            response = client.post(path, body,
+                content_type='application/json')
+        else:
+            response = client.get(path)
+        timings.append(time.time() - before)
+        queries.append(metrics.query_time()[0] - before_queries)
+        if response.status_code != 200:
+            errors += 1
+    results = summarise(timings, time.time() - start)
+    results['mean_queries'] = round(float(sum(queries)) / len(queries), 2)
+    results['max_queries'] = max(queries)
+    results['errors'] = errors
+    return results
+
+def build_requests(rng, count):
+    "the requests to time for each view"
+    from runner.models import Command, Run
+    command_ids = list(Command.objects.values_list('id', flat=True))
+    commands = Command.objects.in_bulk(rng.sample(command_ids,
+        min(count, len(command_ids))))
+    slugs = [command.slug for command in commands.values()]
+    # the runs with the most output are the interesting ones to show
+    runs = list(Run.objects.select_related('command').order_by(
+        '-output_length', '-id')[:count])
+    # the web hook needs runs which are still going
+    hooked = Run.objects.create_many([rng.choice(commands.values())
+        for i in range(count)])
+    result = '{"status": 0, "output": "done"}'
+    return [
+        ('dashboard', [("GET", "/", None)] * count),
+        ('list_runs', [("GET", "/runs/", None)] * count),
+        ('show_command', [("GET", "/commands/%s/" % slugs[i % len(slugs)],
+            None) for i in range(count)]),
+        ('show_run', [("GET", "%s/" % runs[i % len(runs)].get_absolute_url(),
+            None) for i in range(count)]),
+        ('run_web_hook', [("POST", "%s/hook/" % run.get_absolute_url(),
+            result) for run in hooked]),
+    ]
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--database',
+        help='a database filled by seed.py, otherwise a small one is made')
+    parser.add_option('--requests', type='int', default=50,
+        help='how many requests to make of each view')
+    parser.add_option('--cache', default='dummy://',
+        help='the cache to use, for instance locmem:// to include caching')
+    parser.add_option('--seed', type='int', default=1,
+        help='the random seed used to pick commands')
+    options, args = parser.parse_args()
+
+    # the cache is set up when it's first imported
+    settings.CACHE_BACKEND = options.cache
+    settings.DEBUG = False
+    settings.QUEUE_COMMANDS = False
+    settings.BACKGROUND_COMMANDS = False
+
+    path = setup_database(options.database)
+    try:
+        if options.database is None:
+            from seed import seed
+            seed(SMALL_COMMANDS, SMALL_RUNS, SMALL_LARGE_RUNS)
+
+        from django.test.client import Client
+        from runner.models import Command, Run
+
+        results = {
+            'benchmark': 'web',
+            'requests': options.requests,
+            'cache': options.cache,
+            'commands': Command.objects.count(),
+            'runs': Run.objects.count(),
+        }
+        client = Client()
+        # the first request loads the middleware and url patterns
+        client.get('/')
+        for name, requests in build_requests(random.Random(options.seed),
+                options.requests):
+            results[name] = measure_requests(client, requests)
+        output(results)
+    finally:
+        if options.database is None:
+            os.unlink(path)
+
+if __name__ == '__main__':
+    main()
@@ -1,106 +1,697 @@
 #!/usr/bin/env python
 
 """
-Self contained script which listens for commands on the queue, executes
-them locally and then sends an http request back to the webhook url
-with the results.
+Script which listens for commands on the queue, executes them locally and
+then sends an http request back to the webhook url with the results. It
+runs on machines without the web tier's settings, so only uses the parts
+of runner which don't need them, found in the apps directory beside it.
+
+Messages are only acknowledged once their results have been delivered,
+and the queues are durable, so nothing is lost if the listener or the
+broker is stopped. Messages which can't be run or whose results can't be
+delivered are rejected, and the broker moves them to the dead letter
+queue where they can be looked at later.
+
+Given --metrics-port the listener serves metrics at /metrics in the
+Prometheus text format, including how many commands it's running, how
+long messages waited and how often posting results had to be retried.
 """
 
 # standard library
 import sys
-import commands
+import os
+import time
+import select
+import signal
+import socket
+import threading
+import traceback
+import BaseHTTPServer
+import Queue
+from optparse import OptionParser
 
 # external
 import httplib2
 from django.utils import simplejson
 from amqplib import client_0_8 as amqp
 
+# the parts of runner which don't need django, shared with the web tier
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    '..', 'apps'))
+from runner.executor import execute
+from runner.prometheus import Registry, Counter, Gauge, Histogram, \
+    CONTENT_TYPE as METRICS_CONTENT_TYPE
+from runner.queues import EXCHANGE, DEFAULT_TARGET, queue_name
+
 # devine the location of your message queue
 QUEUE_ADDRESS = '172.16.142.128'
 DEBUG = True
 
-def recv_callback(msg):
-    "Callback function each time a message is recieved"
+# how many commands to run at the same time
+WORKERS = 4
+
+# the longest the main thread waits for the broker before sending the acks
+# and rejects the workers have left it, in seconds
+SETTLE_INTERVAL = 0.1
+
+# where rejected messages end up
+DEAD_LETTER_EXCHANGE = "asteroid_dead"
+DEAD_LETTER_QUEUE = "asteroid_dead_letters"
+
+# the reply code the broker closes the channel with when we declare an
+# exchange or queue differently to how it already exists
+PRECONDITION_FAILED = 406
+UPGRADE_MESSAGE = """The message queue refused our exchange or queues: %s
+
+They were probably left by an older version of asteroid which didn't make
+them durable. Stop every listener, delete the %s exchange and the
+asteroid_ queues from the broker, then start the listeners again."""
+
+# added to the output of runs which were being run when their listener
+# stopped
+LOST_MESSAGE = "The listener running this command stopped before it finished."
+
+# how much output which couldn't be sent to hold on to, to try again with
+# the next piece. Past this the run's output would have a hole in it, so
+# we give up on it
+MAX_UNSENT = 16 * 1024 * 1024
+
+# how many finished runs to send to the batch webhook at once
+BATCH_SIZE = 50
+# and the longest a result waits for others to join it, in seconds
+BATCH_INTERVAL = 1
+# how many batches a result is sent in before we give up on it. The web
+# tier may have recorded a batch whose reply we never got, so rather than
+# reject the lot results are sent again with the next batch, and the web
+# tier tells us which it already has
+BATCH_ATTEMPTS = 3
+
+# how many times to try posting to the web tier
+RETRIES = 6
+# the longest we wait between tries, in seconds
+MAX_BACKOFF = 60
+HTTP_TIMEOUT = 30
+
+# the upper bounds of the buckets for timing things, in seconds
+METRIC_BUCKETS = (0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600, 4 * 3600)
+
+metrics = Registry()
+
+WORKER_COUNT = metrics.register(Gauge('asteroid_listener_workers',
+    'Commands which can be run at the same time'))
+JOBS_IN_FLIGHT = metrics.register(Gauge('asteroid_listener_jobs_in_flight',
+    'Commands being run'))
+JOBS_WAITING = metrics.register(Gauge('asteroid_listener_jobs_waiting',
+    'Messages waiting for a free worker'))
+POOL_SATURATION = metrics.register(Gauge('asteroid_listener_pool_saturation',
+    'The fraction of workers which are busy'))
+MESSAGES = metrics.register(Counter('asteroid_listener_messages_total',
+    'Messages finished with, by whether they were acknowledged or '
+    'rejected', ['outcome']))
+ABANDONED = metrics.register(Counter('asteroid_listener_abandoned_total',
+    'Messages whose runs were started by a listener which stopped, '
+    'and so were failed'))
+QUEUE_WAIT = metrics.register(Histogram(
+    'asteroid_listener_queue_wait_seconds',
+    'How long messages waited between being published and being run',
+    buckets=METRIC_BUCKETS))
+POOL_WAIT = metrics.register(Histogram('asteroid_listener_pool_wait_seconds',
+    'How long messages waited for a free worker', buckets=METRIC_BUCKETS))
+EXECUTION = metrics.register(Histogram('asteroid_listener_execution_seconds',
+    'How long commands took to run', buckets=METRIC_BUCKETS))
+WEBHOOK = metrics.register(Histogram('asteroid_listener_webhook_seconds',
+    'How long posting to the web tier took, including retries',
+    buckets=METRIC_BUCKETS))
+WEBHOOK_RETRIES = metrics.register(Counter(
+    'asteroid_listener_webhook_retries_total',
+    'Posts to the web tier which were tried again'))
+WEBHOOK_FAILURES = metrics.register(Counter(
+    'asteroid_listener_webhook_failures_total',
+    'Posts to the web tier which were given up on'))
+BATCHES = metrics.register(Counter('asteroid_listener_batches_total',
+    'Batches of results sent to the web tier'))
+BATCHED_RESULTS = metrics.register(Counter(
+    'asteroid_listener_batched_results_total',
+    'Results sent to the web tier in batches'))
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "serves the metrics to whatever asks"
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = metrics.expose()
+        self.send_response(200)
+        self.send_header("Content-Type", METRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # every scrape would be logged otherwise
+        pass
+
+def serve_metrics(port):
+    "serve the metrics on a thread of their own, returning the server"
+    server = BaseHTTPServer.HTTPServer(('', port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+class DeliveryError(Exception):
+    """
+    Raised when the web tier won't take a result, with the status it
+    replied with if it refused it
+    """
+
+    def __init__(self, message, status=None):
+        Exception.__init__(self, message)
+        self.status = status
+
+# each thread keeps its own client, and so its own keep-alive connections
+_local = threading.local()
+
+def http_client():
+    "the http client for this thread"
+    if not hasattr(_local, 'http'):
+        _local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+    return _local.http
+
+def post(url, data):
+    """
+    Post a JSON document to the web tier and return the parsed response.
+    Connection problems and server errors are retried with an increasing
+    delay, as the web tier may just be restarting, but client errors
+    aren't as sending the same thing again won't help.
+    """
+    json = simplejson.dumps(data)
+    delay = 1
+    start = time.time()
+    try:
+        for attempt in range(RETRIES):
+            if attempt:
+                WEBHOOK_RETRIES.inc()
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_BACKOFF)
+            try:
+                resp, content = http_client().request(url, "POST", body=json,
+                    headers={'content-type': 'application/json'})
+            except (socket.error, httplib2.HttpLib2Error), e:
+                if DEBUG:
+                    print "error posting to %s: %s" % (url, e)
+                # start again with a fresh connection
+                _local.http = httplib2.Http(timeout=HTTP_TIMEOUT)
+                continue
+            if resp.status < 300:
+                if content:
+                    return simplejson.loads(content)
+                return None
+            if resp.status < 500:
+                raise DeliveryError("%s returned %s" % (url, resp.status),
+                    resp.status)
+            if DEBUG:
+                print "%s returned %s" % (url, resp.status)
+        raise DeliveryError("gave up posting to %s" % url)
+    except DeliveryError:
+        WEBHOOK_FAILURES.inc()
+        raise
+    finally:
+        WEBHOOK.observe(time.time() - start)
+
+class ResultBatcher(object):
+    """
+    Collects the results of finished commands and sends them to the batch
+    webhook together, so under load many runs are updated in one request
+    and one transaction. A batch is sent once it's full or once its first
+    result has waited long enough. Each result can have a function which is
+    called once it's been dealt with, with whether it was delivered.
+    Results in a batch which couldn't be sent go in the next one, up to
+    attempts times.
+    """
+
+    def __init__(self, size=BATCH_SIZE, interval=BATCH_INTERVAL,
+            attempts=BATCH_ATTEMPTS):
+        self.size = size
+        self.interval = interval
+        self.attempts = attempts
+        # bounded, so if the web tier is struggling the workers wait
+        self.results = Queue.Queue(size * 4)
+        # results to send again, with how many times they've been sent
+        self.retrying = []
+        self.thread = threading.Thread(target=self.work)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def add(self, url, result, delivered=None):
+        "queue a result for the batch webhook at url"
+        self.results.put((url, result, delivered, 0))
+
+    def work(self):
+        stopping = False
+        while not stopping or self.retrying:
+            # anything which didn't get through last time goes first
+            batch, self.retrying = self.retrying, []
+            deadline = time.time() + self.interval
+            while not stopping and len(batch) < self.size:
+                # with nothing to send we wait for as long as it takes
+                timeout = None
+                if batch:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                try:
+                    item = self.results.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            if batch:
+                self.deliver(batch)
+
+    def deliver(self, batch):
+        "send a batch, grouped by webhook in case there's more than one"
+        urls = {}
+        for url, result, delivered, sent in batch:
+            urls.setdefault(url, []).append(result)
+        BATCHES.inc(len(urls))
+        BATCHED_RESULTS.inc(len(batch))
+        failed = set()
+        outcomes = {}
+        for url, results in urls.items():
+            try:
+                outcomes[url] = post(url, results) or {}
+                if DEBUG:
+                    print "delivered %d results: %s" % (len(results),
+                        outcomes[url])
+            except DeliveryError:
+                traceback.print_exc()
+                failed.add(url)
+        for url, result, delivered, sent in batch:
+            if url in failed and sent + 1 < self.attempts:
+                self.retrying.append((url, result, delivered, sent + 1))
+            elif delivered is not None:
+                # the web tier refuses results it can't record, such as
+                # ones which would leave a gap in the output. Ones it
+                # already has come back as already_finished
+                delivered(url not in failed and outcomes[url].get(
+                    str(result['run'])) != "bad_request")
+
+    def close(self):
+        "send anything we're holding on to and stop"
+        self.results.put(None)
+        self.thread.join()
+
+def process(msg, batcher=None, delivered=None):
+    """
+    Run the command from a message, sending the output to the webhook as it
+    arrives and the result to the batcher once the command has finished.
+    Each piece of output says where it starts so if it's sent again after a
+    retry the web tier knows it already has it. delivered is called with
+    whether the result got through.
+    """
     # get the JSON document from the message body
     
     if DEBUG:
         print "recieved message"
     
     obj = simplejson.loads(msg.body)
+    # how much output the web tier has, and what it hasn't got yet
+    sent = [0]
+    unsent = []
+    lost = [False]
+
+    # messages queued by older versions don't say when they were queued.
+    # The clocks of the web tier and listener may not quite agree
+    if 'queued_at' in obj:
+        QUEUE_WAIT.observe(max(0, time.time() - obj['queued_at']))
+
+    # tell the web tier we're starting, which also checks the run still
+    # wants running. It may have been failed or deleted while it waited,
+    # or started by a listener which stopped part way through
+    try:
+        started = post(obj['webhook'], {"started": True})
+        if started == "already_started":
+            ABANDONED.inc()
+            abandon(obj)
+    except DeliveryError, e:
+        if e.status is not None:
+            if DEBUG:
+                print "not running %s: %s" % (obj['command'], e)
+            if delivered is not None:
+                delivered(True)
+        else:
+            traceback.print_exc()
+            if delivered is not None:
+                delivered(False)
+        return
+    if started == "already_started":
+        if delivered is not None:
+            delivered(True)
+        return
+
+    def send(output):
+        """
+        post a piece of output, along with any earlier output which didn't
+        get through, so the web tier never has gaps in what it stores
+        """
+        if lost[0]:
+            return
+        unsent.append(output)
+        output = u"".join(unsent)
+        try:
+            post(obj['webhook'], {"output": output, "append": True,
+                "offset": sent[0]})
+        except DeliveryError:
+            traceback.print_exc()
+            if len(output) > MAX_UNSENT:
+                lost[0] = True
+                del unsent[:]
+            return
+        del unsent[:]
+        sent[0] += len(output)
 
     if DEBUG:
         print "running %s" % obj['command']
 
-    # run the specified command
-    code, output = commands.getstatusoutput(obj['command'])
+    # run the specified command, sending the output to obj['webhook']
+    # as it arrives
+    start = time.time()
+    code = execute(obj['command'], send)
+    EXECUTION.observe(time.time() - start)
 
     if DEBUG:
         print "command returned with %s" % code
 
-    # send post request to obj['webhook']
-    # containing the following data
-    pre_json = {"status": code,"output": output}
-
-    # convert to json
-    json = simplejson.dumps(pre_json)
+    if lost[0]:
+        # the web tier can't have all the output, so rather than finish the
+        # run with some of it missing the message goes to the dead letters
+        if DEBUG:
+            print "gave up sending the output of %s" % obj['command']
+        if delivered is not None:
+            delivered(False)
+        return
 
-    # setup the http client
-    h = httplib2.Http()
-    # make a post request
-    resp, content = h.request(
-        obj['webhook'],
-        "POST", body=json,
-        headers={'content-type':'application/json'}
-    )
+    # and finally send the status along with any output still to send,
+    # batched up with others if we can. Messages queued by older versions
+    # don't say which run they're for
+    if batcher is not None and 'batch_webhook' in obj and 'run' in obj:
+        batcher.add(obj['batch_webhook'], {
+            "run": obj['run'],
+            "command": obj['slug'],
+            "output": u"".join(unsent),
+            "append": True,
+            "offset": sent[0],
+            "status": code,
+        }, delivered)
+    else:
+        try:
+            post(obj['webhook'], {"output": u"".join(unsent),
+                "append": True, "offset": sent[0], "status": code})
+            ok = True
+        except DeliveryError:
+            traceback.print_exc()
+            ok = False
+        if delivered is not None:
+            delivered(ok)
 
     if DEBUG:
         print "finished processing message"
 
-def run(host, queue, exchange, key):
-    "Long running message queue processor"
+def abandon(obj):
+    """
+    Tell the web tier that the run in a message failed because the listener
+    running it stopped part way through. Commands aren't always safe to run
+    twice, so runs another listener has started aren't run again.
+    """
+    if DEBUG:
+        print "abandoning %s" % obj['command']
+    post(obj['webhook'], {"output": "\n%s\n" % LOST_MESSAGE,
+        "append": True, "status": -1})
 
-    # we define a tag based on the queue name
-    tag = "%s_tag" % queue
+class Shutdown(Exception):
+    "Raised when we're asked to stop"
+    pass
 
-    # set up a connection to the server
-    conn = amqp.Connection(host)
-    # and get a channel
-    chan = conn.channel()
+def shutdown(signum, frame):
+    "treat a TERM signal like an interrupt"
+    raise Shutdown()
 
-    # define your queue and exchange
-    # if they already exist then we check they are of the correct type
-    chan.exchange_declare(exchange=exchange, type="direct", 
-    durable=False, auto_delete=True)
-    # for our purposes queues want to be unique between implementations
-    # and exchanges are defined by the paperboy service
-    chan.queue_declare(queue=queue, durable=False, 
-                       exclusive=False, auto_delete=True)
+class WorkerPool(object):
+    """
+    Runs jobs on a fixed number of threads. Commands spend their time
+    waiting on other processes so threads are fine here.
+    """
 
-    # and wire the queue and exchange together
-    chan.queue_bind(queue=queue, exchange=exchange, routing_key=key)
+    def __init__(self, size, handler):
+        self.handler = handler
+        self.jobs = Queue.Queue()
+        self.threads = []
+        for i in range(size):
+            thread = threading.Thread(target=self.work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
 
-    # register our callback function for when we see something on the queue
-    chan.basic_consume(queue=queue, no_ack=True, 
-                       callback=recv_callback, consumer_tag=tag)
+    def submit(self, job):
+        "queue a job for the next free worker"
+        self.jobs.put(job)
 
-    # set the script to be long running
-    try:
+    def work(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                # we've been told to stop
+                break
+            try:
+                self.handler(job)
+            except Exception:
+                traceback.print_exc()
+
+    def drain(self):
+        "wait for the queued and running jobs to finish then stop the workers"
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+
+class Listener(object):
+    """
+    Takes messages from the queues of our targets and hands them to a pool
+    of workers. The broker only gives us as many unacknowledged messages as
+    we have workers, and a message is only acknowledged once its command
+    has finished, so messages we haven't finished with go back on the
+    queue if we die.
+
+    amqplib channels aren't safe to share between threads, so only the main
+    thread uses ours. The workers leave their acks and rejects in a queue
+    which it sends between short waits for the broker.
+    """
+
+    def __init__(self, host, exchange, targets=(DEFAULT_TARGET,),
+            workers=WORKERS):
+        self.host = host
+        self.exchange = exchange
+        self.targets = targets
+        self.workers = workers
+        self.in_flight = 0
+        self.waiting = 0
+        WORKER_COUNT.set(workers)
+        # we define a tag for each queue based on its name
+        self.tags = ["%s_tag" % queue_name(target) for target in targets]
+        # the delivery tags of messages we're finished with, and whether
+        # they were delivered
+        self.settled = Queue.Queue()
+        # the workers keep count of what they're doing
+        self.lock = threading.Lock()
+
+    def recv_callback(self, msg):
+        "Callback function each time a message is recieved"
+        msg.received_at = time.time()
+        self.track(waiting=1)
+        self.pool.submit(msg)
+
+    def track(self, waiting=0, in_flight=0):
+        "keep count of the messages waiting for a worker and being run"
+        self.lock.acquire()
+        try:
+            self.waiting += waiting
+            self.in_flight += in_flight
+            JOBS_WAITING.set(self.waiting)
+            JOBS_IN_FLIGHT.set(self.in_flight)
+            POOL_SATURATION.set(float(self.in_flight) / self.workers)
+        finally:
+            self.lock.release()
+
+    def handle(self, msg):
+        """
+        run in a worker for each message. The message is acknowledged once
+        the result has been delivered, and rejected if that fails or the
+        message can't be run.
+        """
+        self.track(waiting=-1, in_flight=1)
+        POOL_WAIT.observe(time.time() - msg.received_at)
+        try:
+            try:
+                process(msg, self.batcher, lambda ok: self.settle(msg, ok))
+            except Exception:
+                self.settle(msg, False)
+                raise
+        finally:
+            self.track(in_flight=-1)
+
+    def settle(self, msg, delivered):
+        """
+        acknowledge a message, or reject it to the dead letter queue, once
+        the main thread gets to it
+        """
+        self.settled.put((msg.delivery_tag, delivered))
+
+    def send_settled(self):
+        "send the acks and rejects the workers have left us"
         while True:
-            chan.wait()
-    except KeyboardInterrupt:
-        # if we do exit then tell the server
-        chan.basic_cancel(tag)
+            try:
+                tag, delivered = self.settled.get_nowait()
+            except Queue.Empty:
+                return
+            if delivered:
+                self.chan.basic_ack(tag)
+                outcome = "acked"
+            else:
+                self.chan.basic_reject(tag, requeue=False)
+                outcome = "rejected"
+            MESSAGES.inc(outcome=outcome)
+
+    def readable(self, timeout):
+        """
+        whether the broker has sent us something to wait for, waiting no
+        longer than timeout. amqplib or ssl may already have read it off the
+        socket, in which case the socket won't say so
+        """
+        transport = self.conn.transport
+        reader = getattr(self.conn, 'method_reader', None)
+        ssl = getattr(transport, 'sslobj', None)
+        if self.chan.method_queue or getattr(transport, '_read_buffer', None):
+            return True
+        if reader is not None and not reader.queue.empty():
+            return True
+        if ssl is not None and hasattr(ssl, 'pending') and ssl.pending():
+            return True
+        return bool(select.select([transport.sock], [], [], timeout)[0])
+
+    def declare(self):
+        """
+        declare the exchange, the dead letter queue and the queue of each
+        of our targets. If they already exist the broker checks they're of
+        the same type
+        """
+        self.chan.exchange_declare(exchange=self.exchange, type="direct",
+            durable=True, auto_delete=False)
+
+        # rejected messages are kept in the dead letter queue
+        self.chan.exchange_declare(exchange=DEAD_LETTER_EXCHANGE,
+            type="fanout", durable=True, auto_delete=False)
+        self.chan.queue_declare(queue=DEAD_LETTER_QUEUE, durable=True,
+            exclusive=False, auto_delete=False)
+        self.chan.queue_bind(queue=DEAD_LETTER_QUEUE,
+            exchange=DEAD_LETTER_EXCHANGE)
+
+        for target in self.targets:
+            # every listener for a target shares its queue, which is
+            # bound to the exchange with the target as the routing key
+            queue = queue_name(target)
+            self.chan.queue_declare(queue=queue, durable=True,
+                exclusive=False, auto_delete=False,
+                arguments={'x-dead-letter-exchange': DEAD_LETTER_EXCHANGE})
+            self.chan.queue_bind(queue=queue, exchange=self.exchange,
+                routing_key=target)
+
+    def run(self):
+        "Long running message queue processor"
+
+        # set up a connection to the server
+        self.conn = amqp.Connection(self.host)
+        # and get a channel
+        self.chan = self.conn.channel()
+
+        try:
+            self.declare()
+        except amqp.AMQPChannelException, e:
+            if e.amqp_reply_code != PRECONDITION_FAILED:
+                raise
+            print >> sys.stderr, UPGRADE_MESSAGE % (e.amqp_reply_text,
+                self.exchange)
+            self.conn.close()
+            sys.exit(1)
 
-        # and close everything
-        chan.close()
-        conn.close()
+        # don't take more messages than we have workers to run them
+        self.batcher = ResultBatcher()
+        self.pool = WorkerPool(self.workers, self.handle)
+        self.chan.basic_qos(prefetch_size=0, prefetch_count=self.workers,
+            a_global=False)
 
-        sys.exit()
+        for target, tag in zip(self.targets, self.tags):
+            # register our callback function for when we see something on
+            # the queue
+            self.chan.basic_consume(queue=queue_name(target), no_ack=False,
+                callback=self.recv_callback, consumer_tag=tag)
+
+        if DEBUG:
+            print "listening for %s" % ", ".join(self.targets)
+
+        # set the script to be long running
+        signal.signal(signal.SIGTERM, shutdown)
+        try:
+            while True:
+                self.send_settled()
+                if self.readable(SETTLE_INTERVAL):
+                    self.chan.wait()
+        except (KeyboardInterrupt, Shutdown):
+            # if we do exit then tell the server we don't want any more
+            for tag in self.tags:
+                self.chan.basic_cancel(tag)
+
+            # let the commands we already have finish
+            if DEBUG:
+                print "waiting for running commands to finish"
+            self.pool.drain()
+            # and deliver their results
+            self.batcher.close()
+            self.send_settled()
+
+            # and close everything
+            self.chan.close()
+            self.conn.close()
+
+            sys.exit()
+
+def run(host, exchange, targets=(DEFAULT_TARGET,), workers=WORKERS,
+        metrics_port=None):
+    "Listen for and run commands for the targets, serving metrics if asked"
+    if metrics_port:
+        serve_metrics(metrics_port)
+    Listener(host, exchange, targets, workers).run()
 
 if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--host', default=QUEUE_ADDRESS,
+        help='the address of the message queue')
+    parser.add_option('--workers', type='int', default=WORKERS,
+        help='how many commands to run at the same time')
+    parser.add_option('--target', action='append', dest='targets',
+        help='run commands with this target, can be given more than once. '
+        'Use %s for commands without a target' % DEFAULT_TARGET)
+    parser.add_option('--metrics-port', type='int',
+        help='serve metrics at /metrics on this port')
+    options, args = parser.parse_args()
+
     run(
-        host = QUEUE_ADDRESS,
-        queue = "asteroid_queue",
-        exchange = "asteroid",
-        key = "all",
-    )
\ No newline at end of file
+        host = options.host,
+        exchange = EXCHANGE,
+        targets = options.targets or [DEFAULT_TARGET],
+        workers = options.workers,
+        metrics_port = options.metrics_port,
+    )
@@ -59,6 +59,8 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # first, so the time the rest take is included
+    'runner.profiling.ProfilingMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -92,9 +94,55 @@ DEFAULT_FROM_EMAIL = 'webmaster@localhost'
 QUEUE_COMMANDS = True
 QUEUE_ADDRESS = '172.16.142.128'
 
+# without the queue commands are run on threads in the web process, unless
+# this is turned off in which case they are run during the request
+BACKGROUND_COMMANDS = True
+# how many commands to run at once, and how many can wait for their turn
+BACKGROUND_WORKERS = 4
+BACKGROUND_QUEUE_SIZE = 100
+
+# lists of commands and runs are cached until a command or run changes.
+# The local memory cache is per process, use a file cache to share it
+# between processes, for instance file:///var/tmp/asteroid_cache. Changes
+# made by management commands such as prune_runs and reap_runs only reach
+# the web server's cached pages through a shared cache
+CACHE_BACKEND = 'locmem://'
+# how long to cache things for anyway, in seconds
+CACHE_TIMEOUT = 600
+
+# runs in progress which haven't been heard from for this many hours are
+# assumed to have been lost, and are failed by the reap_runs command
+STALE_RUN_HOURS = 24
+
+# how the output of runs is searched, fts5 needs sqlite with full text
+# search and like works with any database, see runner.search. None uses
+# fts5 if the database has it and like otherwise
+SEARCH_BACKEND = None
+
+# time every database query for the metrics at /metrics, which costs a
+# little on each query
+METRICS_TIME_QUERIES = True
+
+# the fraction of requests to profile, shown to staff at /admin/profiling/,
+# 0.01 for one in a hundred. It's off by default. The latest profiles are
+# kept in memory, this many per process
+PROFILING_SAMPLE_RATE = 0
+PROFILING_BUFFER_SIZE = 500
+
+# where the prune_runs command archives runs before deleting them
+ARCHIVE_DIR = os.path.join(SITE_ROOT, 'archive')
+
 # used for the callback
 DOMAIN = "http://localhost:8001"
 
+# how long a request for new output from a run waits for some to arrive,
+# and how long it first waits between checks, doubling each time, in
+# seconds. A waiting request holds a web server thread the whole time, so
+# every open run page takes one, and the page asks again as soon as it's
+# answered, so a longer wait saves little
+TAIL_TIMEOUT = 5
+TAIL_INTERVAL = 0.5
+
 # ignore django code when we calculate coverage
 EXCLUDE_FROM_COVERAGE = ['django']
 
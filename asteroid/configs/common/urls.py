@@ -4,20 +4,41 @@ from django.views.generic.simple import direct_to_template
 from django.conf import settings
 
 from runner.views import run_command, show_command, list_commands, show_run, \
-    dashboard, list_runs, run_web_hook
+    dashboard, list_runs, run_web_hook, tail_run, run_batch_web_hook, \
+    run_commands, search_runs, show_metrics
+from runner.profiling import show_profiles
+from runner.api import api_commands, api_command, api_runs, api_run, \
+    api_run_status, api_run_output, api_search, api_command_stats
 
 admin.autodiscover()
 
 urlpatterns = patterns('',
     (r'^admin/doc/', include('django.contrib.admindocs.urls')),
+    (r'^admin/profiling/$', show_profiles),
     (r'^admin/(.*)', admin.site.root),
     (r'^$', dashboard),
     (r'^commands/$', list_commands),
     (r'^runs/$', list_runs),
+    (r'^hooks/$', run_batch_web_hook),
+    (r'^run/$', run_commands),
+    (r'^search/$', search_runs),
+    (r'^metrics$', show_metrics),
     (r'^commands/(?P<command>[-\w]+)/(?P<run>\d+)/$', show_run),
     (r'^commands/(?P<command>[-\w]+)/run/$', run_command),
     (r'^commands/(?P<command>[-\w]+)/(?P<run>\d+)/hook/$', run_web_hook),
+    (r'^commands/(?P<command>[-\w]+)/(?P<run>\d+)/tail/$', tail_run),
     (r'^commands/(?P<command>[-\w]+)/$', show_command),
+    (r'^api/commands/$', api_commands),
+    (r'^api/runs/$', api_runs),
+    (r'^api/search/$', api_search),
+    (r'^api/commands/(?P<command>[-\w]+)/$', api_command),
+    (r'^api/commands/(?P<command>[-\w]+)/runs/$', api_runs),
+    (r'^api/commands/(?P<command>[-\w]+)/stats/$', api_command_stats),
+    (r'^api/commands/(?P<command>[-\w]+)/(?P<run>\d+)/$', api_run),
+    (r'^api/commands/(?P<command>[-\w]+)/(?P<run>\d+)/status/$',
+        api_run_status),
+    (r'^api/commands/(?P<command>[-\w]+)/(?P<run>\d+)/output/$',
+        api_run_output),
     (r'^assets/(?P<path>.*)$', 'django.views.static.serve', {
         'document_root': settings.MEDIA_ROOT
     }),
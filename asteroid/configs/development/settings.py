@@ -3,6 +3,10 @@ from asteroid.configs.common.settings import *
 # used for the callback
 DOMAIN = "http://localhost:8000"
 
+# the tests use a file rather than sqlite's default of memory, so the
+# background threads, which have connections of their own, can see it
+TEST_DATABASE_NAME = os.path.join(SITE_ROOT, 'db') + '/test.db'
+
 INSTALLED_APPS += (
     'test_extensions',
     'clue',